@@ -0,0 +1,446 @@
+"""
+レシピ生成ワーカーのオフラインベンチマーク
+
+LLMをスタブに置き換えたCeleryワーカーをプール種別・同時実行数ごとに起動し、レシピ生成タスクを投入して
+スループット・エンドツーエンドのレイテンシ（p50/p95/p99）・ステップごとのオーバーヘッド・
+キャッシュ済み/キャッシュ外の入力トークン数・動画解析1回あたりのGeminiのトークン数と秒数・
+タスクあたりのWebSocketメッセージのバイト数を計測する。
+WebSocketの送信先はローカルの受信サーバー、Redisは --redis-url 未指定の場合 fakeredis のTCPサーバーを使う。
+
+    python -m benchmarks.run --pools prefork,threads --concurrency 4,16 --tasks 100
+
+結果はJSONで保存し、--baseline に過去の結果を指定すると同じ条件の実行と比較して表示する。
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from benchmarks.sink import FINAL_TYPES, WebSocketSink
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_QUEUES = "recipe_gen_queue,recipe_gemini_queue,recipe_bedrock_queue"
+
+# 進捗メッセージのtypeからステップの区切りを判定する
+# (ステップ名, 開始を表すマーク, 終了を表すマーク, 想定するスタブの待ち時間の種類)
+STEPS = [
+    ("queue_wait", "submitted", "started", None),
+    ("gemini", "started", "extracted", "gemini"),
+    ("rewrite", "extracted", "rewritten", "bedrock"),
+    ("attributes", "rewritten", "attributes", "bedrock"),
+    ("embedding", "attributes", "finished", "embed"),
+]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark for the recipe generation worker")
+    parser.add_argument("--pools", default="prefork,threads,gevent", help="カンマ区切りのCeleryプール種別")
+    parser.add_argument("--concurrency", default="4,16", help="カンマ区切りのワーカー同時実行数")
+    parser.add_argument("--tasks", type=int, default=50, help="1回の実行で投入するタスク数")
+    parser.add_argument("--warmup", type=int, default=2, help="計測前に投入するタスク数（ワーカーの起動確認を兼ねる）")
+    parser.add_argument("--rate", type=float, default=0, help="毎秒の投入数（0で一括投入）")
+    parser.add_argument("--gemini-latency", type=float, default=3.0)
+    parser.add_argument("--bedrock-latency", type=float, default=1.0)
+    parser.add_argument("--embed-latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.1, help="スタブの待ち時間の揺らぎ（0.1で±10%%）")
+    parser.add_argument("--error-rate", type=float, default=0, help="スタブが一時的なエラーを返す割合")
+    parser.add_argument("--pipeline-mode", choices=["monolithic", "canvas", "async"], default=os.getenv("PIPELINE_MODE", "monolithic"))
+    parser.add_argument("--wire-format", choices=["json", "msgpack"], default="json", help="受信サーバーが選択するWebSocketメッセージの形式")
+    parser.add_argument("--embedding-dtype", choices=["float32", "float16"], default="float32", help="msgpack形式で送信するembeddingの精度")
+    parser.add_argument("--media-resolution", choices=["low", "medium", "high"], help="動画解析の解像度（未指定の場合はモデルの既定値）")
+    parser.add_argument("--video-fps", type=float, default=0, help="動画から切り出すフレームの頻度（0の場合はモデルの既定値）")
+    parser.add_argument("--adaptive-resolution", action="store_true", help="lowの解像度で抽出し、工程・材料が空の場合のみ抽出し直す")
+    parser.add_argument("--low-res-incomplete-rate", type=float, default=0, help="lowの解像度でスタブが工程が空のレシピを返す割合")
+    parser.add_argument("--redis-url", help="ローカルのRedis（未指定の場合はfakeredisのTCPサーバーを起動）")
+    parser.add_argument("--flush-redis", action="store_true", help="--redis-urlのDBを実行ごとにFLUSHDBする")
+    parser.add_argument("--timeout", type=float, default=600, help="1回の実行でタスクの完了を待つ秒数")
+    parser.add_argument("--output", help="結果のJSONの保存先（未指定の場合はbenchmarks/results/に保存）")
+    parser.add_argument("--baseline", help="比較する過去の結果のJSON")
+    return parser.parse_args(argv)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(math.ceil(len(ordered) * q / 100) - 1, 0)], 4)
+
+
+def distribution(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": round(statistics.fmean(values), 4) if values else None,
+        "max": round(max(values), 4) if values else None,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_redis():
+    """fakeredisのTCPサーバーをバックグラウンドで起動"""
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(("127.0.0.1", free_port()), server_type="redis")
+    # 接続ごとのスレッドが残っていても終了できるようにする
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fakeredis", daemon=True).start()
+    return server
+
+
+def configure_environment(args: argparse.Namespace, redis_url: str, sink: WebSocketSink, metrics_dir: str):
+    """ベンチマークとワーカーのサブプロセスで共有する設定を環境変数に書き込む
+
+    configは読み込み時に環境変数を参照するため、アプリのモジュールを読み込む前に呼び出す。
+    """
+    os.environ.update({
+        "REDIS_URL": redis_url,
+        "CELERY_BROKER_URL": redis_url,
+        "CELERY_RESULT_BACKEND": redis_url,
+        "WEBSOCKET_URL": sink.url,
+        "PIPELINE_MODE": args.pipeline_mode,
+        "WEBSOCKET_EMBEDDING_DTYPE": args.embedding_dtype,
+        "GEMINI_MEDIA_RESOLUTION": args.media_resolution or "",
+        "GEMINI_VIDEO_FPS": str(args.video_fps),
+        "GEMINI_ADAPTIVE_RESOLUTION": "true" if args.adaptive_resolution else "false",
+        "BENCH_LOW_RES_INCOMPLETE_RATE": str(args.low_res_incomplete_rate),
+        "PROMETHEUS_MULTIPROC_DIR": metrics_dir,
+        "BENCH_GEMINI_LATENCY": str(args.gemini_latency),
+        "BENCH_BEDROCK_LATENCY": str(args.bedrock_latency),
+        "BENCH_EMBED_LATENCY": str(args.embed_latency),
+        "BENCH_LATENCY_JITTER": str(args.jitter),
+        "BENCH_ERROR_RATE": str(args.error_rate),
+    })
+
+
+def start_worker(pool: str, concurrency: int, log_path: str) -> subprocess.Popen:
+    env = dict(os.environ, METRICS_PORT=str(free_port()), PYTHONUNBUFFERED="1")
+    command = [
+        sys.executable, "-m", "celery", "-A", "benchmarks.worker", "worker",
+        "-P", pool, "-c", str(concurrency), "-Q", WORKER_QUEUES,
+        "-n", f"bench-{pool}-{concurrency}@%h",
+        "--loglevel", "WARNING", "--without-gossip", "--without-mingle", "--without-heartbeat",
+    ]
+    log_file = open(log_path, "w", encoding="utf-8")
+    return subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def stop_worker(process: subprocess.Popen):
+    """ウォームシャットダウンで停止し、応答がなければ強制終了"""
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def submit_tasks(sink: WebSocketSink, count: int, rate: float) -> Dict[str, float]:
+    """重複しない動画URLでタスクを投入し、セッションごとの投入時刻を返す"""
+    from tasks.queue_processor import submit_recipe_generation
+
+    submitted = {}
+    started = time.monotonic()
+    for index in range(count):
+        if rate > 0:
+            time.sleep(max(started + index / rate - time.monotonic(), 0))
+        session_id = f"bench-{uuid.uuid4().hex}"
+        video_id = uuid.uuid4().hex[:11]
+        sink.expect(session_id)
+        submitted[session_id] = time.time()
+        submit_recipe_generation(
+            session_id,
+            f"https://youtube.com/shorts/{video_id}",
+            user_id=1,
+            metadata={"priority": "normal", "created_at": datetime.now(timezone.utc).isoformat()},
+        )
+    return submitted
+
+
+def step_marks(submitted_at: float, messages: List[dict]) -> Dict[str, float]:
+    """受信したメッセージから各ステップの区切りの時刻を取得"""
+    marks = {"submitted": submitted_at}
+    for message in messages:
+        data = message["data"]
+        at = message["received_at"]
+        if message["type"] == "task_started":
+            marks.setdefault("started", at)
+        elif message["type"] in FINAL_TYPES:
+            marks["finished"] = at
+        elif message["type"] == "task_progress" and not data.get("streaming"):
+            if data.get("type") == 2:
+                marks.setdefault("extracted", at)
+            elif data.get("type") == 3:
+                marks.setdefault("rewritten", at)
+            elif data.get("type") in (4, 5, 6):
+                marks["attributes"] = at
+    return marks
+
+
+def analyze_run(args: argparse.Namespace, sink: WebSocketSink, submitted: Dict[str, float], first_submit: float) -> Dict:
+    expected = {"gemini": args.gemini_latency, "bedrock": args.bedrock_latency, "embed": args.embed_latency}
+    latencies = []
+    failed = 0
+    last_finish = first_submit
+    step_values = {name: [] for name, *_ in STEPS}
+    message_bytes = []
+    for session_id, submitted_at in submitted.items():
+        messages = sink.messages(session_id)
+        final = [message for message in messages if message["type"] in FINAL_TYPES]
+        if not final:
+            continue
+        if final[-1]["type"] == "task_failed":
+            failed += 1
+            continue
+        marks = step_marks(submitted_at, messages)
+        message_bytes.append(sum(message["size"] for message in messages))
+        latencies.append(marks["finished"] - submitted_at)
+        last_finish = max(last_finish, marks["finished"])
+        for name, start, end, _ in STEPS:
+            if start in marks and end in marks:
+                step_values[name].append(marks[end] - marks[start])
+
+    steps = {}
+    for name, _, _, kind in STEPS:
+        values = step_values[name]
+        steps[name] = distribution(values)
+        if kind is not None:
+            # スタブの待ち時間を除いた、ワーカー側の処理・通信にかかった時間
+            steps[name]["expected"] = expected[kind]
+            steps[name]["overhead_p50"] = round(steps[name]["p50"] - expected[kind], 4) if values else None
+            steps[name]["overhead_p95"] = round(steps[name]["p95"] - expected[kind], 4) if values else None
+
+    duration = last_finish - first_submit
+    return {
+        "tasks": len(submitted),
+        "completed": len(latencies),
+        "failed": failed,
+        "timed_out": len(submitted) - len(latencies) - failed,
+        "duration_seconds": round(duration, 3),
+        "throughput_per_second": round(len(latencies) / duration, 4) if duration > 0 else None,
+        "latency_seconds": distribution(latencies),
+        "steps": steps,
+        "message_bytes_per_task": round(statistics.mean(message_bytes)) if message_bytes else None,
+    }
+
+
+def token_totals(metrics_dir: str) -> Dict[str, float]:
+    """ワーカーがPrometheusのマルチプロセス用ディレクトリに記録したトークン数を種類ごとに合計
+
+    動画解析（recipe_gemini_extraction_*）のトークン数・秒数の合計と回数も gemini_* として含める。
+    """
+    from prometheus_client import CollectorRegistry
+    from prometheus_client.multiprocess import MultiProcessCollector
+
+    if not os.path.isdir(metrics_dir):
+        return {}
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry, path=metrics_dir)
+    totals = {}
+    for metric in registry.collect():
+        for sample in metric.samples:
+            if metric.name == "recipe_llm_tokens" and sample.name.endswith("_total"):
+                kind = sample.labels["kind"]
+                totals[kind] = totals.get(kind, 0) + sample.value
+            elif metric.name.startswith("recipe_gemini_extraction_") and sample.name.endswith(("_sum", "_count")):
+                key = sample.name.replace("recipe_gemini_extraction_", "gemini_")
+                totals[key] = totals.get(key, 0) + sample.value
+                if sample.name == "recipe_gemini_extraction_tokens_count" and sample.labels["escalated"] == "true":
+                    totals["gemini_escalated"] = totals.get("gemini_escalated", 0) + sample.value
+    return totals
+
+
+def token_usage(before: Dict[str, float], after: Dict[str, float]) -> Dict:
+    usage = {kind: int(after.get(kind, 0) - before.get(kind, 0)) for kind in ("input", "cached_input", "output")}
+    total_input = usage["input"] + usage["cached_input"]
+    usage["cached_input_ratio"] = round(usage["cached_input"] / total_input, 4) if total_input else None
+    return usage
+
+
+def gemini_usage(before: Dict[str, float], after: Dict[str, float]) -> Dict:
+    """動画解析1回あたりのトークン数・秒数と、解像度を上げて抽出し直した回数"""
+    delta = {key: after.get(key, 0) - before.get(key, 0) for key in ("gemini_tokens_sum", "gemini_tokens_count", "gemini_seconds_sum", "gemini_escalated")}
+    count = delta["gemini_tokens_count"]
+    return {
+        "extractions": int(count),
+        "escalated": int(delta["gemini_escalated"]),
+        "tokens_per_extraction": round(delta["gemini_tokens_sum"] / count) if count else None,
+        "seconds_per_extraction": round(delta["gemini_seconds_sum"] / count, 3) if count else None,
+    }
+
+
+def run_once(args: argparse.Namespace, sink: WebSocketSink, pool: str, concurrency: int, log_dir: str, flush) -> Dict:
+    result = {"pool": pool, "concurrency": concurrency}
+    if pool in ("gevent", "eventlet") and importlib.util.find_spec(pool) is None:
+        result["skipped"] = f"{pool} is not installed"
+        return result
+
+    flush()
+    sink.reset()
+    log_path = os.path.join(log_dir, f"worker-{pool}-{concurrency}.log")
+    result["worker_log"] = log_path
+    worker = start_worker(pool, concurrency, log_path)
+    try:
+        # ウォームアップのタスクが完了した時点でワーカーが起動済みとみなす
+        warmup = submit_tasks(sink, max(args.warmup, 1), 0)
+        if sink.wait(list(warmup), timeout=120):
+            result["skipped"] = "worker did not complete warm-up tasks"
+            return result
+
+        metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+        tokens_before = token_totals(metrics_dir)
+        first_submit = time.time()
+        submitted = submit_tasks(sink, args.tasks, args.rate)
+        sink.wait(list(submitted), timeout=args.timeout)
+        result.update(analyze_run(args, sink, submitted, first_submit))
+        tokens_after = token_totals(metrics_dir)
+        result["tokens"] = token_usage(tokens_before, tokens_after)
+        result["gemini"] = gemini_usage(tokens_before, tokens_after)
+        return result
+    finally:
+        stop_worker(worker)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict, baseline: Dict):
+    """同じプール種別・同時実行数の実行とスループット・p95レイテンシを比較して表示"""
+    previous = {(run["pool"], run["concurrency"]): run for run in baseline.get("runs", []) if "skipped" not in run}
+    print(f"\nCompared with {baseline.get('meta', {}).get('commit') or 'baseline'}")
+    for run in results["runs"]:
+        before = previous.get((run["pool"], run["concurrency"]))
+        if "skipped" in run or before is None:
+            continue
+        for label, after_value, before_value in [
+            ("throughput/s", run["throughput_per_second"], before["throughput_per_second"]),
+            ("latency p95 s", run["latency_seconds"]["p95"], before["latency_seconds"]["p95"]),
+        ]:
+            if after_value is None or not before_value:
+                continue
+            change = (after_value - before_value) / before_value * 100
+            print(f"  {run['pool']:>8} c={run['concurrency']:<4} {label:<14} {before_value:>9.3f} -> {after_value:>9.3f} ({change:+.1f}%)")
+
+
+def print_summary(results: Dict):
+    print(f"\n{'pool':>8} {'c':>4} {'done':>6} {'tput/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'cached':>7} {'KB/task':>8} {'gem tok':>8} {'gem s':>6}  step overhead p50 (s)")
+    for run in results["runs"]:
+        if "skipped" in run:
+            print(f"{run['pool']:>8} {run['concurrency']:>4}  skipped: {run['skipped']}")
+            continue
+        latency = run["latency_seconds"]
+        overheads = " ".join(
+            f"{name}={step['overhead_p50']:.3f}" for name, step in run["steps"].items() if step.get("overhead_p50") is not None
+        )
+        # 入力トークンのうちプロンプトキャッシュから読み込んだ割合
+        cached_ratio = run.get("tokens", {}).get("cached_input_ratio")
+        cached = f"{cached_ratio:.0%}" if cached_ratio is not None else "-"
+        message_bytes = run.get("message_bytes_per_task")
+        size = f"{message_bytes / 1024:.1f}" if message_bytes is not None else "-"
+        # 動画解析1回あたりのGeminiのトークン数・秒数（再抽出を含む）
+        gemini = run.get("gemini", {})
+        gemini_tokens = str(gemini["tokens_per_extraction"]) if gemini.get("tokens_per_extraction") is not None else "-"
+        gemini_seconds = f"{gemini['seconds_per_extraction']:.2f}" if gemini.get("seconds_per_extraction") is not None else "-"
+        print(
+            f"{run['pool']:>8} {run['concurrency']:>4} {run['completed']:>3}/{run['tasks']:<3}"
+            f"{run['throughput_per_second'] or 0:>8.2f} {latency['p50'] or 0:>8.2f} {latency['p95'] or 0:>8.2f} {latency['p99'] or 0:>8.2f} {cached:>7} {size:>8}"
+            f" {gemini_tokens:>8} {gemini_seconds:>6}  {overheads}"
+        )
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    pools = [pool.strip() for pool in args.pools.split(",") if pool.strip()]
+    concurrencies = [int(value) for value in args.concurrency.split(",") if value.strip()]
+
+    sink = WebSocketSink(wire_format=args.wire_format)
+    sink.start()
+    fake_redis = None if args.redis_url else start_fake_redis()
+    redis_url = args.redis_url or f"redis://127.0.0.1:{fake_redis.server_address[1]}/0"
+    log_dir = tempfile.mkdtemp(prefix="recipe-bench-")
+    configure_environment(args, redis_url, sink, os.path.join(log_dir, "prometheus"))
+
+    import redis
+
+    redis_client = redis.from_url(redis_url)
+
+    def flush():
+        # 前回の実行のレート制限・サーキットブレーカー・ルーターの統計を持ち越さない
+        if args.redis_url is None or args.flush_redis:
+            redis_client.flushdb()
+
+    results = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "redis": "external" if args.redis_url else "fakeredis",
+            "pipeline_mode": args.pipeline_mode,
+            "wire_format": args.wire_format,
+            "embedding_dtype": args.embedding_dtype,
+            "media_resolution": args.media_resolution,
+            "video_fps": args.video_fps,
+            "adaptive_resolution": args.adaptive_resolution,
+            "low_res_incomplete_rate": args.low_res_incomplete_rate,
+            "tasks": args.tasks,
+            "rate": args.rate,
+            "stub_latency_seconds": {
+                "gemini": args.gemini_latency,
+                "bedrock": args.bedrock_latency,
+                "embed": args.embed_latency,
+                "jitter": args.jitter,
+            },
+            "error_rate": args.error_rate,
+        },
+        "runs": [],
+    }
+    try:
+        for pool in pools:
+            for concurrency in concurrencies:
+                print(f"Running pool={pool} concurrency={concurrency} ...", flush=True)
+                results["runs"].append(run_once(args, sink, pool, concurrency, log_dir, flush))
+    finally:
+        sink.stop()
+        if fake_redis:
+            fake_redis.shutdown()
+
+    output = args.output or os.path.join(ROOT_DIR, "benchmarks", "results", f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print_summary(results)
+    print(f"\nResults written to {output} (worker logs: {log_dir})")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
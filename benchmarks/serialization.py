@@ -0,0 +1,177 @@
+"""
+Celeryのタスクメッセージ・結果のシリアライズのベンチマーク
+
+レシピ生成タスク1件あたりにブローカー（Redisに保存されるメッセージ本文）と結果バックエンドに書き込むバイト数、
+およびワーカー・呼び出し側でのシリアライズ/デシリアライズのCPU時間を、シリアライザ・圧縮・結果の保存方式ごとに計測する。
+メッセージと結果はCeleryと同じ関数（kombuのdumps/compress、結果バックエンドのencode）で作成し、Redisには接続しない。
+
+    python -m benchmarks.serialization --pipeline-mode canvas --iterations 500
+
+canvasモードのメッセージは各ステップの引数のみを対象とし、後続のchain・chordのシグネチャは含めない。
+"""
+import argparse
+import base64
+import json
+import random
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from celery import Celery
+from kombu.compression import compress, decompress
+from kombu.serialization import dumps, loads, prepare_accept_content
+
+from benchmarks.stubs import BEDROCK_RESPONSES, EMBEDDING_DIMENSIONS, SAMPLE_RECIPE
+from tasks.queue_processor import build_completion_data, recipe_result_summary
+from utils.task_results import COMPRESSED_MSGPACK, task_result
+
+URL = "https://www.youtube.com/shorts/abcdefghijk"
+ACCEPT_CONTENT = ["json", "msgpack", COMPRESSED_MSGPACK]
+
+# (名前, タスクのシリアライザ, 結果のシリアライザ, タスクメッセージの圧縮, 結果の保存方式)
+CASES = [
+    ("json/full", "json", "json", None, "full"),
+    ("json/summary", "json", "json", None, "summary"),
+    ("json+zlib/summary", "json", "json", "zlib", "summary"),
+    ("msgpack/summary", "msgpack", "msgpack", None, "summary"),
+    ("msgpack-zlib/summary", COMPRESSED_MSGPACK, COMPRESSED_MSGPACK, None, "summary"),
+    ("msgpack-zlib/full", COMPRESSED_MSGPACK, COMPRESSED_MSGPACK, None, "full"),
+    ("json/ignore", "json", "json", None, "ignore"),
+]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Celeryのタスクメッセージ・結果のシリアライズのベンチマーク")
+    parser.add_argument("--pipeline-mode", choices=["monolithic", "canvas"], default="monolithic")
+    parser.add_argument("--iterations", type=int, default=200, help="CPU時間を計測する繰り返し回数")
+    parser.add_argument("--output", help="結果のJSONの保存先")
+    return parser.parse_args(argv)
+
+
+def sample_generated() -> Dict:
+    """スタブと同じ内容の生成結果（embeddingは乱数）"""
+    responses = {list(value)[0]: value for _, value in BEDROCK_RESPONSES}
+    rng = random.Random(0)
+    return {
+        "recipe": SAMPLE_RECIPE,
+        "genre": responses["genre"],
+        "recipe_name": responses["recipes"],
+        "keywords": responses["keywords"],
+        "embedding": [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)],
+        "embedding_model": "amazon.titan-embed-text-v1",
+    }
+
+
+def task_payloads(mode: str, policy: str) -> Tuple[List[Tuple[str, tuple]], List[object]]:
+    """1タスクで送信するメッセージ（タスク名, 引数）と、結果バックエンドに保存する戻り値の一覧"""
+    session_id = f"bench-{uuid.uuid4().hex}"
+    generated = sample_generated()
+    data = build_completion_data(generated, URL, 1)
+    summary = recipe_result_summary(session_id, "abcdefghijk", data)
+    metadata = {"priority": "normal", "created_at": "2025-01-01T00:00:00+00:00", "status": "pending"}
+    messages = [("process_recipe_generation_task", (session_id, URL, 1, metadata))]
+    if mode == "monolithic":
+        return messages, [task_result(policy, data, summary)] if policy != "ignore" else []
+
+    dispatched = {"status": "DISPATCHED", "workflow_id": str(uuid.uuid4())}
+    context = {"session_id": session_id, "url": URL, "user_id": 1, "cache_video_id": None, "priority": 5, "wait_seconds": 0.1, "dispatched_at": time.time(), "video": None, "run_id": uuid.uuid4().hex}
+    extracted = {**context, "gemini": SAMPLE_RECIPE}
+    rewritten = {**extracted, "rewrite": SAMPLE_RECIPE}
+    attributes = [{"context": rewritten, "attributes": {name: generated[name]}} for name in ("genre", "recipe_name", "keywords")]
+    messages += [
+        ("extract_recipe_step", (context,)),
+        ("rewrite_recipe_step", (extracted,)),
+        *[("generate_attributes_step", (rewritten, [name])) for name in ("genre", "recipe_name", "keywords")],
+        ("embed_and_publish_step", (attributes,)),
+    ]
+    results = [] if policy == "ignore" else [task_result(policy, dispatched, dispatched)]
+    if policy == "full":
+        results += [extracted, rewritten]
+    # chordのヘッダーの結果は保存方式によらず保存する
+    results += attributes
+    if policy != "ignore":
+        results.append(task_result(policy, data, summary))
+    return messages, results
+
+
+def encode_message(app: Celery, name: str, args: tuple, serializer: str, compression: Optional[str]) -> Tuple[bytes, str, str, Optional[str]]:
+    """Producer.publishと同じ手順でメッセージ本文を作成し、Redisトランスポートと同じくbase64で符号化する"""
+    message = app.amqp.as_task_v2(str(uuid.uuid4()), f"tasks.queue_processor.{name}", args=args, kwargs={})
+    content_type, content_encoding, body = dumps(message.body, serializer=serializer)
+    if isinstance(body, str):
+        body = body.encode(content_encoding)
+    compressed = None
+    if compression:
+        body, compressed = compress(body, compression)
+    return base64.b64encode(body), content_type, content_encoding, compressed
+
+
+def decode_message(body: bytes, content_type: str, content_encoding: str, compressed: Optional[str]):
+    body = base64.b64decode(body)
+    if compressed:
+        body = decompress(body, compressed)
+    return loads(body, content_type, content_encoding, accept=prepare_accept_content(ACCEPT_CONTENT))
+
+
+def measure(case: tuple, mode: str, iterations: int) -> Dict:
+    name, task_serializer, result_serializer, compression, policy = case
+    app = Celery("serialization-bench", backend="redis://127.0.0.1:6379/0", set_as_current=False)
+    app.conf.update(task_serializer=task_serializer, result_serializer=result_serializer, accept_content=ACCEPT_CONTENT)
+    backend = app.backend
+    messages, results = task_payloads(mode, policy)
+    metas = [backend._get_result_meta(result, "SUCCESS", None, None) for result in results]
+
+    def run_once() -> Tuple[int, int]:
+        broker_bytes = 0
+        for task_name, args in messages:
+            encoded = encode_message(app, task_name, args, task_serializer, compression)
+            decode_message(*encoded)
+            broker_bytes += len(encoded[0])
+        backend_bytes = 0
+        for meta in metas:
+            payload = backend.encode(meta)
+            backend.decode(payload)
+            backend_bytes += len(payload)
+        return broker_bytes, backend_bytes
+
+    broker_bytes, backend_bytes = run_once()
+    started = time.process_time()
+    for _ in range(iterations):
+        run_once()
+    cpu = (time.process_time() - started) / iterations
+    return {
+        "case": name,
+        "task_serializer": task_serializer,
+        "result_serializer": result_serializer,
+        "compression": compression,
+        "result_policy": policy,
+        "broker_bytes": broker_bytes,
+        "backend_bytes": backend_bytes,
+        "cpu_microseconds": round(cpu * 1e6, 1),
+    }
+
+
+def print_summary(results: List[Dict]):
+    baseline = results[0]
+    print(f"\n{'case':<22} {'broker B':>9} {'backend B':>10} {'CPU us':>8}  vs {baseline['case']}")
+    for result in results:
+        ratios = []
+        for key in ("broker_bytes", "backend_bytes", "cpu_microseconds"):
+            if baseline[key]:
+                ratios.append(f"{result[key] / baseline[key]:.0%}")
+        print(f"{result['case']:<22} {result['broker_bytes']:>9} {result['backend_bytes']:>10} {result['cpu_microseconds']:>8.1f}  {' / '.join(ratios)}")
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    results = [measure(case, args.pipeline_mode, args.iterations) for case in CASES]
+    print(f"Pipeline mode: {args.pipeline_mode} (bytes and CPU per recipe task)")
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"pipeline_mode": args.pipeline_mode, "iterations": args.iterations, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+ベンチマーク用のWebSocket受信サーバー
+
+バックエンドの代わりにワーカーからのメッセージを受け取り、セッションごとに受信時刻・フレームのバイト数とともに記録する。
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pydantic import ValidationError
+from websockets.asyncio.server import serve
+
+from models.websocket_message import BINARY_SUBPROTOCOL, WebSocketMessage
+
+logger = logging.getLogger(__name__)
+
+# タスクの終了を表すメッセージ
+FINAL_TYPES = ("task_completed", "task_failed")
+
+
+class WebSocketSink:
+    """バックグラウンドスレッドで動くWebSocketサーバー
+
+    接続先のパスやクエリ文字列（session_id）は問わず、メッセージのsession_idで振り分ける。
+    wire_formatが"msgpack"の場合、ワーカーが提案したバイナリ形式のサブプロトコルを選択する。
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, wire_format: str = "json"):
+        self.host = host
+        self.port = port
+        self.wire_format = wire_format
+        self._lock = threading.Lock()
+        self._messages: Dict[str, List[dict]] = {}
+        self._finished: Dict[str, threading.Event] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}/api/v1/ws/recipe-gen/celery"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="websocket-sink", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(10):
+            raise RuntimeError("WebSocket sink did not start")
+
+    def stop(self):
+        if self._loop and self._stop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        if self._thread:
+            self._thread.join(5)
+
+    def expect(self, session_id: str):
+        """終了メッセージを待つセッションを登録"""
+        with self._lock:
+            self._messages.setdefault(session_id, [])
+            self._finished.setdefault(session_id, threading.Event())
+
+    def wait(self, session_ids: List[str], timeout: float) -> List[str]:
+        """全セッションの終了メッセージを待ち、期限までに終了しなかったセッションを返す"""
+        deadline = time.monotonic() + timeout
+        for session_id in session_ids:
+            self._finished[session_id].wait(max(deadline - time.monotonic(), 0))
+        return [session_id for session_id in session_ids if not self._finished[session_id].is_set()]
+
+    def messages(self, session_id: str) -> List[dict]:
+        with self._lock:
+            return list(self._messages.get(session_id, []))
+
+    def reset(self):
+        with self._lock:
+            self._messages = {}
+            self._finished = {}
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._serve())
+
+    async def _serve(self):
+        self._stop = asyncio.Event()
+        async with serve(self._handle, self.host, self.port, max_size=None, select_subprotocol=self._select_subprotocol) as server:
+            self.port = server.sockets[0].getsockname()[1]
+            self._ready.set()
+            await self._stop.wait()
+
+    def _select_subprotocol(self, connection, subprotocols) -> Optional[str]:
+        # 選択しない場合、ワーカーはJSONで送信する
+        if self.wire_format == "msgpack" and BINARY_SUBPROTOCOL in subprotocols:
+            return BINARY_SUBPROTOCOL
+        return None
+
+    async def _handle(self, connection):
+        async for raw in connection:
+            received_at = time.time()
+            try:
+                message = WebSocketMessage.decode(raw)
+            except (ValueError, ValidationError):
+                logger.warning("Sink received an undecodable message")
+                continue
+            self._record(message, received_at, len(raw.encode("utf-8")) if isinstance(raw, str) else len(raw))
+
+    def _record(self, message: WebSocketMessage, received_at: float, size: int):
+        with self._lock:
+            self._messages.setdefault(message.session_id, []).append({
+                "type": message.type,
+                "data": message.data or {},
+                "received_at": received_at,
+                # permessage-deflateで圧縮する前のフレームのバイト数
+                "size": size,
+            })
+            finished = self._finished.setdefault(message.session_id, threading.Event())
+        if message.type in FINAL_TYPES:
+            finished.set()
@@ -0,0 +1,305 @@
+"""
+ベンチマーク用のLLMスタブ
+
+genai.Client・ChatBedrock・BedrockEmbeddings のネットワーク呼び出しだけを、指定した時間だけ待って
+固定のレスポンスを返すスタブに置き換える。レート制限・サーキットブレーカー・ルーター・Chainの整形処理は
+本番と同じコードを通るため、LLMの待ち時間以外にワーカーで発生する処理時間を計測できる。
+
+待ち時間などは環境変数で指定する（ワーカーのサブプロセスにも引き継ぐため）。
+    BENCH_GEMINI_LATENCY / BENCH_BEDROCK_LATENCY / BENCH_EMBED_LATENCY: 1回の呼び出しの秒数
+    BENCH_LATENCY_JITTER: 待ち時間の揺らぎ（0.1で±10%）
+    BENCH_ERROR_RATE: 一時的なエラー（ThrottlingException）を返す割合
+    BENCH_LOW_RES_INCOMPLETE_RATE: lowの解像度の動画解析で工程が空のレシピを返す割合
+
+Geminiの動画入力のトークン数は解像度・フレームの頻度・解析範囲から見積もり、待ち時間の半分をトークン数に比例させる。
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Dict, Iterator, List
+
+import google.genai as genai
+from google.genai import types
+from langchain_aws.chat_models.bedrock import ChatBedrock
+from langchain_aws.chat_models.bedrock_converse import ChatBedrockConverse
+from langchain_aws.embeddings.bedrock import BedrockEmbeddings
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# スタブが返すレシピ（Geminiの抽出結果・Bedrockのリライト結果として使う）
+SAMPLE_RECIPE = {
+    "recipes": {"recipe_name": "鶏むね肉の照り焼き"},
+    "processes": [
+        {"process_number": 1, "process": "鶏むね肉を一口大に切り、片栗粉をまぶす"},
+        {"process_number": 2, "process": "フライパンに油を熱し、鶏肉を両面焼く"},
+        {"process_number": 3, "process": "醤油・みりん・砂糖を加えて煮絡める"},
+    ],
+    "ingredients": [
+        {"ingredient_name": "鶏むね肉", "amount": "150g"},
+        {"ingredient_name": "片栗粉", "amount": "大さじ1"},
+        {"ingredient_name": "醤油", "amount": "大さじ1"},
+        {"ingredient_name": "みりん", "amount": "大さじ1"},
+        {"ingredient_name": "砂糖", "amount": "小さじ1"},
+    ],
+}
+
+# プロンプトの特徴的な文言から、どのChainの呼び出しかを判定する（先に一致したものを使う）
+BEDROCK_RESPONSES = [
+    ("まとめて生成", {"genre": "和食", "recipe_name": "ごはんがすすむ照り焼きチキン", "keywords": ["鶏むね肉", "照り焼き", "甘辛"]}),
+    ("ジャンルを判定", {"genre": "和食"}),
+    ("キーワード", {"keywords": ["鶏むね肉", "照り焼き", "甘辛"]}),
+    ("料理の名前を生成", {"recipes": {"recipe_name": "ごはんがすすむ照り焼きチキン"}}),
+]
+
+EMBEDDING_DIMENSIONS = 1536
+# 動画入力のトークン数の見積もり（60秒のShorts。1フレームあたりのトークン数はlowで66、それ以外で258）
+VIDEO_SECONDS = 60
+FRAME_TOKENS = 258
+LOW_RES_FRAME_TOKENS = 66
+AUDIO_TOKENS_PER_SECOND = 32
+DEFAULT_VIDEO_TOKENS = VIDEO_SECONDS * (FRAME_TOKENS + AUDIO_TOKENS_PER_SECOND)
+STREAM_CHUNKS = 10
+
+
+class StubThrottlingError(Exception):
+    """スタブが返す一時的なエラー（classify_errorでスロットリングに分類される）"""
+
+    def __init__(self):
+        super().__init__("ThrottlingException: stubbed rate limit")
+
+
+def latency(kind: str) -> float:
+    """呼び出し1回の待ち時間（揺らぎを含む）"""
+    base = float(os.getenv(f"BENCH_{kind.upper()}_LATENCY", "0"))
+    jitter = float(os.getenv("BENCH_LATENCY_JITTER", "0"))
+    return max(base * random.uniform(1 - jitter, 1 + jitter), 0.0)
+
+
+def _call(kind: str):
+    """待ち時間だけ待機し、指定した割合で一時的なエラーを送出"""
+    time.sleep(latency(kind))
+    if random.random() < float(os.getenv("BENCH_ERROR_RATE", "0")):
+        raise StubThrottlingError()
+
+
+def _split(text: str, chunks: int = STREAM_CHUNKS) -> List[str]:
+    size = max(len(text) // chunks, 1)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _bedrock_payload(messages) -> Dict:
+    prompt = "".join(str(message.content) for message in messages)
+    for marker, payload in BEDROCK_RESPONSES:
+        if marker in prompt:
+            return payload
+    # リライトはレシピをそのまま返す
+    return SAMPLE_RECIPE
+
+
+def _tool_name(tools) -> str:
+    """bind_toolsで渡されたツール定義（Converse形式・OpenAI形式）からツール名を取得"""
+    tool = tools[0]
+    if "toolSpec" in tool:
+        return tool["toolSpec"]["name"]
+    if "function" in tool:
+        return tool["function"]["name"]
+    return tool.get("name", "")
+
+
+def _bedrock_message(messages, kwargs, chunk: bool = False):
+    payload = _bedrock_payload(messages)
+    content = json.dumps(payload, ensure_ascii=False)
+    usage = {
+        "input_tokens": len(_messages_text(messages)),
+        "output_tokens": len(content),
+        "total_tokens": len(_messages_text(messages)) + len(content),
+        "input_token_details": {"cache_read": _cached_prefix_tokens(messages)},
+    }
+    message_class = AIMessageChunk if chunk else AIMessage
+    if kwargs.get("tools"):
+        # 構造化出力（tool-use）ではツール呼び出しとして返す
+        tool_call = {"name": _tool_name(kwargs["tools"]), "args": payload, "id": uuid.uuid4().hex, "type": "tool_call"}
+        return message_class(content="", tool_calls=[tool_call], usage_metadata=usage)
+    return message_class(content=content, usage_metadata=usage)
+
+
+def _messages_text(messages) -> str:
+    return "".join(str(message.content) for message in messages)
+
+
+def _cached_prefix_tokens(messages) -> int:
+    """キャッシュポイントより前のテキストを、キャッシュから読み込んだ入力として数える（Bedrockは初回から読み込めたものとする）"""
+    cached = 0
+    for message in messages:
+        blocks = message.content if isinstance(message.content, list) else [message.content]
+        for index, block in enumerate(blocks):
+            if isinstance(block, dict) and "cachePoint" in block:
+                cached += sum(len(str(previous.get("text", previous) if isinstance(previous, dict) else previous)) for previous in blocks[:index])
+    return cached
+
+
+def stub_chat_generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+    _call("bedrock")
+    return ChatResult(generations=[ChatGeneration(message=_bedrock_message(messages, kwargs))])
+
+
+def stub_chat_stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+    message = _bedrock_message(messages, kwargs)
+    if message.tool_calls:
+        _call("bedrock")
+        yield ChatGenerationChunk(message=_bedrock_message(messages, kwargs, chunk=True))
+        return
+    pieces = _split(message.content)
+    for index, piece in enumerate(pieces):
+        time.sleep(latency("bedrock") / len(pieces))
+        # 使用トークン数は最後のチャンクにのみ含める
+        usage = message.usage_metadata if index == len(pieces) - 1 else None
+        yield ChatGenerationChunk(message=AIMessageChunk(content=piece, usage_metadata=usage))
+
+
+def stub_bedrock_generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+    """ChatBedrock._generateのスタブ（Converse APIを使う場合は本物と同じく_as_converseに委譲する）"""
+    if self.beta_use_converse_api:
+        return self._as_converse._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+    return stub_chat_generate(self, messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+def stub_bedrock_stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+    """ChatBedrock._streamのスタブ（Converse APIを使う場合は本物と同じく_as_converseに委譲する）"""
+    if self.beta_use_converse_api:
+        yield from self._as_converse._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        return
+    yield from stub_chat_stream(self, messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+def _offset_seconds(value) -> float:
+    return float(value.rstrip("s")) if value else 0.0
+
+
+def _video_tokens(contents, config) -> int:
+    """VideoMetadataとmedia_resolutionから動画入力のトークン数を見積もる"""
+    metadata = getattr(contents.parts[0], "video_metadata", None) if contents is not None else None
+    fps = (metadata.fps if metadata else None) or 1
+    start = _offset_seconds(metadata.start_offset) if metadata else 0.0
+    end = _offset_seconds(metadata.end_offset) if metadata else 0.0
+    duration = max(min(end or VIDEO_SECONDS, VIDEO_SECONDS) - start, 1)
+    low = getattr(config, "media_resolution", None) == types.MediaResolution.MEDIA_RESOLUTION_LOW
+    return int(duration * (fps * (LOW_RES_FRAME_TOKENS if low else FRAME_TOKENS) + AUDIO_TOKENS_PER_SECOND))
+
+
+def _gemini_latency(contents, config) -> float:
+    return latency("gemini") * (0.5 + 0.5 * _video_tokens(contents, config) / DEFAULT_VIDEO_TOKENS)
+
+
+def _gemini_text(config) -> str:
+    """抽出結果のJSON（lowの解像度ではBENCH_LOW_RES_INCOMPLETE_RATEの割合で工程を空にする）"""
+    recipe = SAMPLE_RECIPE
+    low = getattr(config, "media_resolution", None) == types.MediaResolution.MEDIA_RESOLUTION_LOW
+    if low and random.random() < float(os.getenv("BENCH_LOW_RES_INCOMPLETE_RATE", "0")):
+        recipe = {**SAMPLE_RECIPE, "processes": []}
+    return json.dumps(recipe, ensure_ascii=False)
+
+
+class StubGeminiModels:
+    """genai.Client.models の generate_content / generate_content_stream のスタブ"""
+
+    def generate_content(self, model: str, contents, config=None):
+        time.sleep(_gemini_latency(contents, config))
+        if random.random() < float(os.getenv("BENCH_ERROR_RATE", "0")):
+            raise StubThrottlingError()
+        return self._response(_gemini_text(config), final=True, contents=contents, config=config)
+
+    def generate_content_stream(self, model: str, contents, config=None):
+        pieces = _split(_gemini_text(config))
+        wait = _gemini_latency(contents, config)
+        for index, piece in enumerate(pieces):
+            time.sleep(wait / len(pieces))
+            yield self._response(piece, final=index == len(pieces) - 1, contents=contents, config=config)
+
+    @staticmethod
+    def _response(text: str, final: bool, contents=None, config=None):
+        # configを読み込んだ後に参照するため、ここで読み込む
+        from llm.gemini import RECIPE_EXTRACTION_PROMPT
+
+        # キャッシュ済みコンテンツはシステム指示の文字数分とする
+        cached = len(RECIPE_EXTRACTION_PROMPT) if getattr(config, "cached_content", None) else 0
+        usage = SimpleNamespace(
+            prompt_token_count=_video_tokens(contents, config) + len(RECIPE_EXTRACTION_PROMPT),
+            candidates_token_count=len(text),
+            thoughts_token_count=0,
+            cached_content_token_count=cached,
+        )
+        return SimpleNamespace(text=text, usage_metadata=usage if final else None)
+
+
+class StubAsyncGeminiModels:
+    """genai.Client.aio.models のスタブ（待ち時間はイベントループをブロックしない）"""
+
+    async def generate_content(self, model: str, contents, config=None):
+        await asyncio.sleep(_gemini_latency(contents, config))
+        if random.random() < float(os.getenv("BENCH_ERROR_RATE", "0")):
+            raise StubThrottlingError()
+        return StubGeminiModels._response(_gemini_text(config), final=True, contents=contents, config=config)
+
+    async def generate_content_stream(self, model: str, contents, config=None):
+        async def chunks():
+            pieces = _split(_gemini_text(config))
+            wait = _gemini_latency(contents, config)
+            for index, piece in enumerate(pieces):
+                await asyncio.sleep(wait / len(pieces))
+                yield StubGeminiModels._response(piece, final=index == len(pieces) - 1, contents=contents, config=config)
+        return chunks()
+
+
+class StubGeminiCaches:
+    """genai.Client.caches.create のスタブ（GEMINI_CONTEXT_CACHE_ENABLED用）"""
+
+    def create(self, model: str, config=None):
+        return SimpleNamespace(name=f"cachedContents/stub-{uuid.uuid4().hex[:12]}")
+
+
+class StubAsyncGeminiCaches:
+    async def create(self, model: str, config=None):
+        return StubGeminiCaches().create(model, config)
+
+
+class StubGenaiClient:
+    def __init__(self, *args, **kwargs):
+        self.models = StubGeminiModels()
+        self.caches = StubGeminiCaches()
+        self.aio = SimpleNamespace(models=StubAsyncGeminiModels(), caches=StubAsyncGeminiCaches())
+
+
+def stub_embed_query(self, text: str) -> List[float]:
+    _call("embed")
+    rng = random.Random(text)
+    return [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+
+
+def stub_embed_documents(self, texts: List[str]) -> List[List[float]]:
+    return [stub_embed_query(self, text) for text in texts]
+
+
+def install_stubs():
+    """LLMクライアントのネットワーク呼び出しをスタブに置き換える
+
+    ワーカーでは子プロセスの起動前（モジュールの読み込み時）に呼び出し、fork後もスタブを引き継がせる。
+    """
+    # 認証情報がなくてもクライアントを生成できるよう、ダミーの値を設定する
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+
+    genai.Client = StubGenaiClient
+    # RateLimitedChatBedrock・RateLimitedChatBedrockConverseはsuper()経由で親クラスを呼ぶため、親クラスを置き換える
+    # Converse APIを使う場合の呼び出し・構造化出力はChatBedrockConverseに委譲される
+    ChatBedrock._generate = stub_bedrock_generate
+    ChatBedrock._stream = stub_bedrock_stream
+    ChatBedrockConverse._generate = stub_chat_generate
+    ChatBedrockConverse._stream = stub_chat_stream
+    BedrockEmbeddings.embed_query = stub_embed_query
+    BedrockEmbeddings.embed_documents = stub_embed_documents
@@ -0,0 +1,13 @@
+"""
+ベンチマーク用のCeleryアプリ
+
+LLMクライアントをスタブに置き換えてから本番と同じCeleryアプリを読み込む。
+run.py がワーカーを起動する際に `celery -A benchmarks.worker worker` として指定する。
+"""
+from benchmarks.stubs import install_stubs
+
+install_stubs()
+
+from celery_app import app
+
+__all__ = ["app"]
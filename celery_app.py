@@ -1,6 +1,11 @@
 from celery import Celery
 
 from config import settings
+from utils.broker import BROKER_TRANSPORT_OPTIONS
+from utils.task_results import register_serializers
+
+# result_serializerにmsgpack-zlibを指定できるよう、アプリの設定より先に登録する
+register_serializers()
 
 # Celeryアプリケーションの初期化
 app = Celery(
@@ -15,11 +20,25 @@ app.conf.update(
     task_serializer=settings.CELERY_TASK_SERIALIZER,
     accept_content=settings.CELERY_ACCEPT_CONTENT,
     result_serializer=settings.CELERY_RESULT_SERIALIZER,
+    task_compression=settings.CELERY_TASK_COMPRESSION,
     timezone=settings.CELERY_TIMEZONE,
     enable_utc=settings.CELERY_ENABLE_UTC,
-    result_expires=settings.CELERY_RESULT_EXPIRES,      task_routes={
+    result_expires=settings.CELERY_RESULT_EXPIRES,
+    task_routes={
+        # canvasモードのステップはGemini用・Bedrock用のキューに振り分ける
+        "tasks.queue_processor.extract_recipe_step": {"queue": "recipe_gemini_queue"},
+        "tasks.queue_processor.rewrite_recipe_step": {"queue": "recipe_bedrock_queue"},
+        "tasks.queue_processor.generate_attributes_step": {"queue": "recipe_bedrock_queue"},
+        "tasks.queue_processor.embed_and_publish_step": {"queue": "recipe_bedrock_queue"},
+        "tasks.queue_processor.reembed_recipes_task": {"queue": "recipe_bedrock_queue"},
         "tasks.queue_processor.*": {"queue": "recipe_gen_queue"},
     },
+    # Redisブローカーで優先度ごとのリストを作り、優先度の高いメッセージから取り出す。
+    # 優先度なしのメッセージはnormalの順番で取り出す（送信側も同じbroker_transport_optionsを使う）
+    broker_transport="utils.broker:PriorityRedisTransport",
+    broker_transport_options=BROKER_TRANSPORT_OPTIONS,
+    task_default_priority=settings.CELERY_DEFAULT_PRIORITY,
+    # 先読みすると優先度の低いメッセージを抱え込むため1件ずつ取得する
     worker_prefetch_multiplier=1,
     task_acks_late=True,
     # Beat スケジュール設定 - FastAPIからのキュー確認用
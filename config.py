@@ -1,3 +1,4 @@
+import json
 import os
 from typing import Optional
 
@@ -6,6 +7,28 @@ from pydantic_settings import BaseSettings
 
 load_dotenv()
 
+# モデルごとの呼び出し上限（全ワーカーPodで共有）。rpm: 毎分リクエスト数 / tpm: 毎分トークン数 /
+# concurrency: 同時実行数 / estimated_tokens: 入力テキスト以外に見込むトークン数（動画・出力分）。0は無制限
+DEFAULT_LLM_RATE_LIMITS = {
+    "models/gemini-2.0-flash": {"rpm": 2000, "tpm": 4000000, "concurrency": 16, "estimated_tokens": 20000},
+    "models/gemini-2.5-flash": {"rpm": 1000, "tpm": 1000000, "concurrency": 16, "estimated_tokens": 20000},
+    "apac.amazon.nova-pro-v1:0": {"rpm": 200, "tpm": 800000, "concurrency": 16, "estimated_tokens": 2000},
+    "apac.amazon.nova-lite-v1:0": {"rpm": 200, "tpm": 800000, "concurrency": 16, "estimated_tokens": 2000},
+    "amazon.titan-embed-text-v1": {"rpm": 2000, "tpm": 300000, "concurrency": 16, "estimated_tokens": 0},
+    "amazon.titan-embed-text-v2:0": {"rpm": 2000, "tpm": 300000, "concurrency": 16, "estimated_tokens": 0},
+}
+
+# モデルごとの定価（USD / 100万トークン）。メトリクスの料金見積もりに使う
+# cached_input: プロンプトキャッシュから読み込んだ入力トークンの単価（未指定の場合はinputと同じ）
+DEFAULT_LLM_TOKEN_PRICES = {
+    "models/gemini-2.0-flash": {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+    "models/gemini-2.5-flash": {"input": 0.30, "cached_input": 0.075, "output": 2.50},
+    "apac.amazon.nova-pro-v1:0": {"input": 0.80, "cached_input": 0.20, "output": 3.20},
+    "apac.amazon.nova-lite-v1:0": {"input": 0.06, "cached_input": 0.015, "output": 0.24},
+    "amazon.titan-embed-text-v1": {"input": 0.10, "output": 0.0},
+    "amazon.titan-embed-text-v2:0": {"input": 0.02, "output": 0.0},
+}
+
 class Settings(BaseSettings):
     # Redis設定
     REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
@@ -14,14 +37,54 @@ class Settings(BaseSettings):
     
     # WebSocket設定
     WEBSOCKET_URL: str = os.getenv("WEBSOCKET_URL", "ws://localhost:8000/api/v1/ws/recipe-gen/celery")
+    # ワーカープロセスで接続を維持し、送信をキューイングする
+    WEBSOCKET_PERSISTENT: bool = os.getenv("WEBSOCKET_PERSISTENT", "true").lower() == "true"
+    # 全セッションのメッセージをWEBSOCKET_URLへの1接続にまとめる（バックエンドがsession_idで振り分ける場合のみ有効にする）
+    WEBSOCKET_MULTIPLEX: bool = os.getenv("WEBSOCKET_MULTIPLEX", "false").lower() == "true"
+    WEBSOCKET_MAX_QUEUE_SIZE: int = int(os.getenv("WEBSOCKET_MAX_QUEUE_SIZE", "1000"))
+    WEBSOCKET_HEARTBEAT_INTERVAL: float = float(os.getenv("WEBSOCKET_HEARTBEAT_INTERVAL", "20"))
+    WEBSOCKET_IDLE_TIMEOUT: float = float(os.getenv("WEBSOCKET_IDLE_TIMEOUT", "60"))
+    WEBSOCKET_MAX_BACKOFF: float = float(os.getenv("WEBSOCKET_MAX_BACKOFF", "30"))
+    WEBSOCKET_MAX_RETRIES: int = int(os.getenv("WEBSOCKET_MAX_RETRIES", "5"))
+    # trueの場合は送信完了を待たずに戻る（falseの場合はWEBSOCKET_SEND_TIMEOUTまで配信を待つ）
+    WEBSOCKET_FIRE_AND_FORGET: bool = os.getenv("WEBSOCKET_FIRE_AND_FORGET", "true").lower() == "true"
+    WEBSOCKET_SEND_TIMEOUT: float = float(os.getenv("WEBSOCKET_SEND_TIMEOUT", "10"))
+    # タスク終了時に未送信メッセージの配信を待つ秒数
+    WEBSOCKET_FLUSH_TIMEOUT: float = float(os.getenv("WEBSOCKET_FLUSH_TIMEOUT", "10"))
+    # 接続時にmsgpackのバイナリ形式（サブプロトコル）を提案する。バックエンドが選択しなかった場合はJSONで送信する
+    WEBSOCKET_BINARY_ENABLED: bool = os.getenv("WEBSOCKET_BINARY_ENABLED", "true").lower() == "true"
+    # バイナリ形式で送信するembeddingの精度 (float32 / float16)
+    WEBSOCKET_EMBEDDING_DTYPE: str = os.getenv("WEBSOCKET_EMBEDDING_DTYPE", "float32")
+    # permessage-deflateによる圧縮を提案する
+    WEBSOCKET_COMPRESSION: bool = os.getenv("WEBSOCKET_COMPRESSION", "true").lower() == "true"
     
     # Celery設定
-    CELERY_TASK_SERIALIZER: str = "json"
-    CELERY_RESULT_SERIALIZER: str = "json"
-    CELERY_ACCEPT_CONTENT: list = ["json"]
+    # タスクメッセージ・結果のシリアライザ (json / msgpack / msgpack-zlib)
+    # kombu標準のmsgpackはcanvasモードのメッセージを正しく送信できないため、canvasモードではmsgpack-zlibを使う
+    CELERY_TASK_SERIALIZER: str = os.getenv("CELERY_TASK_SERIALIZER", "json")
+    CELERY_RESULT_SERIALIZER: str = os.getenv("CELERY_RESULT_SERIALIZER", "json")
+    # シリアライザを切り替えている間も旧形式のメッセージ・結果を読み込めるよう、すべての形式を受け付ける
+    CELERY_ACCEPT_CONTENT: list = ["json", "msgpack", "msgpack-zlib"]
+    # タスクメッセージの圧縮方式（zlibなど。空の場合は圧縮しない。msgpack-zlibは圧縮済みのため不要）
+    CELERY_TASK_COMPRESSION: Optional[str] = os.getenv("CELERY_TASK_COMPRESSION") or None
     CELERY_TIMEZONE: str = "Asia/Tokyo"
     CELERY_ENABLE_UTC: bool = True
-    CELERY_RESULT_EXPIRES: int = 3600
+    CELERY_RESULT_EXPIRES: int = int(os.getenv("CELERY_RESULT_EXPIRES", "3600"))
+    # レシピ生成タスク（canvasモードのステップを含む）の結果の保存方式 (full / summary / ignore)
+    # 既定では戻り値をそのまま保存する。生成結果をWebSocketでのみ受け取る場合はsummaryで状態と参照用のレコードのみ保存する
+    RECIPE_TASK_RESULT_POLICY: str = os.getenv("RECIPE_TASK_RESULT_POLICY", "full")
+    # メッセージ優先度（Redisブローカーでは1が最優先、metadata["priority"]がない場合の既定値）
+    CELERY_DEFAULT_PRIORITY: int = int(os.getenv("CELERY_DEFAULT_PRIORITY", "5"))
+
+    # FastAPIからのタスク検出方式 (scan / index / stream)
+    TASK_DISCOVERY_MODE: str = os.getenv("TASK_DISCOVERY_MODE", "scan")
+    TASK_SCAN_BATCH_SIZE: int = int(os.getenv("TASK_SCAN_BATCH_SIZE", "500"))
+    # 1回のスキャンで取得するタスクの上限
+    TASK_SCAN_LIMIT: int = int(os.getenv("TASK_SCAN_LIMIT", "1000"))
+    # streamモード: 確認応答されないまま指定のミリ秒を過ぎたエントリを取り直す（スキャンが途中で落ちた場合など）
+    TASK_STREAM_CLAIM_IDLE_MS: int = int(os.getenv("TASK_STREAM_CLAIM_IDLE_MS", "600000"))
+    # streamモード: Streamのおおよその最大件数（XTRIM MAXLEN ~）
+    TASK_STREAM_MAXLEN: int = int(os.getenv("TASK_STREAM_MAXLEN", "10000"))
 
     # Beat schedule設定（Celery beatのスケジュールファイルのパス）
     BEAT_SCHEDULE_FILENAME: str = "/app/data/celerybeat-schedule"
@@ -33,4 +96,123 @@ class Settings(BaseSettings):
     AWS_SECRET_ACCESS_KEY: Optional[str] = os.getenv("AWS_SECRET_ACCESS_KEY")
     AWS_REGION_NAME: Optional[str] = os.getenv("AWS_REGION_NAME", "ap-northeast-1")
 
+    # レシピ生成結果キャッシュ（動画IDをキーに再利用）
+    RECIPE_CACHE_ENABLED: bool = os.getenv("RECIPE_CACHE_ENABLED", "true").lower() == "true"
+    RECIPE_CACHE_TTL: int = int(os.getenv("RECIPE_CACHE_TTL", "604800"))
+    RECIPE_CACHE_MAX_ENTRIES: int = int(os.getenv("RECIPE_CACHE_MAX_ENTRIES", "10000"))
+    # プロンプトを変更した場合などにキャッシュを無効化するためのバージョン
+    RECIPE_CACHE_VERSION: str = os.getenv("RECIPE_CACHE_VERSION", "1")
+
+    # 同じ動画の同時リクエストをまとめて1回だけ生成する設定
+    SINGLE_FLIGHT_ENABLED: bool = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+    # リーダーが異常終了した場合に他のタスクが引き継ぐまでの秒数
+    SINGLE_FLIGHT_LOCK_TTL: int = int(os.getenv("SINGLE_FLIGHT_LOCK_TTL", "600"))
+    SINGLE_FLIGHT_WAIT_TIMEOUT: float = float(os.getenv("SINGLE_FLIGHT_WAIT_TIMEOUT", "900"))
+    SINGLE_FLIGHT_RESULT_TTL: int = int(os.getenv("SINGLE_FLIGHT_RESULT_TTL", "60"))
+
+    # パイプラインの実行方式 (monolithic: 1タスクで全ステップを実行 / canvas: ステップごとのタスクを専用キューで実行
+    # / async: ワーカープロセスごとの1つのイベントループで複数タスクのパイプラインを並行実行)
+    PIPELINE_MODE: str = os.getenv("PIPELINE_MODE", "monolithic")
+    # asyncモードで1プロセスが同時に実行するパイプライン数（ワーカーは -P threads -c に同じ値を指定する）
+    ASYNC_PIPELINE_MAX_IN_FLIGHT: int = int(os.getenv("ASYNC_PIPELINE_MAX_IN_FLIGHT", "32"))
+    # asyncモードでBedrock（boto3は同期APIのみ）の呼び出しを実行するスレッド数
+    ASYNC_PIPELINE_EXECUTOR_WORKERS: int = int(os.getenv("ASYNC_PIPELINE_EXECUTOR_WORKERS", "32"))
+
+    # ステップごとの結果を保存し、リトライ時に完了済みステップから再開する
+    CHECKPOINT_ENABLED: bool = os.getenv("CHECKPOINT_ENABLED", "true").lower() == "true"
+    CHECKPOINT_TTL: int = int(os.getenv("CHECKPOINT_TTL", "86400"))
+
+    # ワーカープロセス内でLLMサービスを再利用する秒数（0以下で無期限）
+    SERVICE_REGISTRY_TTL: float = float(os.getenv("SERVICE_REGISTRY_TTL", "3600"))
+
+    # Gemini動画解析とリライトをストリーミングで生成し、途中経過を通知する（type 7: 動画解析・8: リライト、streaming: true）
+    LLM_STREAMING_ENABLED: bool = os.getenv("LLM_STREAMING_ENABLED", "false").lower() == "true"
+    # ストリーミング中の進捗通知の最小間隔（秒）
+    LLM_STREAMING_INTERVAL: float = float(os.getenv("LLM_STREAMING_INTERVAL", "0.25"))
+
+    # GeminiのresponseSchema・Bedrockのtool-useによる構造化出力を使う（ストリーミング中のリライトはテキスト出力）
+    LLM_STRUCTURED_OUTPUT: bool = os.getenv("LLM_STRUCTURED_OUTPUT", "false").lower() == "true"
+
+    # Chainの指示・スキーマ（システムプロンプト）の後にBedrockのキャッシュポイントを置く（Converse APIで呼び出す）
+    # プレフィックスがモデルの最小トークン数に満たない場合はキャッシュされない
+    BEDROCK_PROMPT_CACHE_ENABLED: bool = os.getenv("BEDROCK_PROMPT_CACHE_ENABLED", "true").lower() == "true"
+    # 動画解析のシステム指示をGeminiのキャッシュ済みコンテンツとして作成し、全ワーカーで共有する
+    # （保持時間に応じた料金が発生する。無効の場合もシステム指示を先頭に置くため暗黙のキャッシュは効く）
+    GEMINI_CONTEXT_CACHE_ENABLED: bool = os.getenv("GEMINI_CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+    GEMINI_CONTEXT_CACHE_TTL: int = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+
+    # 動画解析の設定（タスクのmetadata["video"]でリクエストごとに上書きできる）
+    # 動画の解像度 (low / medium / high、空の場合はモデルの既定値)。lowは1フレームあたりのトークン数が約1/4になる
+    GEMINI_MEDIA_RESOLUTION: str = os.getenv("GEMINI_MEDIA_RESOLUTION", "")
+    # 動画から切り出すフレームの頻度（0の場合はモデルの既定値の1fps）
+    GEMINI_VIDEO_FPS: float = float(os.getenv("GEMINI_VIDEO_FPS", "0"))
+    # 解析する範囲の開始・終了位置（秒、0の場合は動画の先頭・末尾）
+    GEMINI_VIDEO_START_OFFSET: float = float(os.getenv("GEMINI_VIDEO_START_OFFSET", "0"))
+    GEMINI_VIDEO_END_OFFSET: float = float(os.getenv("GEMINI_VIDEO_END_OFFSET", "0"))
+    # lowの解像度で抽出し、工程・材料が空の場合のみGEMINI_MEDIA_RESOLUTIONの解像度で抽出し直す
+    GEMINI_ADAPTIVE_RESOLUTION: bool = os.getenv("GEMINI_ADAPTIVE_RESOLUTION", "false").lower() == "true"
+
+    # ジャンル・レシピ名・キーワードの生成方式 (merged: 1回の呼び出しでまとめて生成 / split: 項目ごとに生成)
+    BEDROCK_ATTRIBUTE_MODE: str = os.getenv("BEDROCK_ATTRIBUTE_MODE", "merged")
+    # ジャンル・レシピ名・キーワード生成を並列実行するスレッド数
+    BEDROCK_PARALLEL_CHAINS: int = int(os.getenv("BEDROCK_PARALLEL_CHAINS", "3"))
+
+    # embeddingのモデル（変更した場合はreembed_recipes_taskでキャッシュ済みのレシピを再embeddingする）
+    EMBEDDING_MODEL_ID: str = os.getenv("EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v1")
+    # テキストのハッシュをキーにembeddingをRedisにキャッシュする（float32のバイナリで保存）
+    EMBEDDING_CACHE_ENABLED: bool = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    EMBEDDING_CACHE_TTL: int = int(os.getenv("EMBEDDING_CACHE_TTL", "2592000"))
+    # 一括embeddingで1回のembed_documentsに渡すテキスト数と、並列に実行するバッチ数
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+    EMBEDDING_CONCURRENCY: int = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+    # reembed_recipes_taskが1タスクで処理するレシピ数
+    REEMBED_CHUNK_SIZE: int = int(os.getenv("REEMBED_CHUNK_SIZE", "200"))
+
+    # Redisで全ワーカー共通のレート制限・同時実行数制限を行う（上限に達した呼び出しは待機させる）
+    RATE_LIMIT_ENABLED: bool = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    # モデルごとの上限（JSONで指定したモデルはDEFAULT_LLM_RATE_LIMITSの値を置き換える）
+    LLM_RATE_LIMITS: dict = json.loads(os.getenv("LLM_RATE_LIMITS", "{}"))
+    # 枠が空くまで待つ最大秒数（超えた場合はエラー）
+    RATE_LIMIT_MAX_WAIT: float = float(os.getenv("RATE_LIMIT_MAX_WAIT", "300"))
+    # 同時実行枠の保持期限（ワーカーが異常終了した場合に枠を解放するまでの秒数）
+    RATE_LIMIT_LEASE_TTL: int = int(os.getenv("RATE_LIMIT_LEASE_TTL", "600"))
+
+    # プロバイダーごとのサーキットブレーカー（window秒以内に一時的な障害が閾値に達したらreset_timeout秒間遮断）
+    CIRCUIT_BREAKER_ENABLED: bool = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+    CIRCUIT_BREAKER_WINDOW: int = int(os.getenv("CIRCUIT_BREAKER_WINDOW", "60"))
+    CIRCUIT_BREAKER_RESET_TIMEOUT: float = float(os.getenv("CIRCUIT_BREAKER_RESET_TIMEOUT", "30"))
+
+    # 一時的なエラー・スロットリング時のタスク再試行（指数バックオフ + ジッター）
+    TASK_MAX_RETRIES: int = int(os.getenv("TASK_MAX_RETRIES", "3"))
+    TASK_RETRY_BACKOFF: float = float(os.getenv("TASK_RETRY_BACKOFF", "2"))
+    TASK_RETRY_BACKOFF_MAX: float = float(os.getenv("TASK_RETRY_BACKOFF_MAX", "300"))
+
+    # ステップごとの候補モデル（カンマ区切り、先頭ほど優先）。複数指定した場合は直近のp95レイテンシとエラー率で振り分ける
+    # 既定は従来のモデルのみ。速いモデルへ振り分けると出力の品質・料金が変わるため、候補の追加は明示的に行う
+    # 動画解析はYouTube URLを扱えるGeminiのみ、テキスト処理はBedrockのモデルを指定する
+    ROUTER_EXTRACT_MODELS: str = os.getenv("ROUTER_EXTRACT_MODELS", "models/gemini-2.0-flash")
+    ROUTER_TEXT_MODELS: str = os.getenv("ROUTER_TEXT_MODELS", "apac.amazon.nova-pro-v1:0")
+    # レイテンシ・エラー率を集計する直近の呼び出し数
+    ROUTER_STATS_WINDOW: int = int(os.getenv("ROUTER_STATS_WINDOW", "100"))
+    # この件数以上の結果があるモデルのみエラー率で不健全と判定する
+    ROUTER_MIN_SAMPLES: int = int(os.getenv("ROUTER_MIN_SAMPLES", "10"))
+    ROUTER_MAX_ERROR_RATE: float = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+    # テキスト処理で応答がこの秒数を超えたら次の候補にも同時に投げる（0で無効、重複した呼び出しの料金が発生する）
+    ROUTER_HEDGE_AFTER: float = float(os.getenv("ROUTER_HEDGE_AFTER", "0"))
+
+    # Prometheusメトリクス（ワーカーのメインプロセスでMETRICS_PORTに公開）
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    METRICS_PORT: int = int(os.getenv("METRICS_PORT", "9808"))
+    # prefork の子プロセスが値を書き出すディレクトリ
+    METRICS_MULTIPROC_DIR: str = os.getenv("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+    # モデルごとの定価（JSONで指定したモデルはDEFAULT_LLM_TOKEN_PRICESの値を置き換える）
+    LLM_TOKEN_PRICES: dict = json.loads(os.getenv("LLM_TOKEN_PRICES", "{}"))
+
+    # OpenTelemetryトレースの出力先 (none / otlp: ローカルのOTLPコレクター / file: JSON Lines / console)
+    TRACING_EXPORTER: str = os.getenv("TRACING_EXPORTER", "none")
+    TRACING_OTLP_ENDPOINT: str = os.getenv("TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+    TRACING_FILE_PATH: str = os.getenv("TRACING_FILE_PATH", "/tmp/recipe-traces.jsonl")
+    TRACING_SERVICE_NAME: str = os.getenv("TRACING_SERVICE_NAME", "bae-recipe-worker")
+
 settings = Settings()
@@ -1,5 +1,11 @@
+import re
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, Dict
+
+from langchain_core.output_parsers import StrOutputParser
+from pydantic import ValidationError
+
+from .errors import StructuredOutputError
 
 
 class BaseInput:
@@ -34,4 +40,33 @@ class BaseChain(ABC):
         Returns:
             Formatted prompt string
         """
-        pass
\ No newline at end of file
+        pass
+
+    @staticmethod
+    def replaced2json(output: str) -> str:
+        """LLMのテキスト出力からコードフェンスや余分な空白行・末尾カンマを取り除く"""
+        replaced_output = output.replace('```json', '').replace('```', '')
+        # 正規表現を使って空白行（改行だけや空白のみの行）を削除
+        replaced_output = re.sub(r'^\s*\n', '', replaced_output, flags=re.MULTILINE)
+        # 正規表現を使って最後のカンマを削除
+        replaced_output = re.sub(r',\s*$', '', replaced_output)
+        # replaced_output = json.loads(replaced_output) # これを加えるとdict型になってしまう
+        return replaced_output
+
+    def invoke_structured(self, formatted_input: Dict) -> Dict:
+        """構造化出力のChain（include_raw=True）を実行し、output_modelの内容をdictで返す
+
+        モデルがツールを呼び出さなかった場合は、テキストの応答をJSONとして解釈する。
+        それもできない場合は再試行の対象となるStructuredOutputErrorを送出する。
+        """
+        result = self.structured_chain.invoke(formatted_input)
+        if result["parsed"] is not None:
+            return result["parsed"].model_dump()
+
+        text = StrOutputParser().invoke(result["raw"])
+        try:
+            return self.output_model.model_validate_json(self.replaced2json(text)).model_dump()
+        except ValidationError as e:
+            raise StructuredOutputError(
+                f"{type(self).__name__}: structured output was not returned ({result['parsing_error'] or 'no tool call'})"
+            ) from e
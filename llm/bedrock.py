@@ -1,26 +1,147 @@
+import contextvars
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
 from langchain_aws.chat_models.bedrock import ChatBedrock
+from langchain_aws.chat_models.bedrock_converse import ChatBedrockConverse
 from langchain_aws.embeddings.bedrock import BedrockEmbeddings
+from langchain_core.callbacks import CallbackManagerForLLMRun
 from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from opentelemetry.trace import Status, StatusCode
 
 from config import settings
+from utils.circuit_breaker import get_circuit_breaker
+from utils.embedding_cache import EmbeddingCache
+from utils.metrics import record_llm_usage
+from utils.rate_limiter import get_rate_limiter
+from utils.tracing import annotate_span, traced, tracer
+
+from .chain import GenreClassificationChain, RecipeAttributesGenerationChain, RecipeKeywordsGenerationChain, RecipeNameGenerationChain, RecipeRewriteChain
+from .router import ModelRouter, parse_models
+from .schemas import GENRE_SCHEMAS
+
+# ジャンルの選択肢（スキーマのenumと一致させる）
+GENRE_CHOICES = json.loads(GENRE_SCHEMAS)["properties"]["genre"]["enum"]
+
+
+class _RateLimitedChatMixin:
+    """呼び出しごとに全ワーカー共通のレート制限枠を確保し、サーキットブレーカーを通すChatモデルのMixin
+
+    Chainやwith_structured_outputからの呼び出しも全て_generate/_streamを経由するため、ここで枠を確保する。
+    """
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # ChatBedrockはConverse APIの呼び出しを_as_converseに委譲するため、枠は委譲先で確保する
+        if getattr(self, "beta_use_converse_api", False):
+            return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        limiter = get_rate_limiter()
+        estimated_tokens = limiter.estimate_tokens(self.model_id, _messages_text(messages))
+        with (
+            tracer.start_as_current_span("bedrock.generate", attributes={"llm.model": self.model_id}) as span,
+            get_circuit_breaker().guard("bedrock"),
+            limiter.acquire(self.model_id, estimated_tokens) as lease,
+        ):
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            if result.generations:
+                _report_usage(span, lease, self.model_id, *_usage(result.generations[0].message))
+            return result
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if getattr(self, "beta_use_converse_api", False):
+            yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return
+        limiter = get_rate_limiter()
+        estimated_tokens = limiter.estimate_tokens(self.model_id, _messages_text(messages))
+        # LangChainはチャンクごとに別のコンテキストでジェネレーターを進めるため、スパンを現在のコンテキストに設定しない
+        span = tracer.start_span("bedrock.stream", attributes={"llm.model": self.model_id})
+        try:
+            with (
+                get_circuit_breaker().guard("bedrock"),
+                limiter.acquire(self.model_id, estimated_tokens) as lease,
+            ):
+                input_tokens = output_tokens = cached_tokens = 0
+                for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    chunk_input, chunk_output, chunk_cached = _usage(chunk.message)
+                    input_tokens += chunk_input
+                    output_tokens += chunk_output
+                    cached_tokens += chunk_cached
+                    yield chunk
+                _report_usage(span, lease, self.model_id, input_tokens, output_tokens, cached_tokens)
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            raise
+        finally:
+            span.end()
+
+
+class RateLimitedChatBedrockConverse(_RateLimitedChatMixin, ChatBedrockConverse):
+    """レート制限・サーキットブレーカーを通すChatBedrockConverse"""
+
+
+class RateLimitedChatBedrock(_RateLimitedChatMixin, ChatBedrock):
+    """レート制限・サーキットブレーカーを通すChatBedrock
+
+    Converse APIを使う場合、ChatBedrockは呼び出し・with_structured_output・bind_toolsを_as_converseの
+    ChatBedrockConverseに委譲するため、委譲先もRateLimitedChatBedrockConverseにする。
+    """
 
-from .chain import GenreClassificationChain, RecipeKeywordsGenerationChain, RecipeNameGenerationChain, RecipeRewriteChain
+    @property
+    def _as_converse(self) -> ChatBedrockConverse:
+        converse = super()._as_converse
+        return RateLimitedChatBedrockConverse.model_construct(_fields_set=converse.model_fields_set, **dict(converse))
+
+
+def _messages_text(messages: List[BaseMessage]) -> str:
+    return "".join(str(message.content) for message in messages)
+
+
+def _report_usage(span, lease, model_id: str, input_tokens: int, output_tokens: int, cached_tokens: int = 0):
+    """使用トークン数をレート制限・メトリクス・呼び出しのスパンに反映（ストリーミングのスパンは現在のスパンではないため明示的に渡す）"""
+    lease.report_tokens(input_tokens + output_tokens)
+    record_llm_usage(model_id, input_tokens, output_tokens, cached_tokens)
+    span.set_attributes({"llm.input_tokens": input_tokens, "llm.output_tokens": output_tokens, "llm.cached_input_tokens": cached_tokens})
+
+
+def _usage(message: BaseMessage) -> Tuple[int, int, int]:
+    """レスポンスのメタデータから (入力トークン数, 出力トークン数, キャッシュから読み込んだ入力トークン数) を取得"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    cached_tokens = (usage.get("input_token_details") or {}).get("cache_read") or 0
+    return usage.get("input_tokens", 0), usage.get("output_tokens", 0), cached_tokens
 
 
 class BedrockClient:
     """Amazon Bedrockクライアント"""
 
-    def __init__(self):
+    def __init__(self, model_id: str = 'apac.amazon.nova-pro-v1:0'):
+        self.model_id = model_id
         self.client = self._initialize_client()
 
     def _initialize_client(self) -> BaseChatModel:
         """Amazon Bedrockクライアントを初期化"""
         try:
-            return ChatBedrock(
-                model_id='apac.amazon.nova-pro-v1:0',
+            return RateLimitedChatBedrock(
+                model_id=self.model_id,
                 region_name=settings.AWS_REGION_NAME,
                 aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                # Nova の tool-use による構造化出力とプロンプトキャッシュは Converse API 経由でのみ利用できる
+                beta_use_converse_api=settings.LLM_STRUCTURED_OUTPUT or settings.BEDROCK_PROMPT_CACHE_ENABLED,
             )
         except Exception as e:
             raise ValueError(f"Amazon Bedrockクライアントの初期化に失敗しました: {str(e)}")
@@ -32,14 +153,15 @@ class BedrockClient:
 class BedrockEmbeddingsClient:
     """Amazon Bedrock埋め込みクライアント"""
 
-    def __init__(self):
+    def __init__(self, model_id: str = 'amazon.titan-embed-text-v1'):
+        self.model_id = model_id
         self.client = self._initialize_client()
 
     def _initialize_client(self) -> BedrockEmbeddings:
         """Amazon Bedrock埋め込みクライアントを初期化"""
         try:
             return BedrockEmbeddings(
-                model_id='amazon.titan-embed-text-v1',
+                model_id=self.model_id,
                 region_name=settings.AWS_REGION_NAME,
                 aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
                 aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
@@ -51,14 +173,39 @@ class BedrockEmbeddingsClient:
         """Bedrock埋め込みクライアントを取得"""
         return self.client
 
+class BedrockChains:
+    """1つのモデルで実行するChain一式"""
+
+    def __init__(self, chat_llm: BaseChatModel, structured: bool = False):
+        self.genre = GenreClassificationChain(chat_llm=chat_llm, structured=structured)
+        self.recipe_name = RecipeNameGenerationChain(chat_llm=chat_llm, structured=structured)
+        self.keywords = RecipeKeywordsGenerationChain(chat_llm=chat_llm, structured=structured)
+        self.attributes = RecipeAttributesGenerationChain(chat_llm=chat_llm, structured=structured)
+        self.rewrite = RecipeRewriteChain(chat_llm=chat_llm, structured=structured)
+
+
 class BedrockService:
 
-    """Amazon Bedrockサービス"""
-    def __init__(self):
-        self.client = BedrockClient().get_client()
-        self.genre_chain = GenreClassificationChain(chat_llm=self.client)
-        self.recipe_name_chain = RecipeNameGenerationChain(chat_llm=self.client)
-        self.recipe_keywords_chain = RecipeKeywordsGenerationChain(chat_llm=self.client)
+    """Amazon Bedrockサービス
+
+    ROUTER_TEXT_MODELSの候補モデルごとにChainを用意し、ModelRouterで健全で最も速いモデルに振り分ける。
+
+    Args:
+        attribute_mode: ジャンル・レシピ名・キーワードの生成方式。
+            "merged" は1回のLLM呼び出しでまとめて生成し、検証に失敗した項目のみ個別Chainで再生成する。
+            "split" は項目ごとに個別Chainを実行する。未指定の場合は設定値を使用する。
+    """
+    def __init__(self, attribute_mode: Optional[str] = None):
+        self.attribute_mode = attribute_mode or settings.BEDROCK_ATTRIBUTE_MODE
+        if self.attribute_mode not in ("merged", "split"):
+            raise ValueError(f"不正な属性生成モードです: {self.attribute_mode}")
+        self.structured = settings.LLM_STRUCTURED_OUTPUT
+        models = parse_models(settings.ROUTER_TEXT_MODELS)
+        self.chains = {
+            model_id: BedrockChains(BedrockClient(model_id).get_client(), structured=self.structured)
+            for model_id in models
+        }
+        self.router = ModelRouter("text", models)
 
     def generate_genre(self, recipe_json: dict) -> str:
         """レシピJSONからジャンルを生成"""
@@ -67,7 +214,7 @@ class BedrockService:
         # 文字列型に変換
         if isinstance(recipe_json, dict):
             recipe_json = str(recipe_json)
-        return self.genre_chain.invoke(recipe_json)
+        return self.router.call_hedged(lambda model: self.chains[model].genre.invoke(recipe_json))
 
     def generate_recipe_name(self, recipe_json: dict) -> str:
         """レシピJSONからレシピ名を生成"""
@@ -76,7 +223,7 @@ class BedrockService:
         # 文字列型に変換
         if isinstance(recipe_json, dict):
             recipe_json = str(recipe_json)
-        return self.recipe_name_chain.invoke(recipe_json)
+        return self.router.call_hedged(lambda model: self.chains[model].recipe_name.invoke(recipe_json))
 
     def generate_keywords(self, recipe_json: dict) -> str:
         """レシピJSONからキーワードを生成"""
@@ -85,23 +232,135 @@ class BedrockService:
         # 文字列型に変換
         if isinstance(recipe_json, dict):
             recipe_json = str(recipe_json)
-        return self.recipe_keywords_chain.invoke(recipe_json)
-    
-    def rewrite_recipe(self, recipe_json: dict) -> str:
-        """レシピJSONをリライト"""
+        return self.router.call_hedged(lambda model: self.chains[model].keywords.invoke(recipe_json))
+
+    def generate_recipe_attributes(
+        self,
+        recipe_json: dict,
+        on_complete: Optional[Callable[[str, Any], None]] = None,
+        names: Optional[list] = None,
+    ) -> Tuple[dict, dict]:
+        """レシピJSONからジャンル・レシピ名・キーワードを生成
+
+        mergedモードでは1回のLLM呼び出しで3項目をまとめて生成し、検証に失敗した項目のみ個別Chainで補完する。
+        splitモードでは3つのChainを並列に実行する。
+
+        Args:
+            recipe_json: リライト済みのレシピJSON
+            on_complete: 項目の生成完了ごとに (項目名, 結果) で呼び出されるコールバック
+            names: 生成する項目（一部のみの場合は個別Chainで生成する）。未指定の場合は全項目
+
+        Returns:
+            (results, errors): 成功した項目の結果と、失敗した項目の例外
+        """
+        if not recipe_json:
+            raise ValueError("レシピJSONは空ではいけません。")
+        all_names = ["genre", "recipe_name", "keywords"]
+        names = [name for name in all_names if names is None or name in names]
+        results = {}
+        if self.attribute_mode == "merged" and names == all_names:
+            results = self.generate_merged_attributes(recipe_json)
+            for name, value in results.items():
+                if on_complete:
+                    on_complete(name, value)
+            names = [name for name in names if name not in results]
+            if names:
+                print(f"個別Chainで再生成する項目: {names}")
+        if not names:
+            return results, {}
+        fallback_results, errors = self._run_attribute_chains(recipe_json, names, on_complete)
+        results.update(fallback_results)
+        return results, errors
+
+    def generate_merged_attributes(self, recipe_json: dict) -> dict:
+        """1回のLLM呼び出しでジャンル・レシピ名・キーワードを生成
+
+        検証を通過した項目のみを、個別Chainと同じ形式に変換して返す。
+        呼び出し自体が失敗した場合は空のdictを返す。
+        """
+        if not recipe_json:
+            raise ValueError("レシピJSONは空ではいけません。")
+        # 文字列型に変換
+        if isinstance(recipe_json, dict):
+            recipe_json = str(recipe_json)
+        try:
+            response = self.router.call_hedged(lambda model: self.chains[model].attributes.invoke(recipe_json))
+        except Exception as e:
+            print(f"属性の一括生成に失敗しました: {str(e)}")
+            return {}
+        if not isinstance(response, dict):
+            return {}
+
+        results = {}
+        genre = response.get("genre")
+        if isinstance(genre, str) and genre in GENRE_CHOICES:
+            results["genre"] = {"genre": genre}
+        recipe_name = response.get("recipe_name")
+        if isinstance(recipe_name, str) and recipe_name.strip():
+            results["recipe_name"] = {"recipes": {"recipe_name": recipe_name.strip()}}
+        keywords = response.get("keywords")
+        if isinstance(keywords, list) and 1 <= len(keywords) <= 5 and all(isinstance(k, str) and k for k in keywords):
+            results["keywords"] = {"keywords": keywords}
+        return results
+
+    def _run_attribute_chains(self, recipe_json: dict, names: list, on_complete: Optional[Callable[[str, Any], None]] = None) -> Tuple[dict, dict]:
+        """指定された項目の個別Chainを並列に実行
+
+        各Chainはリライト済みレシピのみを入力とするため、スレッドプールで同時に実行する。
+        各ブランチは独立しており、1つが失敗しても他のブランチの結果は破棄されない。
+        """
+        branches = {
+            "genre": self.generate_genre,
+            "recipe_name": self.generate_recipe_name,
+            "keywords": self.generate_keywords,
+        }
+        results = {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=settings.BEDROCK_PARALLEL_CHAINS) as executor:
+            # トレースのコンテキストを引き継ぐため、呼び出し元のコンテキストで実行する
+            futures = {executor.submit(contextvars.copy_context().run, branches[name], recipe_json): name for name in names}
+            # コールバックは完了順に呼び出しスレッドで実行する
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+                    continue
+                if on_complete:
+                    on_complete(name, results[name])
+        return results, errors
+
+    def rewrite_recipe(self, recipe_json: dict, on_progress: Optional[Callable[[dict], None]] = None) -> str:
+        """レシピJSONをリライト
+
+        LLM_STREAMING_ENABLEDが有効な場合はストリーミングで生成し、部分結果をon_progressに通知する。
+        """
         if not recipe_json:
             raise ValueError("レシピJSONは空ではいけません。")
         # 文字列型に変換
         if isinstance(recipe_json, dict):
             recipe_json = str(recipe_json)
-        rewrite_chain = RecipeRewriteChain(chat_llm=self.client)
-        return rewrite_chain.invoke(recipe_json)
+        if settings.LLM_STREAMING_ENABLED:
+            # 部分結果を通知済みのためヘッジせず、失敗時のみ次の候補で生成し直す
+            return self.router.call(
+                lambda model: self.chains[model].rewrite.stream(recipe_json, on_progress, interval=settings.LLM_STREAMING_INTERVAL)
+            )
+        return self.router.call_hedged(lambda model: self.chains[model].rewrite.invoke(recipe_json))
     
 class BedrockEmbeddingsService:
-    """Amazon Bedrock埋め込みサービス"""
-    
-    def __init__(self):
-        self.client = BedrockEmbeddingsClient().get_client()
+    """Amazon Bedrock埋め込みサービス
+
+    EMBEDDING_CACHE_ENABLEDが有効な場合は、同じテキストのembeddingをキャッシュから返す。
+
+    Args:
+        model_id: embeddingのモデル。未指定の場合は設定値を使用する
+    """
+
+    def __init__(self, model_id: Optional[str] = None):
+        self.model_id = model_id or settings.EMBEDDING_MODEL_ID
+        self.client = BedrockEmbeddingsClient(self.model_id).get_client()
+        self.cache = EmbeddingCache(self.model_id) if settings.EMBEDDING_CACHE_ENABLED else None
 
     def get_prompt(self, recipe_name, ingredients, processes, genrue, keyword) -> str:
         print("入力確認", ingredients,processes)
@@ -120,8 +379,60 @@ keyword: {keyword}
 
 """
 
+    @traced("bedrock.embed_text")
     def embed_text(self, text: str) -> list:
         """テキストを埋め込み"""
         if not text:
             raise ValueError("テキストは空ではいけません。")
-        return self.client.embed_query(text)
\ No newline at end of file
+        annotate_span(**{"llm.model": self.model_id})
+        cached = self.cache.get_many([text]) if self.cache else {}
+        if text in cached:
+            return cached[text]
+        limiter = get_rate_limiter()
+        with get_circuit_breaker().guard("bedrock"), limiter.acquire(self.model_id, limiter.estimate_tokens(self.model_id, text)):
+            embedding = self.client.embed_query(text)
+        if self.cache:
+            self.cache.set_many({text: embedding})
+        return embedding
+
+    @traced("bedrock.embed_texts")
+    def embed_texts(self, texts: List[str]) -> List[list]:
+        """複数のテキストを一括で埋め込み
+
+        キャッシュにないテキストのみをEMBEDDING_BATCH_SIZE件ずつembed_documentsに渡し、
+        EMBEDDING_CONCURRENCY個のバッチを並列に実行する。重複したテキストは1回だけ埋め込む。
+        結果は入力と同じ順序で返す。
+        """
+        if any(not text for text in texts):
+            raise ValueError("テキストは空ではいけません。")
+        unique_texts = list(dict.fromkeys(texts))
+        embeddings = self.cache.get_many(unique_texts) if self.cache else {}
+        missing = [text for text in unique_texts if text not in embeddings]
+        annotate_span(**{"llm.model": self.model_id, "embedding.texts": len(texts), "embedding.cache_misses": len(missing)})
+        if missing:
+            batch_size = max(settings.EMBEDDING_BATCH_SIZE, 1)
+            batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+            with ThreadPoolExecutor(max_workers=max(min(settings.EMBEDDING_CONCURRENCY, len(batches)), 1)) as executor:
+                # トレースのコンテキストを引き継ぐため、呼び出し元のコンテキストで実行する
+                futures = [executor.submit(contextvars.copy_context().run, self._embed_batch, batch) for batch in batches]
+                errors = []
+                for batch, future in zip(batches, futures):
+                    try:
+                        embedded = dict(zip(batch, future.result()))
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    embeddings.update(embedded)
+                    # 一部のバッチが失敗しても再試行時に完了したバッチを再利用できるよう、バッチごとに保存する
+                    if self.cache:
+                        self.cache.set_many(embedded)
+            if errors:
+                raise errors[0]
+        return [embeddings[text] for text in texts]
+
+    def _embed_batch(self, texts: List[str]) -> List[list]:
+        """1バッチ分をembed_documentsで埋め込む（レート制限はテキスト数分のリクエストとして確保）"""
+        limiter = get_rate_limiter()
+        tokens = sum(limiter.estimate_tokens(self.model_id, text) for text in texts)
+        with get_circuit_breaker().guard("bedrock"), limiter.acquire(self.model_id, tokens, requests=len(texts)):
+            return self.client.embed_documents(texts)
\ No newline at end of file
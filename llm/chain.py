@@ -1,33 +1,102 @@
 import json
-import re
+from typing import Callable, Optional
 
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnableLambda
 
+from utils.tracing import traced
+
 from .base import BaseChain
-from .schemas import GENRE_SCHEMAS, KEYWORD_SCHEMAS, RECIPE_SCHEMAS, RECIPENAME_SCHEMAS
+from .output_models import GenreOutput, KeywordsOutput, RecipeAttributesOutput, RecipeOutput
+from .prompt_cache import cacheable_prompt
+from .schemas import GENRE_SCHEMAS, KEYWORD_SCHEMAS, RECIPE_ATTRIBUTES_SCHEMAS, RECIPE_SCHEMAS
+from .streaming import StreamingJSONMonitor
 
+# 出力形式の指示（各プロンプトの末尾にスキーマとともに置く）
+OUTPUT_FORMAT_RULES = '''- 出力形式は必ず **以下の JSON スキーマ形式のみ** に従ってください。
+- **テキスト出力や説明文、Markdownは絶対に含めないでください。**
+- JSON 以外の文字を含むとエラーとなります。'''
 
-#ジャンル分類するChain
-class GenreClassificationChain(BaseChain):
-    """Chain for analyzing conversation history"""
+# レシピごとに変わる入力（キャッシュされるシステムプロンプトの後にユーザーメッセージとして渡す）
+RECIPE_INPUT_TEMPLATE = '''入力JSON：
+"""
+{recipe_json}
+"""
+'''
 
-    def __init__(self, 
-            chat_llm: BaseChatModel
-        ):
-        self.chat_llm = chat_llm
-        self.prompt = PromptTemplate(
-            template='''あなたは料理レシピのジャンルを判定するAIです。
+# プロンプトはプロセスごとに1回だけ組み立て、全モデルのChainで共有する
+GENRE_PROMPT = cacheable_prompt(f'''あなたは料理レシピのジャンルを判定するAIです。
+
+ユーザーが入力する構造化されたレシピJSONの内容をもとに、料理のジャンルを以下の選択肢から1つだけ選んでください：
 
-以下の構造化されたレシピJSONの内容をもとに、料理のジャンルを以下の選択肢から1つだけ選んでください：
+["和食", "洋食", "中華", "韓国風", "エスニック", "スイーツ", "その他"]
 
-入力JSON：
+選択のポイント：
+- 日本の家庭料理・丼もの・しょうゆやみりんベース：→ 「和食」
+- バター・チーズ・オーブン料理など：→ 「洋食」
+- 中華鍋、オイスターソース、甜麺醤など：→ 「中華」
+- コチュジャン、キムチ、韓国風焼肉など：→ 「韓国風」
+- ナンプラー、パクチー、スパイスが特徴：→ 「エスニック」
+- デザート類（ケーキ、クッキー、プリンなど）：→ 「スイーツ」
+- 上記に当てはまらない・ジャンルが混在：→ 「その他」
+
+---
+
+{OUTPUT_FORMAT_RULES}
+
+出力形式:"""
+{GENRE_SCHEMAS}
 """
-{recipe_json}
+''', RECIPE_INPUT_TEMPLATE)
+
+RECIPE_NAME_PROMPT = cacheable_prompt(f'''ユーザーが入力する構造化レシピJSONに基づいて、この料理の名前を生成してください。
+親しみやすく、キャッチーな名前を考えてください。ただし、あまり長くならないようにしてください。
+また料理の内容からは逸脱しないようにしてください。
+
+{OUTPUT_FORMAT_RULES}
+
+出力形式:"""
+{RECIPE_SCHEMAS}
+"""
+''', RECIPE_INPUT_TEMPLATE)
+
+KEYWORDS_PROMPT = cacheable_prompt(f'''あなたは料理のレシピJSONを分析して、関連するキーワードを抽出するAIです。
+
+ユーザーが入力するJSONは料理レシピの構造化データです。
+このレシピの特徴や材料、調理方法をもとに、関連する単語やフレーズからなる **キーワードリスト** を生成してください。
+
+**以下のスキーマに従って、キーワードの配列だけを含んだJSONとして出力してください。**
+
+絶対に `keywords` プロパティだけを含むJSONだけを出力してください。
+`type`, `properties`, `required` などのスキーマ構文は一切含めないでください。
+
+{OUTPUT_FORMAT_RULES}
+
+出力形式:"""
+{KEYWORD_SCHEMAS}
 """
+''', RECIPE_INPUT_TEMPLATE)
 
+REWRITE_PROMPT = cacheable_prompt(f'''あなたは料理レシピを、親しみやすく温かみのある表現に書き換えるとても優秀なAIです。
+
+ユーザーが入力するJSONには、ある料理のレシピ（名前、手順、材料）が構造化されて含まれています。このレシピを愛着の持てる表現にリライトしてください。
+
+ただし、**出力のスキーマ構造（項目名など）は変更せず、内容だけをやさしく・親しみやすく書き直す**ようにしてください。
+料理の意味が変わるような大幅な改変や創作は行わないでください。
+
+{OUTPUT_FORMAT_RULES}
+
+出力形式:"""
+{RECIPE_SCHEMAS}
+"""
+''', RECIPE_INPUT_TEMPLATE)
+
+ATTRIBUTES_PROMPT = cacheable_prompt(f'''あなたは料理レシピJSONを分析して、ジャンル・料理名・キーワードをまとめて生成するAIです。
+
+ユーザーが入力する構造化されたレシピJSONの内容をもとに、次の3つの項目を生成してください。
+
+1. genre: 料理のジャンルを以下の選択肢から1つだけ選んでください：
 ["和食", "洋食", "中華", "韓国風", "エスニック", "スイーツ", "その他"]
 
 選択のポイント：
@@ -39,31 +108,53 @@ class GenreClassificationChain(BaseChain):
 - デザート類（ケーキ、クッキー、プリンなど）：→ 「スイーツ」
 - 上記に当てはまらない・ジャンルが混在：→ 「その他」
 
+2. recipe_name: この料理の名前を生成してください。
+親しみやすく、キャッチーな名前を考えてください。ただし、あまり長くならないようにしてください。
+また料理の内容からは逸脱しないようにしてください。
+
+3. keywords: このレシピの特徴や材料、調理方法をもとに、関連する単語やフレーズからなるキーワードを1〜5個生成してください。
+
+`type`, `properties`, `required` などのスキーマ構文は一切含めないでください。
+
 ---
 
-- 出力形式は必ず **以下の JSON スキーマ形式のみ** に従ってください。
-- **テキスト出力や説明文、Markdownは絶対に含めないでください。**
-- JSON 以外の文字を含むとエラーとなります。
+{OUTPUT_FORMAT_RULES}
 
 出力形式:"""
-{schema}
+{RECIPE_ATTRIBUTES_SCHEMAS}
 """
-''',
-    input_variables=["recipe_json", "schema"]
-    )
+''', RECIPE_INPUT_TEMPLATE)
+
+
+#ジャンル分類するChain
+class GenreClassificationChain(BaseChain):
+    """Chain for analyzing conversation history"""
+
+    output_model = GenreOutput
+
+    def __init__(self,
+            chat_llm: BaseChatModel,
+            structured: bool = False,
+        ):
+        self.chat_llm = chat_llm
+        self.prompt = GENRE_PROMPT
         self.chain = self.prompt | self.chat_llm | StrOutputParser() | RunnableLambda(self.replaced2json)
+        self.structured = structured
+        if structured:
+            # スキーマから生成したモデルでtool-useによる構造化出力を行う（ツールを呼び出さなかった場合に備えて生の応答も受け取る）
+            self.structured_chain = self.prompt | self.chat_llm.with_structured_output(self.output_model, include_raw=True)
 
     def get_prompt(self, inputs, **kwargs):
         """Get the prompt string for the given inputs."""
 
         # Create formatted input
         formatted_input = {
-            "history": inputs,
-            "schema": GENRE_SCHEMAS,
+            "recipe_json": inputs,
         }
 
         return self.prompt.invoke(formatted_input, **kwargs).to_string()
         
+    @traced("chain.GenreClassificationChain.invoke")
     def invoke(self, 
             inputs: str,            
         ):
@@ -72,53 +163,35 @@ class GenreClassificationChain(BaseChain):
         # Prepare the input for the chain
         formatted_input = {
             "recipe_json": inputs,
-            "schema": GENRE_SCHEMAS,
         }
 
+        if self.structured:
+            return self.invoke_structured(formatted_input)
+
         # Execute the chain
         response = self.chain.invoke(formatted_input)
 
         print(f"Response: {response}")
 
         return json.loads(response)
-    
-    @staticmethod
-    def replaced2json(output: str) -> str:
-        replaced_output = output.replace('```json', '').replace('```', '')
-        # 正規表現を使って空白行（改行だけや空白のみの行）を削除
-        replaced_output = re.sub(r'^\s*\n', '', replaced_output, flags=re.MULTILINE)
-        # 正規表現を使って最後のカンマを削除
-        replaced_output = re.sub(r',\s*$', '', replaced_output)
-        # replaced_output = json.loads(replaced_output) # これを加えるとdict型になってしまう
-        return replaced_output
-    
+
+
 class RecipeNameGenerationChain(BaseChain):
     """Chain for generating recipe names"""
 
+    output_model = RecipeOutput
+
     def __init__(self,
-            chat_llm: BaseChatModel
+            chat_llm: BaseChatModel,
+            structured: bool = False,
         ):
         self.chat_llm = chat_llm
-        self.prompt = PromptTemplate(
-            template='''以下の構造化レシピJSONに基づいて、この料理の名前を生成してください。
-親しみやすく、キャッチーな名前を考えてください。ただし、あまり長くならないようにしてください。
-また料理の内容からは逸脱しないようにしてください。
-
-入力:"""
-{recipe_json}
-"""
-
-- 出力形式は必ず **以下の JSON スキーマ形式のみ** に従ってください。
-- **テキスト出力や説明文、Markdownは絶対に含めないでください。**
-- JSON 以外の文字を含むとエラーとなります。
-
-出力形式:"""
-{schema}
-"""
-''',
-            input_variables=["recipe_json", "schema"]
-        )
+        self.prompt = RECIPE_NAME_PROMPT
         self.chain = self.prompt | self.chat_llm | StrOutputParser() | RunnableLambda(self.replaced2json)
+        self.structured = structured
+        if structured:
+            # スキーマから生成したモデルでtool-useによる構造化出力を行う（ツールを呼び出さなかった場合に備えて生の応答も受け取る）
+            self.structured_chain = self.prompt | self.chat_llm.with_structured_output(self.output_model, include_raw=True)
     
     def get_prompt(self, inputs, **kwargs):
         """Get the prompt string for the given inputs."""
@@ -126,11 +199,11 @@ class RecipeNameGenerationChain(BaseChain):
         # Create formatted input
         formatted_input = {
             "recipe_json": inputs,
-            "schema": RECIPENAME_SCHEMAS,
         }
 
         return self.prompt.invoke(formatted_input, **kwargs).to_string()
     
+    @traced("chain.RecipeNameGenerationChain.invoke")
     def invoke(self,
             inputs: str,
         ):
@@ -139,60 +212,35 @@ class RecipeNameGenerationChain(BaseChain):
         # Prepare the input for the chain
         formatted_input = {
             "recipe_json": inputs,
-            "schema": RECIPE_SCHEMAS,
         }
 
+        if self.structured:
+            return self.invoke_structured(formatted_input)
+
         # Execute the chain
         response = self.chain.invoke(formatted_input)
 
         print(f"Response: {response}")
 
         return json.loads(response)
-    
-    @staticmethod
-    def replaced2json(output: str) -> str:
-        replaced_output = output.replace('```json', '').replace('```', '')
-        # 正規表現を使って空白行（改行だけや空白のみの行）を削除
-        replaced_output = re.sub(r'^\s*\n', '', replaced_output, flags=re.MULTILINE)
-        # 正規表現を使って最後のカンマを削除
-        replaced_output = re.sub(r',\s*$', '', replaced_output)
-        # replaced_output = json.loads(replaced_output) # これを加えるとdict型になってしまう
-        return replaced_output
-    
+
 
 class RecipeKeywordsGenerationChain(BaseChain):
     """Chain for generating recipe keywords"""
 
+    output_model = KeywordsOutput
+
     def __init__(self,
-            chat_llm: BaseChatModel
+            chat_llm: BaseChatModel,
+            structured: bool = False,
         ):
         self.chat_llm = chat_llm
-        self.prompt = PromptTemplate(
-            template='''あなたは料理のレシピJSONを分析して、関連するキーワードを抽出するAIです。
-
-以下のJSONは料理レシピの構造化データです。  
-このレシピの特徴や材料、調理方法をもとに、関連する単語やフレーズからなる **キーワードリスト** を生成してください。
-
-**以下のスキーマに従って、キーワードの配列だけを含んだJSONとして出力してください。**
-
-絶対に上記のような `keywords` プロパティだけを含むJSONだけを出力してください。
-`type`, `properties`, `required` などのスキーマ構文は一切含めないでください。
-
-入力:"""
-{recipe_json}
-"""
-
-- 出力形式は必ず **以下の JSON スキーマ形式のみ** に従ってください。
-- **テキスト出力や説明文、Markdownは絶対に含めないでください。**
-- JSON 以外の文字を含むとエラーとなります。
-
-出力形式:"""
-{schema}
-"""
-''',
-            input_variables=["recipe_json", "schema"]
-        )
+        self.prompt = KEYWORDS_PROMPT
         self.chain = self.prompt | self.chat_llm | StrOutputParser() | RunnableLambda(self.replaced2json)
+        self.structured = structured
+        if structured:
+            # スキーマから生成したモデルでtool-useによる構造化出力を行う（ツールを呼び出さなかった場合に備えて生の応答も受け取る）
+            self.structured_chain = self.prompt | self.chat_llm.with_structured_output(self.output_model, include_raw=True)
 
     def get_prompt(self, inputs, **kwargs):
         """Get the prompt string for the given inputs."""
@@ -200,10 +248,10 @@ class RecipeKeywordsGenerationChain(BaseChain):
         # Create formatted input
         formatted_input = {
             "recipe_json": inputs,
-            "schema": KEYWORD_SCHEMAS,
         }
         return self.prompt.invoke(formatted_input, **kwargs).to_string()
     
+    @traced("chain.RecipeKeywordsGenerationChain.invoke")
     def invoke(self,
             inputs: str,
         ):
@@ -212,9 +260,11 @@ class RecipeKeywordsGenerationChain(BaseChain):
         # Prepare the input for the chain
         formatted_input = {
             "recipe_json": inputs,
-            "schema": KEYWORD_SCHEMAS,
         }
 
+        if self.structured:
+            return self.invoke_structured(formatted_input)
+
         # Execute the chain
         response = self.chain.invoke(formatted_input)
 
@@ -222,71 +272,120 @@ class RecipeKeywordsGenerationChain(BaseChain):
 
         return json.loads(response)
 
-    @staticmethod
-    def replaced2json(output: str) -> str:
-        replaced_output = output.replace('```json', '').replace('```', '')
-        # 正規表現を使って空白行（改行だけや空白のみの行）を削除
-        replaced_output = re.sub(r'^\s*\n', '', replaced_output, flags=re.MULTILINE)
-        # 正規表現を使って最後のカンマを削除
-        replaced_output = re.sub(r',\s*$', '', replaced_output)
-        # replaced_output = json.loads(replaced_output) # これを加えるとdict型になってしまう
-        return replaced_output
-    
+
 class RecipeRewriteChain(BaseChain):
     """Chain for rewriting recipe content"""
 
+    output_model = RecipeOutput
+
     def __init__(self,
-            chat_llm: BaseChatModel
+            chat_llm: BaseChatModel,
+            structured: bool = False,
         ):
         self.chat_llm = chat_llm
-        self.prompt = PromptTemplate(
-            template='''あなたは料理レシピを、親しみやすく温かみのある表現に書き換えるとても優秀なAIです。
+        self.prompt = REWRITE_PROMPT
+        self.chain = self.prompt | self.chat_llm | StrOutputParser() | RunnableLambda(self.replaced2json)
+        self.structured = structured
+        if structured:
+            # スキーマから生成したモデルでtool-useによる構造化出力を行う（ツールを呼び出さなかった場合に備えて生の応答も受け取る）
+            self.structured_chain = self.prompt | self.chat_llm.with_structured_output(self.output_model, include_raw=True)
+        # RunnableLambdaは入力を集約してしまうため、ストリーミング用は整形前で止める
+        self.stream_chain = self.prompt | self.chat_llm | StrOutputParser()
 
-以下のJSONには、ある料理のレシピ（名前、手順、材料）が構造化されて含まれています。このレシピを愛着の持てる表現にリライトしてください。
+    
+    def get_prompt(self, inputs, **kwargs):
+        """Get the prompt string for the given inputs."""
 
-入力JSON：
-"""
-{recipe_json}
-"""
+        # Create formatted input
+        formatted_input = {
+            "recipe_json": inputs,
+        }
+        return self.prompt.invoke(formatted_input, **kwargs).to_string()
+    
+    @traced("chain.RecipeRewriteChain.invoke")
+    def invoke(self,
+            inputs: str,
+        ):
+        """Invoke the chain for recipe rewriting."""
 
-ただし、**出力のスキーマ構造（項目名など）は変更せず、内容だけをやさしく・親しみやすく書き直す**ようにしてください。  
-料理の意味が変わるような大幅な改変や創作は行わないでください。
+        # Prepare the input for the chain
+        formatted_input = {
+            "recipe_json": inputs,
+        }
 
-- 出力形式は必ず **以下の JSON スキーマ形式のみ** に従ってください。
-- **テキスト出力や説明文、Markdownは絶対に含めないでください。**
-- JSON 以外の文字を含むとエラーとなります。
+        print(f"Formatted Input: {formatted_input}")
 
-出力形式:"""
-{schema}
-"""
-''',
-            input_variables=["recipe_json", "schema"]
-        )
+        if self.structured:
+            return self.invoke_structured(formatted_input)
+
+        # Execute the chain
+        response = self.chain.invoke(formatted_input)
+
+        print(f"Response: {response}")
+
+        return json.loads(response)
+
+    @traced("chain.RecipeRewriteChain.stream")
+    def stream(self,
+            inputs: str,
+            on_progress: Optional[Callable[[dict], None]] = None,
+            interval: float = 0.25,
+        ):
+        """Stream the chain for recipe rewriting, reporting partial output."""
+
+        # Prepare the input for the chain
+        formatted_input = {
+            "recipe_json": inputs,
+        }
+
+        # Execute the chain, validating the JSON structure as chunks arrive
+        monitor = StreamingJSONMonitor(RECIPE_SCHEMAS, on_progress, interval=interval)
+        response = self.replaced2json(monitor.consume(self.stream_chain.stream(formatted_input)))
+
+        print(f"Response: {response}")
+
+        return json.loads(response)
+
+
+class RecipeAttributesGenerationChain(BaseChain):
+    """Chain for generating genre, recipe name and keywords in a single call"""
+
+    output_model = RecipeAttributesOutput
+
+    def __init__(self,
+            chat_llm: BaseChatModel,
+            structured: bool = False,
+        ):
+        self.chat_llm = chat_llm
+        self.prompt = ATTRIBUTES_PROMPT
         self.chain = self.prompt | self.chat_llm | StrOutputParser() | RunnableLambda(self.replaced2json)
+        self.structured = structured
+        if structured:
+            # スキーマから生成したモデルでtool-useによる構造化出力を行う（ツールを呼び出さなかった場合に備えて生の応答も受け取る）
+            self.structured_chain = self.prompt | self.chat_llm.with_structured_output(self.output_model, include_raw=True)
 
-    
     def get_prompt(self, inputs, **kwargs):
         """Get the prompt string for the given inputs."""
 
         # Create formatted input
         formatted_input = {
             "recipe_json": inputs,
-            "schema": RECIPE_SCHEMAS,
         }
         return self.prompt.invoke(formatted_input, **kwargs).to_string()
-    
+
+    @traced("chain.RecipeAttributesGenerationChain.invoke")
     def invoke(self,
             inputs: str,
         ):
-        """Invoke the chain for recipe rewriting."""
+        """Invoke the chain for combined recipe attribute generation."""
 
         # Prepare the input for the chain
         formatted_input = {
             "recipe_json": inputs,
-            "schema": RECIPE_SCHEMAS,
         }
 
-        print(f"Formatted Input: {formatted_input}")
+        if self.structured:
+            return self.invoke_structured(formatted_input)
 
         # Execute the chain
         response = self.chain.invoke(formatted_input)
@@ -294,13 +393,3 @@ class RecipeRewriteChain(BaseChain):
         print(f"Response: {response}")
 
         return json.loads(response)
-    
-    @staticmethod
-    def replaced2json(output: str) -> str:
-        replaced_output = output.replace('```json', '').replace('```', '')
-        # 正規表現を使って空白行（改行だけや空白のみの行）を削除
-        replaced_output = re.sub(r'^\s*\n', '', replaced_output, flags=re.MULTILINE)
-        # 正規表現を使って最後のカンマを削除
-        replaced_output = re.sub(r',\s*$', '', replaced_output)
-        # replaced_output = json.loads(replaced_output) # これを加えるとdict型になってしまう
-        return replaced_output
\ No newline at end of file
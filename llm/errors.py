@@ -0,0 +1,103 @@
+from typing import Iterator, Optional
+
+# エラーの分類
+TRANSIENT = "transient"  # 一時的な障害（5xx・タイムアウト・接続エラー）。時間をおいて再試行する
+THROTTLE = "throttle"  # プロバイダーのレート制限。長めに間隔をあけて再試行する
+PERMANENT = "permanent"  # 入力・認証・出力形式の誤りなど、再試行しても解消しないエラー
+
+# 認証情報の失効を示すエラーコード・メッセージ
+CREDENTIAL_ERROR_MARKERS = (
+    "ExpiredToken",
+    "ExpiredTokenException",
+    "UnrecognizedClientException",
+    "InvalidSignatureException",
+    "InvalidClientTokenId",
+    "API_KEY_INVALID",
+    "UNAUTHENTICATED",
+)
+
+
+class StructuredOutputError(ValueError):
+    """構造化出力でモデルがツールを呼び出さず、応答をスキーマどおりに解釈できなかった"""
+
+
+THROTTLE_MARKERS = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "Too Many Requests",
+    "RESOURCE_EXHAUSTED",
+    "ServiceQuotaExceededException",
+    "RateLimitTimeoutError",
+    "Rate exceeded",
+)
+
+TRANSIENT_MARKERS = (
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+    "ModelStreamErrorException",
+    "EndpointConnectionError",
+    "ConnectTimeout",
+    "ReadTimeout",
+    "ConnectionError",
+    "CircuitOpenError",
+    # 出力はリクエストごとに変わるため、再試行で解消することが多い
+    "StructuredOutputError",
+    "UNAVAILABLE",
+    "DEADLINE_EXCEEDED",
+    "Service Unavailable",
+    "timed out",
+)
+
+THROTTLE_STATUS_CODES = {429}
+TRANSIENT_STATUS_CODES = {500, 502, 503, 504}
+
+
+def classify_error(error: BaseException) -> str:
+    """例外を transient / throttle / permanent に分類
+
+    LangChainはboto3の例外をValueErrorで包んで送出するため、原因の例外をたどり、
+    例外クラス名・ステータスコード・メッセージ中のエラーコードで判定する。
+    ステータスコードは例外の属性からのみ取得する（メッセージ中の数値は誤判定の原因になるため使わない）。
+    判定できない例外は再試行による負荷の増大を避けるためpermanentとする。
+    """
+    chain = list(_exception_chain(error))
+    texts = [f"{type(e).__name__}: {e}" for e in chain]
+    if any(marker in text for text in texts for marker in CREDENTIAL_ERROR_MARKERS):
+        return PERMANENT
+
+    status_codes = {code for code in (_status_code(e) for e in chain) if code}
+
+    if status_codes & THROTTLE_STATUS_CODES or any(marker in text for text in texts for marker in THROTTLE_MARKERS):
+        return THROTTLE
+    if status_codes & TRANSIENT_STATUS_CODES or any(marker in text for text in texts for marker in TRANSIENT_MARKERS):
+        return TRANSIENT
+    if any(isinstance(e, (ConnectionError, TimeoutError)) for e in chain):
+        return TRANSIENT
+    return PERMANENT
+
+
+def _exception_chain(error: BaseException) -> Iterator[BaseException]:
+    seen = set()
+    current: Optional[BaseException] = error
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        yield current
+        current = current.__cause__ or current.__context__
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    # google-genai の APIError
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    # botocore の ClientError
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    # httpx・requests の HTTPError
+    status_code = getattr(response, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code
+    return None
@@ -1,83 +1,479 @@
-import re
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
 
 import google.genai as genai
 from google.genai import types
+from opentelemetry.trace import Status, StatusCode
+from pydantic import BaseModel
 
 from config import settings
+from utils.circuit_breaker import get_circuit_breaker
+from utils.metrics import record_gemini_extraction, record_llm_usage
+from utils.rate_limiter import get_rate_limiter
+from utils.tracing import annotate_span, tracer
+from utils.youtube import extract_shorts_video_id
 
+from .base import BaseChain
+from .output_models import RecipeOutput
+from .prompt_cache import GeminiContextCache
+from .router import ModelRouter, parse_models
 from .schemas import RECIPE_SCHEMAS
+from .streaming import StreamingJSONMonitor
+
+# 動画からレシピを抽出するシステム指示（全リクエストで共通のため、キャッシュされるよう先頭に置く）
+RECIPE_EXTRACTION_PROMPT = f'''あなたは料理動画を分析して、構造化されたJSONデータを出力するとても優秀なAIです。
+
+入力された動画の内容を分析して、一人分の料理として以下の**スキーマに準拠した形式**でレシピ情報を抽出してください。
+料理工程はできるだけ詳細に記述してください。
+
+**何があっても、以下のスキーマの形のみ出力するように絶対従ってください。**
+
+出力形式："""
+{RECIPE_SCHEMAS}
+"""
+'''
+
+# 動画ごとのリクエスト（動画の後に置く）
+RECIPE_EXTRACTION_REQUEST = "この動画のレシピ情報を、指定されたスキーマに従ってJSONで出力してください。"
+
+# 動画の解像度の設定値とGeminiのMediaResolutionの対応
+MEDIA_RESOLUTIONS = {
+    "low": types.MediaResolution.MEDIA_RESOLUTION_LOW,
+    "medium": types.MediaResolution.MEDIA_RESOLUTION_MEDIUM,
+    "high": types.MediaResolution.MEDIA_RESOLUTION_HIGH,
+}
+# lowの解像度で抽出した結果が空の場合に、解像度を上げて抽出し直す項目
+REQUIRED_RECIPE_FIELDS = ("processes", "ingredients")
+
+logger = logging.getLogger(__name__)
+
+
+def video_options(overrides: Optional[Dict] = None) -> Dict:
+    """動画解析のオプション（設定値にリクエストごとの指定を重ねたもの）
+
+    overridesはタスクのmetadata["video"]で、media_resolution / fps / start_offset / end_offset（秒）/ adaptive を指定できる。
+    """
+    options = {
+        "media_resolution": settings.GEMINI_MEDIA_RESOLUTION or None,
+        "fps": settings.GEMINI_VIDEO_FPS or None,
+        "start_offset": settings.GEMINI_VIDEO_START_OFFSET or None,
+        "end_offset": settings.GEMINI_VIDEO_END_OFFSET or None,
+        "adaptive": settings.GEMINI_ADAPTIVE_RESOLUTION,
+    }
+    options.update({key: value for key, value in (overrides or {}).items() if key in options})
+    if options["media_resolution"] is not None and options["media_resolution"] not in MEDIA_RESOLUTIONS:
+        raise ValueError(f"Unknown media_resolution: {options['media_resolution']}")
+    for key in ("fps", "start_offset", "end_offset"):
+        if options[key] is not None:
+            options[key] = float(options[key])
+    return options
+
+
+def missing_recipe_fields(recipe) -> List[str]:
+    """抽出結果のうち空の必須項目（工程・材料）"""
+    if not isinstance(recipe, dict):
+        return list(REQUIRED_RECIPE_FIELDS)
+    return [name for name in REQUIRED_RECIPE_FIELDS if not recipe.get(name)]
 
 
 class GeminiClient:
 
-    def __init__(self):
+    def __init__(self, model: str = 'models/gemini-2.0-flash'):
         self.client = genai.Client(api_key=settings.GOOGLE_API_KEY)
-        self.model = 'models/gemini-2.0-flash'
+        self.model = model
+        self.context_cache = GeminiContextCache(self.client) if settings.GEMINI_CONTEXT_CACHE_ENABLED else None
 
-    def invoke(self, prompt: str, file_url: str):
+    def invoke(
+        self,
+        prompt: str,
+        file_url: str,
+        response_schema: Optional[type[BaseModel]] = None,
+        model: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+        video: Optional[Dict] = None,
+        usage: Optional[Dict[str, int]] = None,
+    ):
         """
         Invoke the Gemini model with a prompt and file URL.
 
         Args:
             prompt (str): The prompt to send to the model.
             file_url (str): The URL of the file to be processed.
+            response_schema: Pydantic model for native JSON structured output.
+            model: Model to call instead of the client's default model.
+            system_instruction: Static instruction sent ahead of the contents.
+                Served from cached content when GEMINI_CONTEXT_CACHE_ENABLED is set.
+            video: Video options (media_resolution, fps, start_offset, end_offset) from video_options.
+            usage: Dict accumulating the reported input / output / cached_input tokens.
+        """
+
+        model = model or self.model
+        limiter = get_rate_limiter()
+        cached_content = self.context_cache.get(model, system_instruction) if self.context_cache and system_instruction else None
+        with (
+            tracer.start_as_current_span("gemini.generate_content", attributes={"llm.model": model}) as span,
+            get_circuit_breaker().guard("gemini"),
+            limiter.acquire(model, limiter.estimate_tokens(model, (system_instruction or "") + prompt)) as lease,
+        ):
+            response = self.client.models.generate_content(
+                model=model,
+                contents=self._build_contents(prompt, file_url, video),
+                config=self._build_config(response_schema, system_instruction, cached_content, (video or {}).get("media_resolution")),
+            )
+            self._report_usage(span, lease, model, response, usage)
+
+        return response.text
+
+    def stream(
+        self,
+        prompt: str,
+        file_url: str,
+        response_schema: Optional[type[BaseModel]] = None,
+        model: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+        video: Optional[Dict] = None,
+        usage: Optional[Dict[str, int]] = None,
+    ) -> Iterator[str]:
+        """
+        Invoke the Gemini model and yield the text of each streamed chunk.
+
+        Args:
+            prompt (str): The prompt to send to the model.
+            file_url (str): The URL of the file to be processed.
+            response_schema: Pydantic model for native JSON structured output.
+            model: Model to call instead of the client's default model.
+            system_instruction: Static instruction sent ahead of the contents.
+                Served from cached content when GEMINI_CONTEXT_CACHE_ENABLED is set.
+            video: Video options (media_resolution, fps, start_offset, end_offset) from video_options.
+            usage: Dict accumulating the reported input / output / cached_input tokens.
+        """
+
+        model = model or self.model
+        limiter = get_rate_limiter()
+        cached_content = self.context_cache.get(model, system_instruction) if self.context_cache and system_instruction else None
+        # yieldをまたいでスパンを現在のコンテキストに設定すると、呼び出し側のコンテキストで終了できないため明示的に開始・終了する
+        span = tracer.start_span("gemini.generate_content_stream", attributes={"llm.model": model})
+        try:
+            with (
+                get_circuit_breaker().guard("gemini"),
+                limiter.acquire(model, limiter.estimate_tokens(model, (system_instruction or "") + prompt)) as lease,
+            ):
+                last_chunk = None
+                for chunk in self.client.models.generate_content_stream(
+                    model=model,
+                    contents=self._build_contents(prompt, file_url, video),
+                    config=self._build_config(response_schema, system_instruction, cached_content, (video or {}).get("media_resolution")),
+                ):
+                    last_chunk = chunk
+                    if chunk.text:
+                        yield chunk.text
+                # 使用トークン数は最後のチャンクに累計で含まれる
+                if last_chunk is not None:
+                    self._report_usage(span, lease, model, last_chunk, usage)
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            raise
+        finally:
+            span.end()
+
+    async def ainvoke(
+        self,
+        prompt: str,
+        file_url: str,
+        response_schema: Optional[type[BaseModel]] = None,
+        model: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+        video: Optional[Dict] = None,
+        usage: Optional[Dict[str, int]] = None,
+    ):
+        """
+        Coroutine version of invoke using the client's native async API.
+
+        Args:
+            prompt (str): The prompt to send to the model.
+            file_url (str): The URL of the file to be processed.
+            response_schema: Pydantic model for native JSON structured output.
+            model: Model to call instead of the client's default model.
+            system_instruction: Static instruction sent ahead of the contents.
+                Served from cached content when GEMINI_CONTEXT_CACHE_ENABLED is set.
+            video: Video options (media_resolution, fps, start_offset, end_offset) from video_options.
+            usage: Dict accumulating the reported input / output / cached_input tokens.
+        """
+
+        model = model or self.model
+        limiter = get_rate_limiter()
+        cached_content = await self.context_cache.aget(model, system_instruction) if self.context_cache and system_instruction else None
+        with tracer.start_as_current_span("gemini.generate_content", attributes={"llm.model": model}) as span:
+            async with (
+                get_circuit_breaker().guard_async("gemini"),
+                limiter.acquire_async(model, limiter.estimate_tokens(model, (system_instruction or "") + prompt)) as lease,
+            ):
+                response = await self.client.aio.models.generate_content(
+                    model=model,
+                    contents=self._build_contents(prompt, file_url, video),
+                    config=self._build_config(response_schema, system_instruction, cached_content, (video or {}).get("media_resolution")),
+                )
+                # 使用トークン数の反映はRedisへの書き込みを伴うためスレッドプールで行う
+                await asyncio.to_thread(self._report_usage, span, lease, model, response, usage)
+
+        return response.text
+
+    async def astream(
+        self,
+        prompt: str,
+        file_url: str,
+        response_schema: Optional[type[BaseModel]] = None,
+        model: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+        video: Optional[Dict] = None,
+        usage: Optional[Dict[str, int]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Coroutine version of stream using the client's native async API.
+
+        Args:
+            prompt (str): The prompt to send to the model.
+            file_url (str): The URL of the file to be processed.
+            response_schema: Pydantic model for native JSON structured output.
+            model: Model to call instead of the client's default model.
+            system_instruction: Static instruction sent ahead of the contents.
+                Served from cached content when GEMINI_CONTEXT_CACHE_ENABLED is set.
+            video: Video options (media_resolution, fps, start_offset, end_offset) from video_options.
+            usage: Dict accumulating the reported input / output / cached_input tokens.
         """
 
-        contents = types.Content(
+        model = model or self.model
+        limiter = get_rate_limiter()
+        cached_content = await self.context_cache.aget(model, system_instruction) if self.context_cache and system_instruction else None
+        # streamと同じく、yieldをまたぐスパンは現在のコンテキストに設定せず明示的に開始・終了する
+        span = tracer.start_span("gemini.generate_content_stream", attributes={"llm.model": model})
+        try:
+            async with (
+                get_circuit_breaker().guard_async("gemini"),
+                limiter.acquire_async(model, limiter.estimate_tokens(model, (system_instruction or "") + prompt)) as lease,
+            ):
+                last_chunk = None
+                async for chunk in await self.client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=self._build_contents(prompt, file_url, video),
+                    config=self._build_config(response_schema, system_instruction, cached_content, (video or {}).get("media_resolution")),
+                ):
+                    last_chunk = chunk
+                    if chunk.text:
+                        yield chunk.text
+                # 使用トークン数は最後のチャンクに累計で含まれる
+                if last_chunk is not None:
+                    await asyncio.to_thread(self._report_usage, span, lease, model, last_chunk, usage)
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            raise
+        finally:
+            span.end()
+
+    @classmethod
+    def _report_usage(cls, span, lease, model: str, response, usage: Optional[Dict[str, int]] = None):
+        input_tokens, output_tokens, cached_tokens = cls._usage(response)
+        if usage is not None:
+            usage["input"] = usage.get("input", 0) + input_tokens
+            usage["output"] = usage.get("output", 0) + output_tokens
+            usage["cached_input"] = usage.get("cached_input", 0) + cached_tokens
+        lease.report_tokens(input_tokens + output_tokens)
+        record_llm_usage(model, input_tokens, output_tokens, cached_tokens)
+        span.set_attributes({"llm.input_tokens": input_tokens, "llm.output_tokens": output_tokens, "llm.cached_input_tokens": cached_tokens})
+
+    @staticmethod
+    def _usage(response) -> Tuple[int, int, int]:
+        """usage_metadataから (入力トークン数, 出力トークン数, キャッシュ済みの入力トークン数) を取得（思考トークンは出力に含める）"""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return 0, 0, 0
+        output_tokens = (usage.candidates_token_count or 0) + (getattr(usage, "thoughts_token_count", None) or 0)
+        return usage.prompt_token_count or 0, output_tokens, getattr(usage, "cached_content_token_count", None) or 0
+
+    @staticmethod
+    def _build_config(
+        response_schema: Optional[type[BaseModel]],
+        system_instruction: Optional[str] = None,
+        cached_content: Optional[str] = None,
+        media_resolution: Optional[str] = None,
+    ) -> Optional[types.GenerateContentConfig]:
+        options = {}
+        if media_resolution:
+            options["media_resolution"] = MEDIA_RESOLUTIONS[media_resolution]
+        if response_schema is not None:
+            options.update(response_mime_type="application/json", response_schema=response_schema)
+        # キャッシュ済みコンテンツにシステム指示が含まれるため、使える場合は送信しない
+        if cached_content:
+            options["cached_content"] = cached_content
+        elif system_instruction:
+            options["system_instruction"] = system_instruction
+        if not options:
+            return None
+        return types.GenerateContentConfig(**options)
+
+    @staticmethod
+    def _build_contents(prompt: str, file_url: str, video: Optional[Dict] = None) -> types.Content:
+        return types.Content(
             parts=[
                 types.Part(
-                    file_data=types.FileData(file_uri=file_url)
+                    file_data=types.FileData(file_uri=file_url),
+                    video_metadata=GeminiClient._video_metadata(video),
                 ),
                 types.Part(text=prompt)
             ]
         )
 
-        response = self.client.models.generate_content(
-            model=self.model,
-            contents=contents,
-        )
-
-        return response.text
+    @staticmethod
+    def _video_metadata(video: Optional[Dict]) -> Optional[types.VideoMetadata]:
+        """フレームの頻度と解析範囲（指定がない場合は動画全体を既定の頻度で解析）"""
+        video = video or {}
+        options = {}
+        if video.get("fps"):
+            options["fps"] = video["fps"]
+        if video.get("start_offset"):
+            options["start_offset"] = f"{video['start_offset']:g}s"
+        if video.get("end_offset"):
+            options["end_offset"] = f"{video['end_offset']:g}s"
+        return types.VideoMetadata(**options) if options else None
 
 class GeminiService:
 
     def __init__(self):
         self.client = GeminiClient()
+        # 動画解析の候補モデル（障害時・遅延時に切り替える）
+        self.router = ModelRouter("extract", parse_models(settings.ROUTER_EXTRACT_MODELS))
 
-    def generate_content(self, file_url: str):
+    def generate_content(self, file_url: str, on_progress: Optional[Callable[[dict], None]] = None, video: Optional[Dict] = None):
         """
         Generate content using the Gemini model.
 
         Args:
             prompt (str): The prompt to send to the model.
             file_url (str): The URL of the file to be processed.
+            on_progress: Callback receiving throttled partial output while streaming.
+                Streaming is used only when LLM_STREAMING_ENABLED is set.
+            video: Per-request video options overriding the GEMINI_* settings (see video_options).
+                With adaptive, a low-resolution pass runs first and is repeated at the
+                configured resolution only when processes or ingredients come back empty.
 
         Returns:
             Response from the Gemini model.
         """
 
-        if not file_url:
-            raise ValueError("Prompt and file URL must not be empty.")
-        
-        youtube_shorts_pattern = r'^https://(www\.)?youtube\.com/shorts/[a-zA-Z0-9_-]+(\?.*)?$'
+        self._validate_url(file_url)
 
-        if not re.match(youtube_shorts_pattern, file_url):
-            raise ValueError(f"File URL must be a valid YouTube Shorts URL.: {file_url}")
-        
-        prompt = f'''あなたは料理動画を分析して、構造化されたJSONデータを出力するとても優秀なAIです。
+        prompt = RECIPE_EXTRACTION_REQUEST
+        # 構造化出力ではスキーマに沿ったJSONが返るため整形処理は不要
+        response_schema = RecipeOutput if settings.LLM_STRUCTURED_OUTPUT else None
+        usage = {}
+        if settings.LLM_STREAMING_ENABLED:
+            def run(model: str, options: Dict) -> str:
+                # 途中経過を通知しつつ、JSON構造が崩れた時点で打ち切る
+                monitor = StreamingJSONMonitor(RECIPE_SCHEMAS, on_progress, interval=settings.LLM_STREAMING_INTERVAL)
+                return monitor.consume(self.client.stream(
+                    prompt, file_url, response_schema, model=model, system_instruction=RECIPE_EXTRACTION_PROMPT, video=options, usage=usage,
+                ))
+        else:
+            def run(model: str, options: Dict) -> str:
+                return self.client.invoke(prompt, file_url, response_schema, model=model, system_instruction=RECIPE_EXTRACTION_PROMPT, video=options, usage=usage)
 
-次の動画の内容を分析して、一人分の料理として以下の**スキーマに準拠した形式**でレシピ情報を抽出してください。
-料理工程はできるだけ詳細に記述してください。
+        started = time.monotonic()
+        passes = self._passes(video_options(video))
+        for index, options in enumerate(passes):
+            # 動画の解析は時間がかかり料金も大きいため、ヘッジせずに失敗時のみ次の候補に切り替える
+            response = self.router.call(partial(run, options=options))
+            result = self._check_pass(response, response_schema, options, index == len(passes) - 1)
+            if result is not None:
+                break
+        self._report_extraction(options, index > 0, usage, time.monotonic() - started)
 
-**何があっても、以下のスキーマの形のみ出力するように絶対従ってください。**
+        return result
 
-出力形式："""
-{RECIPE_SCHEMAS}
-"""
-'''     
-        response = self.client.invoke(prompt, file_url)
+    async def agenerate_content(self, file_url: str, on_progress: Optional[Callable[[dict], None]] = None, video: Optional[Dict] = None):
+        """
+        Coroutine version of generate_content.
+
+        Args:
+            file_url (str): The URL of the file to be processed.
+            on_progress: Callback receiving throttled partial output while streaming.
+                It is called on the event loop and must not block.
+            video: Per-request video options overriding the GEMINI_* settings (see video_options).
+
+        Returns:
+            Response from the Gemini model.
+        """
+
+        self._validate_url(file_url)
+
+        prompt = RECIPE_EXTRACTION_REQUEST
+        response_schema = RecipeOutput if settings.LLM_STRUCTURED_OUTPUT else None
+        usage = {}
+        if settings.LLM_STREAMING_ENABLED:
+            async def run(model: str, options: Dict) -> str:
+                monitor = StreamingJSONMonitor(RECIPE_SCHEMAS, on_progress, interval=settings.LLM_STREAMING_INTERVAL)
+                return await monitor.aconsume(self.client.astream(
+                    prompt, file_url, response_schema, model=model, system_instruction=RECIPE_EXTRACTION_PROMPT, video=options, usage=usage,
+                ))
+        else:
+            async def run(model: str, options: Dict) -> str:
+                return await self.client.ainvoke(prompt, file_url, response_schema, model=model, system_instruction=RECIPE_EXTRACTION_PROMPT, video=options, usage=usage)
+
+        started = time.monotonic()
+        passes = self._passes(video_options(video))
+        for index, options in enumerate(passes):
+            response = await self.router.acall(partial(run, options=options))
+            result = self._check_pass(response, response_schema, options, index == len(passes) - 1)
+            if result is not None:
+                break
+        self._report_extraction(options, index > 0, usage, time.monotonic() - started)
+
+        return result
+
+    @staticmethod
+    def _passes(options: Dict) -> List[Dict]:
+        """抽出に使うオプションの順序（adaptiveの場合はlowの解像度を先に試す）"""
+        if options["adaptive"] and options["media_resolution"] != "low":
+            return [{**options, "media_resolution": "low"}, options]
+        return [options]
+
+    def _check_pass(self, response: str, response_schema: Optional[type[BaseModel]], options: Dict, final: bool) -> Optional[Dict]:
+        """抽出結果を返す。最後の抽出でなく、JSONが不正・必須項目が空の場合はNone（解像度を上げて抽出し直す）"""
+        try:
+            result = self._parse_response(response, response_schema)
+        except ValueError as e:
+            if final:
+                raise
+            logger.info(f"Escalating video resolution from {options['media_resolution']}: {str(e)}")
+            return None
+        missing = missing_recipe_fields(result)
+        if missing and not final:
+            logger.info(f"Escalating video resolution from {options['media_resolution']}: empty {', '.join(missing)}")
+            return None
+        return result
+
+    @staticmethod
+    def _report_extraction(options: Dict, escalated: bool, usage: Dict[str, int], seconds: float):
+        tokens = usage.get("input", 0) + usage.get("output", 0)
+        record_gemini_extraction(options["media_resolution"], escalated, tokens, seconds)
+        annotate_span(**{"gemini.media_resolution": options["media_resolution"] or "default", "gemini.escalated": escalated, "gemini.tokens": tokens})
+        print(f"Gemini extraction: resolution={options['media_resolution'] or 'default'} escalated={escalated} tokens={tokens} seconds={seconds:.2f}")
+
+    @staticmethod
+    def _validate_url(file_url: str):
+        if not file_url:
+            raise ValueError("Prompt and file URL must not be empty.")
+        
+        if not extract_shorts_video_id(file_url):
+            raise ValueError(f"File URL must be a valid YouTube Shorts URL.: {file_url}")
 
-        response = self.replaced2json(response)
+    def _parse_response(self, response: str, response_schema: Optional[type[BaseModel]]):
+        if response_schema is None:
+            response = self.replaced2json(response)
 
         print(f"Response: {response}")
 
@@ -92,10 +488,4 @@ class GeminiService:
             raise ValueError(f"Response is not a valid JSON format: {e}")
     
     def replaced2json(self, output: str) -> str:
-        replaced_output = output.replace('```json', '').replace('```', '')
-        # 正規表現を使って空白行（改行だけや空白のみの行）を削除
-        replaced_output = re.sub(r'^\s*\n', '', replaced_output, flags=re.MULTILINE)
-        # 正規表現を使って最後のカンマを削除
-        replaced_output = re.sub(r',\s*$', '', replaced_output)
-        # replaced_output = json.loads(replaced_output) # これを加えるとdict型になってしまう
-        return replaced_output
+        return BaseChain.replaced2json(output)
@@ -0,0 +1,61 @@
+import json
+from typing import Any, List, Literal, Optional
+
+from pydantic import BaseModel, Field, create_model
+
+from .schemas import GENRE_SCHEMAS, KEYWORD_SCHEMAS, RECIPE_ATTRIBUTES_SCHEMAS, RECIPE_SCHEMAS
+
+# JSONスキーマの型とPythonの型の対応
+JSON_SCHEMA_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": float,
+    "boolean": bool,
+}
+
+
+def schema_to_model(name: str, schema: str) -> type[BaseModel]:
+    """JSONスキーマ文字列からPydanticモデルを生成
+
+    構造化出力（Geminiのresponse_schema・Bedrockのtool-use）に渡すため、
+    プロンプトに埋め込んでいるスキーマと同じ定義からモデルを作る。
+    """
+    return _build_model(name, json.loads(schema))
+
+
+def _build_model(name: str, schema: dict) -> type[BaseModel]:
+    required = set(schema.get("required", []))
+    fields = {}
+    for field_name, field_schema in schema.get("properties", {}).items():
+        annotation = _build_type(f"{name}{_camel(field_name)}", field_schema)
+        field = Field(
+            default=... if field_name in required else None,
+            description=field_schema.get("description"),
+            min_length=field_schema.get("minItems"),
+            max_length=field_schema.get("maxItems"),
+        )
+        if field_name not in required:
+            annotation = Optional[annotation]
+        fields[field_name] = (annotation, field)
+    return create_model(name, __doc__=schema.get("description") or f"{name} structured output.", **fields)
+
+
+def _build_type(name: str, schema: dict) -> Any:
+    if "enum" in schema:
+        return Literal[tuple(schema["enum"])]
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return _build_model(name, schema)
+    if schema_type == "array":
+        return List[_build_type(f"{name}Item", schema.get("items", {}))]
+    return JSON_SCHEMA_TYPES.get(schema_type, Any)
+
+
+def _camel(value: str) -> str:
+    return "".join(part.capitalize() for part in value.split("_"))
+
+
+RecipeOutput = schema_to_model("RecipeOutput", RECIPE_SCHEMAS)
+GenreOutput = schema_to_model("GenreOutput", GENRE_SCHEMAS)
+KeywordsOutput = schema_to_model("KeywordsOutput", KEYWORD_SCHEMAS)
+RecipeAttributesOutput = schema_to_model("RecipeAttributesOutput", RECIPE_ATTRIBUTES_SCHEMAS)
@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import logging
+from typing import Optional
+
+import google.genai as genai
+import redis
+from google.genai import types
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def cacheable_prompt(instructions: str, user_template: str) -> ChatPromptTemplate:
+    """変化しない指示・スキーマをシステムプロンプト、レシピごとの入力をユーザーメッセージにしたテンプレートを作成
+
+    システムプロンプトはテンプレートとして解釈しないため、スキーマの波括弧はエスケープ不要。
+    BEDROCK_PROMPT_CACHE_ENABLEDが有効な場合は、システムプロンプトの後にキャッシュポイントを置き、
+    2回目以降の呼び出しではプレフィックスをキャッシュから読み込ませる。
+    """
+    if settings.BEDROCK_PROMPT_CACHE_ENABLED:
+        system = SystemMessage(content=[{"type": "text", "text": instructions}, {"cachePoint": {"type": "default"}}])
+    else:
+        system = SystemMessage(content=instructions)
+    return ChatPromptTemplate.from_messages([system, HumanMessagePromptTemplate.from_template(user_template)])
+
+
+def prompt_text(prompt: ChatPromptTemplate) -> str:
+    """テンプレートのシステムプロンプトとユーザーメッセージのテンプレートの本文（キャッシュポイントの有無によらない）"""
+    texts = []
+    for message in prompt.messages:
+        if isinstance(message, SystemMessage):
+            content = message.content
+            if isinstance(content, list):
+                content = "".join(block.get("text", "") for block in content if isinstance(block, dict))
+            texts.append(content)
+        else:
+            texts.append(message.prompt.template)
+    return "\n".join(texts)
+
+
+class GeminiContextCache:
+    """システム指示をGeminiのキャッシュ済みコンテンツとして作成し、名前をRedisで全ワーカーと共有するクラス
+
+    キャッシュ済みコンテンツはモデルごとに作成する。作成に失敗した場合（最小トークン数に満たない・
+    モデルが非対応など）は一定時間作成を試みず、呼び出し側はシステム指示をそのまま送信する。
+    Redisに接続できない場合もキャッシュを使わずに呼び出す。
+    """
+
+    KEY_PREFIX = "gemini_context_cache"
+    # 作成に失敗した場合に再作成を試みるまでの秒数
+    FAILURE_TTL = 600
+    # 期限切れの直前に取得した名前で呼び出さないよう、有効期限より早く共有をやめる秒数
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, client: genai.Client, redis_client=None, ttl: Optional[int] = None):
+        self.client = client
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.ttl = ttl or settings.GEMINI_CONTEXT_CACHE_TTL
+
+    def get(self, model: str, system_instruction: str) -> Optional[str]:
+        """キャッシュ済みコンテンツの名前を取得（なければ作成）。使えない場合はNone"""
+        key = self._key(model, system_instruction)
+        name, known = self._lookup(key)
+        if known:
+            return name
+        try:
+            cached = self.client.caches.create(model=model, config=self._config(system_instruction))
+        except Exception as e:
+            return self._store_failure(key, model, e)
+        return self._store(key, cached.name)
+
+    async def aget(self, model: str, system_instruction: str) -> Optional[str]:
+        """getのコルーチン版（Redisへの問い合わせはスレッドプールで行う）"""
+        key = self._key(model, system_instruction)
+        name, known = await asyncio.to_thread(self._lookup, key)
+        if known:
+            return name
+        try:
+            cached = await self.client.aio.caches.create(model=model, config=self._config(system_instruction))
+        except Exception as e:
+            return await asyncio.to_thread(self._store_failure, key, model, e)
+        return await asyncio.to_thread(self._store, key, cached.name)
+
+    def _lookup(self, key: str):
+        """(名前, 判定済みか) を返す。作成に失敗した記録がある場合とRedisに接続できない場合は (None, True)"""
+        try:
+            value = self.redis_client.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Gemini context cache unavailable: {str(e)}")
+            return None, True
+        if value is None:
+            return None, False
+        return (value or None), True
+
+    def _store(self, key: str, name: str) -> str:
+        try:
+            # 同時に作成した場合は先に登録された名前を使う（重複したキャッシュは期限切れで消える）
+            if not self.redis_client.set(key, name, nx=True, ex=max(self.ttl - self.EXPIRY_MARGIN, 1)):
+                name = self.redis_client.get(key) or name
+        except redis.RedisError as e:
+            logger.warning(f"Gemini context cache unavailable: {str(e)}")
+        return name
+
+    def _store_failure(self, key: str, model: str, error: Exception) -> None:
+        logger.warning(f"Gemini context cache creation failed ({model}): {str(error)}")
+        try:
+            self.redis_client.set(key, "", ex=self.FAILURE_TTL)
+        except redis.RedisError:
+            pass
+        return None
+
+    def _config(self, system_instruction: str) -> types.CreateCachedContentConfig:
+        return types.CreateCachedContentConfig(
+            system_instruction=system_instruction,
+            ttl=f"{self.ttl}s",
+            display_name="recipe-extraction",
+        )
+
+    def _key(self, model: str, system_instruction: str) -> str:
+        digest = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()[:16]
+        return f"{self.KEY_PREFIX}:{model}:{digest}"
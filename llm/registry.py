@@ -0,0 +1,108 @@
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from config import settings
+
+from .bedrock import BedrockEmbeddingsService, BedrockService
+from .errors import CREDENTIAL_ERROR_MARKERS
+from .gemini import GeminiService
+
+
+class ServiceRegistry:
+    """ワーカープロセス単位でLLMサービスを保持するレジストリ
+
+    サービスの生成時にはgenai.Client・ChatBedrock・BedrockEmbeddingsが作られ、
+    boto3セッションの作成や認証情報の読み込み、HTTPコネクションプールの確保が発生する。
+    一度生成したサービスをタスク間で再利用し、TTL経過時または認証エラー時にのみ再生成する。
+    """
+
+    def __init__(self, ttl: float = 0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._hits = {}
+        self._misses = {}
+
+    def get(self, name: str, factory: Callable[[], Any]) -> Any:
+        """サービスを取得（未生成またはTTL切れの場合は生成）"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and not self._is_expired(entry):
+                self._hits[name] = self._hits.get(name, 0) + 1
+                return entry["instance"]
+            self._misses[name] = self._misses.get(name, 0) + 1
+            instance = factory()
+            self._entries[name] = {
+                "instance": instance,
+                "created_at": time.monotonic(),
+            }
+            return instance
+
+    def invalidate(self, name: Optional[str] = None):
+        """サービスを破棄して次回取得時に再生成させる（name未指定の場合は全て）"""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+    def invalidate_if_credential_error(self, error: Exception) -> bool:
+        """認証情報の失効によるエラーであれば全サービスを破棄"""
+        message = f"{type(error).__name__}: {error}"
+        if not any(marker in message for marker in CREDENTIAL_ERROR_MARKERS):
+            return False
+        self.invalidate()
+        return True
+
+    def reset(self):
+        """サービスと統計情報を初期化（fork後の子プロセスで使用）"""
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._hits = {}
+        self._misses = {}
+
+    def stats(self) -> dict:
+        """サービスごとのヒット数・ミス数を取得"""
+        with self._lock:
+            names = set(self._hits) | set(self._misses)
+            return {
+                name: {
+                    "hits": self._hits.get(name, 0),
+                    "misses": self._misses.get(name, 0),
+                    "cached": name in self._entries,
+                }
+                for name in sorted(names)
+            }
+
+    def _is_expired(self, entry: dict) -> bool:
+        if self.ttl <= 0:
+            return False
+        return time.monotonic() - entry["created_at"] >= self.ttl
+
+
+service_registry = ServiceRegistry(ttl=settings.SERVICE_REGISTRY_TTL)
+
+
+def get_gemini_service() -> GeminiService:
+    """プロセス共有のGeminiServiceを取得"""
+    return service_registry.get("gemini", GeminiService)
+
+
+def get_bedrock_service() -> BedrockService:
+    """プロセス共有のBedrockServiceを取得"""
+    return service_registry.get("bedrock", BedrockService)
+
+
+def get_bedrock_embeddings_service(model_id: Optional[str] = None) -> BedrockEmbeddingsService:
+    """プロセス共有のBedrockEmbeddingsServiceを取得（model_id指定時は設定値以外のモデル用のサービス）"""
+    if model_id is None or model_id == settings.EMBEDDING_MODEL_ID:
+        return service_registry.get("bedrock_embeddings", BedrockEmbeddingsService)
+    return service_registry.get(f"bedrock_embeddings:{model_id}", lambda: BedrockEmbeddingsService(model_id))
+
+
+def warm_up_services():
+    """全サービスを事前に生成"""
+    get_gemini_service()
+    get_bedrock_service()
+    get_bedrock_embeddings_service()
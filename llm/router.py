@@ -0,0 +1,227 @@
+import asyncio
+import contextvars
+import logging
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import redis
+
+from config import settings
+from utils.metrics import record_llm_call
+
+from .errors import PERMANENT, classify_error
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def parse_models(value: str) -> List[str]:
+    """カンマ区切りのモデル一覧を分割"""
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+class ModelStats:
+    """モデルごとの直近の呼び出し結果（レイテンシ・成否）をRedisに保持するクラス
+
+    全ワーカーPodの結果を共有し、直近window件からp95レイテンシとエラー率を算出する。
+    Redisに接続できない場合は記録せず、全モデルを結果なしとして扱う。
+    """
+
+    KEY_PREFIX = "llm_route"
+
+    def __init__(self, redis_client=None, window: Optional[int] = None):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.window = window or settings.ROUTER_STATS_WINDOW
+
+    def record(self, model: str, latency: float, ok: bool):
+        try:
+            key = self._key(model)
+            pipe = self.redis_client.pipeline()
+            pipe.lpush(key, f"{latency:.3f}:{int(ok)}")
+            pipe.ltrim(key, 0, self.window - 1)
+            pipe.expire(key, 86400)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Model stats record failed ({model}): {str(e)}")
+
+    def summary(self, models: List[str]) -> Dict[str, Dict]:
+        """モデルごとの件数・p95レイテンシ（成功分のみ）・エラー率"""
+        try:
+            pipe = self.redis_client.pipeline()
+            for model in models:
+                pipe.lrange(self._key(model), 0, -1)
+            samples_list = pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Model stats unavailable: {str(e)}")
+            samples_list = [[] for _ in models]
+
+        summary = {}
+        for model, samples in zip(models, samples_list):
+            latencies = []
+            errors = 0
+            for sample in samples:
+                latency, ok = sample.rsplit(":", 1)
+                if ok == "1":
+                    latencies.append(float(latency))
+                else:
+                    errors += 1
+            latencies.sort()
+            summary[model] = {
+                "samples": len(samples),
+                "p95": latencies[max(math.ceil(len(latencies) * 0.95) - 1, 0)] if latencies else None,
+                "error_rate": errors / len(samples) if samples else 0.0,
+            }
+        return summary
+
+    def _key(self, model: str) -> str:
+        return f"{self.KEY_PREFIX}:{model}:samples"
+
+
+class ModelRouter:
+    """ステップごとの候補モデルから、健全で最も速いモデルに振り分けるクラス
+
+    候補は設定順を初期の優先順位とし、結果が集まったモデルはp95レイテンシの小さい順に並べ替える。
+    直近のエラー率が閾値を超えたモデルは後回しにする。呼び出しが一時的なエラー・スロットリングで
+    失敗した場合は次の候補で再実行し、入力の誤りなど再試行しても解消しないエラーはそのまま送出する。
+
+    Args:
+        step: ステップ名（ログ用）
+        candidates: 候補モデル（先頭ほど優先）
+        stats: レイテンシ・エラー率の記録先
+        hedge_after: call_hedgedで次の候補にも投げるまでの秒数（0以下で無効）
+    """
+
+    def __init__(
+        self,
+        step: str,
+        candidates: List[str],
+        stats: Optional[ModelStats] = None,
+        hedge_after: Optional[float] = None,
+    ):
+        if not candidates:
+            raise ValueError(f"{step} の候補モデルが指定されていません")
+        self.step = step
+        self.candidates = candidates
+        self.stats = stats or ModelStats()
+        self.hedge_after = settings.ROUTER_HEDGE_AFTER if hedge_after is None else hedge_after
+        self._executor = None
+
+    def ranked(self) -> List[str]:
+        """呼び出す順に並べた候補モデル"""
+        if len(self.candidates) == 1:
+            return list(self.candidates)
+        summary = self.stats.summary(self.candidates)
+
+        def sort_key(indexed):
+            index, model = indexed
+            stats = summary[model]
+            unhealthy = stats["samples"] >= settings.ROUTER_MIN_SAMPLES and stats["error_rate"] > settings.ROUTER_MAX_ERROR_RATE
+            p95 = stats["p95"] if stats["p95"] is not None else math.inf
+            return (unhealthy, p95, index)
+
+        return [model for _, model in sorted(enumerate(self.candidates), key=sort_key)]
+
+    def call(self, fn: Callable[[str], T]) -> T:
+        """候補モデルを順に試し、最初に成功した結果を返す"""
+        last_error = None
+        for model in self.ranked():
+            try:
+                return self._timed(fn, model)
+            except Exception as e:
+                if classify_error(e) == PERMANENT:
+                    raise
+                logger.warning(f"Model failover ({self.step}): {model} failed: {str(e)}")
+                last_error = e
+        raise last_error
+
+    async def acall(self, fn: Callable[[str], Awaitable[T]]) -> T:
+        """callのコルーチン版（fnはモデルを受け取りコルーチンを返す）
+
+        Redisでの統計の参照・記録はスレッドプールで行い、イベントループをブロックしない。
+        """
+        last_error = None
+        for model in await asyncio.to_thread(self.ranked):
+            try:
+                return await self._atimed(fn, model)
+            except Exception as e:
+                if classify_error(e) == PERMANENT:
+                    raise
+                logger.warning(f"Model failover ({self.step}): {model} failed: {str(e)}")
+                last_error = e
+        raise last_error
+
+    def call_hedged(self, fn: Callable[[str], T]) -> T:
+        """先に呼び出したモデルがhedge_after秒以内に応答しなければ次の候補にも投げ、先に成功した結果を返す
+
+        遅れて完了した呼び出しの結果は破棄する（レイテンシ・エラー率の記録には使う）。
+        """
+        models = self.ranked()
+        if self.hedge_after <= 0 or len(models) < 2:
+            return self.call(fn)
+
+        executor = self._get_executor()
+        pending: Dict[Future, str] = {}
+
+        def launch():
+            model = models.pop(0)
+            pending[executor.submit(contextvars.copy_context().run, self._timed, fn, model)] = model
+
+        launch()
+        last_error = None
+        while pending:
+            done, _ = wait(pending, timeout=self.hedge_after if models else None, return_when=FIRST_COMPLETED)
+            if not done:
+                logger.info(f"Hedging ({self.step}): no response within {self.hedge_after}s, trying {models[0]}")
+                launch()
+                continue
+            for future in done:
+                model = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    if classify_error(e) == PERMANENT:
+                        raise
+                    logger.warning(f"Model failover ({self.step}): {model} failed: {str(e)}")
+                    last_error = e
+            if not pending and models:
+                launch()
+        raise last_error
+
+    def _timed(self, fn: Callable[[str], T], model: str) -> T:
+        started = time.monotonic()
+        try:
+            result = fn(model)
+        except Exception as e:
+            elapsed = time.monotonic() - started
+            record_llm_call(self.step, model, elapsed, ok=False)
+            # 入力の誤りによる失敗はモデルの健全性に含めない
+            if classify_error(e) != PERMANENT:
+                self.stats.record(model, elapsed, False)
+            raise
+        elapsed = time.monotonic() - started
+        record_llm_call(self.step, model, elapsed, ok=True)
+        self.stats.record(model, elapsed, True)
+        return result
+
+    async def _atimed(self, fn: Callable[[str], Awaitable[T]], model: str) -> T:
+        started = time.monotonic()
+        try:
+            result = await fn(model)
+        except Exception as e:
+            elapsed = time.monotonic() - started
+            record_llm_call(self.step, model, elapsed, ok=False)
+            if classify_error(e) != PERMANENT:
+                await asyncio.to_thread(self.stats.record, model, elapsed, False)
+            raise
+        elapsed = time.monotonic() - started
+        record_llm_call(self.step, model, elapsed, ok=True)
+        await asyncio.to_thread(self.stats.record, model, elapsed, True)
+        return result
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.candidates) * 4, thread_name_prefix=f"hedge-{self.step}")
+        return self._executor
@@ -87,4 +87,29 @@ KEYWORD_SCHEMAS = """{
             "description": "A list of keywords related to the recipe."
         }
     }
-}"""
\ No newline at end of file
+}"""
+
+RECIPE_ATTRIBUTES_SCHEMAS = """{
+    "type": "object",
+    "required": ["genre", "recipe_name", "keywords"],
+    "properties": {
+        "genre": {
+            "type": "string",
+            "enum": ["和食", "洋食", "中華", "韓国風", "エスニック", "スイーツ", "その他"],
+            "description": "The genre of the recipe."
+        },
+        "recipe_name": {
+            "type": "string",
+            "description": "The title of the recipe."
+        },
+        "keywords": {
+            "type": "array",
+            "minItems": 1,
+            "maxItems": 5,
+            "items": {
+                "type": "string"
+            },
+            "description": "A list of keywords related to the recipe."
+        }
+    }
+}"""
@@ -0,0 +1,91 @@
+import json
+import re
+import time
+from typing import AsyncIterable, Callable, Iterable, Optional
+
+from langchain_core.utils.json import parse_partial_json
+
+
+class StreamingJSONMonitor:
+    """ストリーミング出力を逐次JSONとして解析し、部分結果を間引いて通知するクラス
+
+    チャンクを受け取るたびに途中までの出力を部分JSONとして解析し、
+    オブジェクトでない・スキーマにないキーを含むなど構造が崩れていれば、その時点で生成を打ち切る。
+
+    Args:
+        schema: 出力が従うJSONスキーマ文字列（トップレベルのキーを検証に使用）
+        on_progress: 部分結果を受け取るコールバック
+        interval: コールバックを呼び出す最小間隔（秒）
+    """
+
+    def __init__(self, schema: str, on_progress: Optional[Callable[[dict], None]] = None, interval: float = 0.25):
+        self.expected_keys = set(json.loads(schema).get("properties", {}).keys())
+        self.on_progress = on_progress
+        self.interval = interval
+        self.chunks = []
+        self.received_chars = 0
+        self.partial = None
+        self._last_notified = 0.0
+
+    @property
+    def text(self) -> str:
+        """これまでに受信した出力全体"""
+        return "".join(self.chunks)
+
+    def feed(self, chunk: str):
+        """チャンクを追加して構造を検証し、必要に応じて進捗を通知"""
+        if not chunk:
+            return
+        self.chunks.append(chunk)
+        self.received_chars += len(chunk)
+        self._validate()
+
+        now = time.monotonic()
+        if self.on_progress and now - self._last_notified >= self.interval:
+            self._last_notified = now
+            self.on_progress({
+                "received_chars": self.received_chars,
+                "partial": self.partial,
+            })
+
+    def consume(self, chunks: Iterable[str]) -> str:
+        """チャンクのイテレータを最後まで読み込み、出力全体を返す"""
+        for chunk in chunks:
+            self.feed(chunk)
+        return self.text
+
+    async def aconsume(self, chunks: AsyncIterable[str]) -> str:
+        """非同期イテレータのチャンクを最後まで読み込み、出力全体を返す"""
+        async for chunk in chunks:
+            self.feed(chunk)
+        return self.text
+
+    def _validate(self):
+        # コードフェンスの受信途中は判定を保留する
+        if "```json".startswith(self.text.strip()):
+            return
+        body = self._strip_fence(self.text)
+        if not body:
+            return
+        if not body.startswith("{"):
+            raise ValueError(f"ストリーミング出力がJSONオブジェクトではありません: {body[:50]}")
+        try:
+            partial = parse_partial_json(body)
+        except json.JSONDecodeError:
+            # 閉じ括弧の補完で解析できない途中状態は次のチャンクを待つ
+            return
+        if partial is None:
+            return
+        if not isinstance(partial, dict):
+            raise ValueError("ストリーミング出力がJSONオブジェクトではありません")
+        for key in partial:
+            # 受信途中のキー名は前方一致で許容する
+            if key not in self.expected_keys and not any(expected.startswith(key) for expected in self.expected_keys):
+                raise ValueError(f"ストリーミング出力にスキーマ外のキーが含まれています: {key}")
+        self.partial = partial
+
+    @staticmethod
+    def _strip_fence(text: str) -> str:
+        body = text.lstrip()
+        body = re.sub(r'^```(json)?', '', body)
+        return body.lstrip()
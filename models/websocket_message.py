@@ -1,8 +1,18 @@
+import struct
 from datetime import datetime
-from typing import Any, Optional
+from typing import Any, Optional, Union
 
+import msgpack
 from pydantic import BaseModel
 
+# Wire format versions: 1 is JSON text (the original format), 2 is msgpack binary
+JSON_VERSION = 1
+BINARY_VERSION = 2
+# Subprotocol a backend selects during the handshake to receive version 2 frames
+BINARY_SUBPROTOCOL = "recipe-gen.msgpack.v2"
+# Little-endian struct codes for the packed embedding
+EMBEDDING_FORMATS = {"float32": "f", "float16": "e"}
+
 
 class WebSocketMessage(BaseModel):
     """
@@ -12,6 +22,47 @@ class WebSocketMessage(BaseModel):
     data: dict[str, Any]  # Task-specific data
     session_id: str  # Session identifier
     timestamp: datetime  # Message timestamp
+    traceparent: Optional[str] = None  # W3C trace context of the task that sent the message
+    version: int = JSON_VERSION  # Wire format version (consumers that ignore it keep reading JSON)
+
+    def encode(self, subprotocol: Optional[str] = None, embedding_dtype: str = "float32") -> Union[str, bytes]:
+        """
+        Serialize for the subprotocol negotiated on the connection
+
+        Without the binary subprotocol the message is sent as JSON text, unchanged from version 1.
+        With it, the message is a msgpack map and an embedding list in data is packed as
+        little-endian float32/float16 bytes with its dtype alongside.
+        """
+        if subprotocol != BINARY_SUBPROTOCOL:
+            return self.model_dump_json()
+        data = dict(self.data)
+        embedding = data.get("embedding")
+        if isinstance(embedding, list):
+            code = EMBEDDING_FORMATS[embedding_dtype]
+            data["embedding"] = struct.pack(f"<{len(embedding)}{code}", *embedding)
+            data["embedding_dtype"] = embedding_dtype
+        return msgpack.packb({
+            "version": BINARY_VERSION,
+            "type": self.type,
+            "data": data,
+            "session_id": self.session_id,
+            "timestamp": self.timestamp.isoformat(),
+            "traceparent": self.traceparent,
+        }, use_bin_type=True, default=str)
+
+    @classmethod
+    def decode(cls, payload: Union[str, bytes]) -> "WebSocketMessage":
+        """Parse a frame in either wire format (JSON text or msgpack binary)"""
+        if isinstance(payload, str):
+            return cls.model_validate_json(payload)
+        fields = msgpack.unpackb(payload, raw=False)
+        data = fields.get("data") or {}
+        embedding = data.get("embedding")
+        if isinstance(embedding, bytes):
+            dtype = data.pop("embedding_dtype", "float32")
+            code = EMBEDDING_FORMATS[dtype]
+            data["embedding"] = list(struct.unpack(f"<{len(embedding) // struct.calcsize(code)}{code}", embedding))
+        return cls(**fields)
     
     @classmethod
     def task_started(cls, session_id: str, data: Optional[dict] = None) -> "WebSocketMessage":
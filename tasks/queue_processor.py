@@ -2,55 +2,590 @@
 Redis の task:recipe_gen_* キーを監視してシンプルにprintする処理
 WebSocket通信でリアルタイム進捗を送信
 """
+import asyncio
 import logging
-from datetime import datetime
-from typing import Dict, List
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
 
 import redis
+from celery import chain, chord
+from celery.signals import before_task_publish, task_failure, task_postrun, task_prerun, worker_init, worker_process_init, worker_process_shutdown, worker_ready
 
 from celery_app import app
 from config import settings
-from llm.bedrock import BedrockEmbeddingsService, BedrockService
-from llm.gemini import GeminiService
+from llm.errors import PERMANENT, classify_error
+from llm.registry import get_bedrock_embeddings_service, get_bedrock_service, get_gemini_service, service_registry, warm_up_services
+from utils.broker import BROKER_TRANSPORT_OPTIONS, find_misrouted_queue_keys
+from utils.checkpoint import PipelineCheckpoint
+from utils.circuit_breaker import get_circuit_breaker
+from utils.event_loop import BoundedCoroutineRunner
 from utils.llm import transform_recipe_data
-from utils.websocket_client import send_task_completed_sync, send_task_failed_sync, send_task_progress_sync, send_task_started_sync
+from utils.metrics import mark_process_dead, record_queue_wait, record_task, start_metrics_server, track_step
+from utils.priority import PRIORITY_LEVELS, PriorityLatencyRecorder, parse_created_at, resolve_priority
+from utils.recipe_cache import RecipeResultCache, pipeline_version, video_variant
+from utils.retry import RetryMetrics, retry_countdown
+from utils.single_flight import SingleFlight
+from utils.task_results import task_result
+from utils.tracing import end_task_span, init_tracing, inject_context, record_task_error, shutdown_tracing, start_task_span
+from utils.websocket_client import flush_pending_messages, send_task_completed_sync, send_task_failed_sync, send_task_progress_async, send_task_progress_sync, send_task_started_sync
+from utils.youtube import extract_shorts_video_id
 
 logger = logging.getLogger(__name__)
 
+# embedding_modelを記録する前にキャッシュされた生成結果のembeddingのモデル
+LEGACY_EMBEDDING_MODEL = "amazon.titan-embed-text-v1"
+
+# 並列生成する各属性の進捗通知内容
+ATTRIBUTE_STEPS = {
+    "genre": {"content": "レシピのジャンルを分類中...", "type": 4},
+    "recipe_name": {"content": "レシピ名を生成中...", "type": 5},
+    "keywords": {"content": "レシピのキーワードを生成中...", "type": 6},
+}
+
+# ストリーミング中の部分出力の進捗通知のtype（ステップの完了を表す1〜6とは別の値）
+STREAM_PROGRESS_TYPES = {
+    "gemini": 7,
+    "rewrite": 8,
+}
+
+# PIPELINE_MODE=async でパイプラインを並行実行するプロセス共通のイベントループ（初回実行時に起動）
+pipeline_runner = BoundedCoroutineRunner(
+    "pipeline-loop",
+    max_in_flight=settings.ASYNC_PIPELINE_MAX_IN_FLIGHT,
+    executor_workers=settings.ASYNC_PIPELINE_EXECUTOR_WORKERS,
+)
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """ワーカープロセス起動時にLLMサービスを生成（親プロセスから引き継いだ状態は破棄）"""
+    service_registry.reset()
+    try:
+        init_tracing()
+    except Exception as e:
+        logger.error(f"Tracing initialization failed: {str(e)}")
+    try:
+        warm_up_services()
+        logger.info("LLM services initialized for worker process")
+    except Exception as e:
+        # 初期化に失敗してもタスク実行時に再度生成を試みる
+        logger.error(f"LLM service warm-up failed: {str(e)}")
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """ワーカープロセス終了時にサービスの利用状況を出力"""
+    logger.info(f"Service registry stats: {service_registry.stats()}")
+    mark_process_dead(os.getpid())
+    pipeline_runner.event_loop.stop()
+    shutdown_tracing()
+
+
+@worker_init.connect
+def start_worker_metrics(**kwargs):
+    """ワーカーのメインプロセスでPrometheusメトリクスを公開"""
+    if not settings.METRICS_ENABLED:
+        return
+    try:
+        start_metrics_server()
+    except OSError as e:
+        logger.error(f"Failed to start metrics server: {str(e)}")
+
+
+@worker_ready.connect
+def check_producer_transport_options(**kwargs):
+    """送信側がkombuの既定のsepでタスクを送信していないかを確認
+
+    sepが異なるとメッセージは別のキーに入り、このワーカーでは受信されない。
+    """
+    queues = {route["queue"] for route in app.conf.task_routes.values()}
+    try:
+        client = redis.from_url(settings.CELERY_BROCKER_URL)
+        misrouted = find_misrouted_queue_keys(client, queues)
+    except redis.RedisError as e:
+        logger.warning(f"Broker key check failed: {str(e)}")
+        return
+    if misrouted:
+        logger.error(
+            f"Messages published with kombu's default separator will not be consumed: {misrouted}. "
+            f"Configure the producer with broker_transport_options={BROKER_TRANSPORT_OPTIONS}"
+        )
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    """キュー待ち時間の計測用に送信時刻を、トレースの親子関係のためにトレースコンテキストをヘッダーに付与"""
+    if headers is not None:
+        headers["published_at"] = time.time()
+        inject_context(headers)
+
+
+@task_prerun.connect
+def record_task_started(task=None, **kwargs):
+    """タスクのスパンを開始し、送信時刻（ETA指定時はETA）からタスク開始までの待ち時間を記録"""
+    start_task_span(task)
+    task.request.metrics_started_at = time.monotonic()
+    published_at = getattr(task.request, "published_at", None)
+    if published_at is None:
+        return
+    eta = task.request.eta
+    if eta:
+        published_at = max(published_at, datetime.fromisoformat(eta).timestamp())
+    record_queue_wait(task.name, time.time() - published_at)
+
+
+@task_failure.connect
+def record_task_failure(sender=None, exception=None, **kwargs):
+    record_task_error(sender, exception)
+
+
+@task_postrun.connect
+def record_task_finished(task=None, state=None, **kwargs):
+    started_at = getattr(task.request, "metrics_started_at", None)
+    if started_at is not None:
+        record_task(task.name, time.monotonic() - started_at, state or "UNKNOWN")
+    end_task_span(task, state)
+
+
+@task_postrun.connect
+def flush_websocket_messages(**kwargs):
+    """タスク終了時に未送信の進捗通知を配信しきる"""
+    if not flush_pending_messages():
+        logger.warning("Some WebSocket messages were not delivered before task end")
+
 
 class SimpleQueueProcessor:
-    """Redis task キーを監視・処理するシンプルなクラス"""
+    """Redis task キーを監視・処理するシンプルなクラス
+
+    タスクの検出方式は TASK_DISCOVERY_MODE で切り替える。
+    - scan: SCAN でキーを少しずつ走査し、HGETALL をパイプラインでまとめて実行（KEYS のように Redis をブロックしない）
+    - index: プロデューサーが登録するソート済みセットから取得（キー空間の大きさに依存しない）
+    - stream: プロデューサーが追加する Redis Stream をコンシューマーグループで読み込む（処理後に確認応答する）
+    """
+
+    TASK_KEY_PATTERN = "task:recipe_gen_*"
+    INDEX_KEY = "task:recipe_gen:index"
+    STREAM_KEY = "task:recipe_gen:stream"
+    CONSUMER_GROUP = "recipe-worker"
     
     def __init__(self):
         self.redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.mode = settings.TASK_DISCOVERY_MODE
+        self.batch_size = settings.TASK_SCAN_BATCH_SIZE
+        self.limit = settings.TASK_SCAN_LIMIT
+        # streamモードで取得し、まだ確認応答していないエントリ
+        self.pending_entry_ids: List[str] = []
     
     def find_recipe_tasks(self) -> List[Dict]:
-        """task:recipe_gen_* パターンのキーを検索"""
+        """task:recipe_gen_* のタスクを検索"""
         try:
-            # recipe_gen で始まるタスクキーを検索
-            task_keys = self.redis_client.keys("task:recipe_gen_*")
-            tasks = []
+            if self.mode == "index":
+                task_keys = self._keys_from_index()
+            elif self.mode == "stream":
+                task_keys = self._keys_from_stream()
+            else:
+                task_keys = self._keys_from_scan()
+            return self._sort_by_priority(self._fetch_tasks(task_keys))
             
-            for task_key in task_keys:
-                # Redisハッシュからデータを取得
-                task_data = self.redis_client.hgetall(task_key)
+        except Exception as e:
+            logger.error(f"タスク検索エラー: {str(e)}")
+            # 確認応答せず、次のスキャンで取り直す
+            self.pending_entry_ids = []
+            return []
+
+    def _keys_from_scan(self) -> List[str]:
+        """SCAN のカーソルで走査し、上限件数に達したら打ち切る"""
+        task_keys = []
+        for task_key in self.redis_client.scan_iter(match=self.TASK_KEY_PATTERN, count=self.batch_size, _type="hash"):
+            task_keys.append(task_key)
+            if len(task_keys) >= self.limit:
+                break
+        return task_keys
+
+    def _keys_from_index(self) -> List[str]:
+        """ソート済みセット（スコアは登録時刻など）の先頭から取得"""
+        return self.redis_client.zrange(self.INDEX_KEY, 0, self.limit - 1)
+
+    def _keys_from_stream(self) -> List[str]:
+        """コンシューマーグループで未読のエントリと、確認応答されずに残ったエントリを取得
+
+        確認応答はタスクを処理した後に acknowledge() で行う。
+        """
+        try:
+            self.redis_client.xgroup_create(self.STREAM_KEY, self.CONSUMER_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            # グループ作成済み
+            if "BUSYGROUP" not in str(e):
+                raise
+        consumer = f"scanner-{socket.gethostname()}"
+        # 処理中に落ちたスキャンのエントリを取り直す
+        _, entries, _ = self.redis_client.xautoclaim(
+            self.STREAM_KEY, self.CONSUMER_GROUP, consumer,
+            min_idle_time=settings.TASK_STREAM_CLAIM_IDLE_MS, start_id="0-0", count=self.limit,
+        )
+        remaining = self.limit - len(entries)
+        if remaining > 0:
+            response = self.redis_client.xreadgroup(self.CONSUMER_GROUP, consumer, {self.STREAM_KEY: ">"}, count=remaining)
+            for _, new_entries in response or []:
+                entries.extend(new_entries)
+        task_keys = []
+        for entry_id, fields in entries:
+            self.pending_entry_ids.append(entry_id)
+            if fields.get("key"):
+                task_keys.append(fields["key"])
+        return task_keys
+
+    def acknowledge(self):
+        """streamモードで取得したエントリを確認応答し、Streamを一定の件数に切り詰める
+
+        タスクを処理し終えてから呼び出す。呼び出す前に落ちたエントリは次のスキャンで取り直される。
+        """
+        if not self.pending_entry_ids:
+            return
+        pipe = self.redis_client.pipeline()
+        pipe.xack(self.STREAM_KEY, self.CONSUMER_GROUP, *self.pending_entry_ids)
+        pipe.xtrim(self.STREAM_KEY, maxlen=settings.TASK_STREAM_MAXLEN, approximate=True)
+        pipe.execute()
+        self.pending_entry_ids = []
+
+    def _fetch_tasks(self, task_keys: List[str]) -> List[Dict]:
+        """HGETALL をバッチごとにパイプラインで実行"""
+        tasks = []
+        stale_keys = []
+        for i in range(0, len(task_keys), self.batch_size):
+            batch = task_keys[i:i + self.batch_size]
+            pipe = self.redis_client.pipeline(transaction=False)
+            for task_key in batch:
+                pipe.hgetall(task_key)
+            for task_key, task_data in zip(batch, pipe.execute()):
                 if task_data:
                     tasks.append({
                         "key": task_key,
                         "data": task_data
                     })
-            
-            return tasks
-            
-        except Exception as e:
-            logger.error(f"タスク検索エラー: {str(e)}")
-            return []
+                else:
+                    stale_keys.append(task_key)
+        # 削除済みタスクはインデックスからも取り除く
+        if self.mode == "index" and stale_keys:
+            self.redis_client.zrem(self.INDEX_KEY, *stale_keys)
+        return tasks
+
+    @staticmethod
+    def _sort_by_priority(tasks: List[Dict]) -> List[Dict]:
+        """ブローカーと同じく優先度の高い順、同じ優先度では作成日時の古い順に並べる"""
+        def sort_key(task):
+            created_at = parse_created_at(task["data"].get("created_at"))
+            return (
+                resolve_priority(task["data"]),
+                created_at or datetime.max.replace(tzinfo=timezone.utc),
+            )
+        return sorted(tasks, key=sort_key)
+
+
+def submit_recipe_generation(session_id: str, url: str, user_id: int, metadata: Dict = None):
+    """metadata["priority"]をメッセージ優先度にしてレシピ生成タスクを登録
+
+    優先度はブローカーに登録する時点でしか指定できないため、
+    FastAPI側もこの関数（または同じ優先度の変換）を使ってタスクを送信する。
+    送信側のCeleryはutils.broker.BROKER_TRANSPORT_OPTIONSをbroker_transport_optionsに設定する必要がある。
+    優先度を指定せずに送信したタスクはnormalとして扱われる。
+    """
+    return process_recipe_generation_task.apply_async(
+        args=(session_id, url, user_id, metadata),
+        priority=resolve_priority(metadata),
+    )
+
+
+def queue_wait_seconds(metadata: Optional[Dict]) -> Optional[float]:
+    """metadataのcreated_atからタスク開始までの待ち時間を算出"""
+    created_at = parse_created_at((metadata or {}).get("created_at"))
+    if created_at is None:
+        return None
+    return max((datetime.now(timezone.utc) - created_at).total_seconds(), 0.0)
+
+
+class _ExtractRecipe:
+    """Geminiで動画からレシピを抽出する（部分出力はstream_type・progress・contentの進捗として送信）"""
+
+    def __init__(self, stream_type: int, progress: int, content: str):
+        self.stream_type = stream_type
+        self.progress = progress
+        self.content = content
+
+
+class _CallService:
+    """同期APIしかないBedrockのサービスを呼び出す"""
+
+    def __init__(self, step: str, func: Callable, args: tuple):
+        self.step = step
+        self.func = func
+        self.args = args
+
+
+class _SendProgress:
+    """進捗をWebSocketで送信する"""
+
+    def __init__(self, data: Dict):
+        self.data = data
+
+
+class _SaveCheckpoint:
+    """完了したステップの結果をチェックポイントに保存する"""
+
+    def __init__(self, step: str, value):
+        self.step = step
+        self.value = value
 
 
-@app.task(bind=True, name='tasks.queue_processor.process_recipe_generation_task')
+def _recipe_pipeline_steps(ws_url: str, session_id: str, completed: Dict, checkpoint: Optional[PipelineCheckpoint]):
+    """run_recipe_pipeline・run_recipe_pipeline_asyncで共通のステップ
+
+    LLMの呼び出し・進捗の送信・チェックポイントの保存をyieldし、実行は呼び出し側（同期版・コルーチン版）に任せる。
+    LLMの呼び出し結果はsendで受け取り、生成結果をStopIterationの値として返す。
+    Bedrockの呼び出し中のコールバックはどちらの場合もワーカーのスレッドで実行されるため、同期APIで送信・保存する。
+    """
+    if completed:
+        print(f"Resuming from checkpoint: {list(completed)}")
+
+    def save_in_thread(step: str, value):
+        if checkpoint:
+            checkpoint.save(step, value)
+
+    def notify_stream(step_type: int, progress: int, content: str):
+        """ストリーミング中の部分出力を進捗として送信するコールバックを生成"""
+        def notify(partial: Dict):
+            send_task_progress_sync(ws_url, session_id, stream_progress_data(step_type, progress, content, partial))
+        return notify
+
+    # Step 1: レシピ生成開始
+    print("Step 1: レシピ生成開始")
+    bedrock_service = get_bedrock_service()
+    bedrock_embeddings_service = get_bedrock_embeddings_service()
+
+    if "gemini" in completed:
+        result = completed["gemini"]
+    else:
+        result = yield _ExtractRecipe(STREAM_PROGRESS_TYPES["gemini"], 0, "動画からレシピ情報を解析中...")
+        yield _SaveCheckpoint("gemini", result)
+
+    # Step 2: レシピ生成完了
+    print("Step 2: レシピ生成開始")
+    yield _SendProgress({
+        "content": "生成されたレシピ情報を生成中...",
+        "progress": 25,
+        "type": 2,  # タスク進捗
+    })
+
+    # Step 3: 親しみやすい表現に変換
+    print("Step 3: 親しみやすい表現に変換")
+    if "rewrite" in completed:
+        result = completed["rewrite"]
+    else:
+        result = yield _CallService("rewrite", bedrock_service.rewrite_recipe, (result, notify_stream(STREAM_PROGRESS_TYPES["rewrite"], 25, "レシピ情報を親しみやすい表現に変換中...")))
+        yield _SaveCheckpoint("rewrite", result)
+    yield _SendProgress({
+        "content": "レシピ情報を親しみやすい表現に変換中...",
+        "progress": 50,
+        "type": 3,
+    })
+
+    # Step 4-6: ジャンル分類・レシピ名生成・キーワード生成を並列実行
+    print("Step 4-6: ジャンル分類・レシピ名生成・キーワード生成")
+    # 完了順に進捗を進める
+    attribute_progress = iter([75, 80, 90])
+
+    def complete_attribute(name, value):
+        # 他の項目が失敗してもリトライ時に再利用できるよう項目ごとに保存
+        save_in_thread(name, value)
+        send_task_progress_sync(ws_url, session_id, attribute_progress_data(name, value, next(attribute_progress)))
+
+    attributes = {name: completed[name] for name in ATTRIBUTE_STEPS if name in completed}
+    for name, value in attributes.items():
+        yield _SendProgress(attribute_progress_data(name, value, next(attribute_progress)))
+    errors = {}
+    pending = [name for name in ATTRIBUTE_STEPS if name not in attributes]
+    if pending:
+        generated, errors = yield _CallService("attributes", bedrock_service.generate_recipe_attributes, (result, complete_attribute, pending))
+        attributes.update(generated)
+    for name, error in errors.items():
+        logger.error(f"Attribute generation failed ({name}): {str(error)}")
+    if errors:
+        raise next(iter(errors.values()))
+
+    # Step 7: レシピデータをembedding用に変換
+    print("Step 7: レシピデータをembedding用に変換")
+    embedding_prompt = build_embedding_prompt(bedrock_embeddings_service, result, attributes)
+    print(f"Embedding Prompt: {embedding_prompt}")
+    if "embedding" in completed:
+        embedding = completed["embedding"]
+    else:
+        embedding = yield _CallService("embedding", bedrock_embeddings_service.embed_text, (embedding_prompt,))
+        yield _SaveCheckpoint("embedding", embedding)
+
+    return {
+        "recipe": result,
+        "genre": attributes["genre"],
+        "recipe_name": attributes["recipe_name"],
+        "keywords": attributes["keywords"],
+        "embedding": embedding,
+        "embedding_model": bedrock_embeddings_service.model_id,
+    }
+
+
+def run_recipe_pipeline(
+    ws_url: str,
+    session_id: str,
+    url: str,
+    user_id: int,
+    checkpoint: Optional[PipelineCheckpoint] = None,
+    video: Optional[Dict] = None,
+) -> Dict:
+    """Gemini・Bedrockでレシピを生成し、各ステップの進捗をWebSocketで送信
+
+    checkpointを渡した場合は各ステップの結果を保存し、保存済みのステップは再実行せずに再開する。
+    videoはリクエストごとの動画解析のオプション（metadata["video"]）。
+    """
+    completed = checkpoint.load() if checkpoint else {}
+    steps = _recipe_pipeline_steps(ws_url, session_id, completed, checkpoint)
+    gemini_service = get_gemini_service()
+
+    outcome = None
+    while True:
+        try:
+            step = steps.send(outcome)
+        except StopIteration as stop:
+            return stop.value
+        outcome = None
+        if isinstance(step, _ExtractRecipe):
+            def notify(partial: Dict, step=step):
+                send_task_progress_sync(ws_url, session_id, stream_progress_data(step.stream_type, step.progress, step.content, partial))
+            with track_step("gemini"):
+                outcome = gemini_service.generate_content(url, on_progress=notify, video=video)
+        elif isinstance(step, _CallService):
+            with track_step(step.step):
+                outcome = step.func(*step.args)
+        elif isinstance(step, _SendProgress):
+            send_task_progress_sync(ws_url, session_id, step.data)
+        elif checkpoint:
+            checkpoint.save(step.step, step.value)
+
+
+async def run_recipe_pipeline_async(
+    ws_url: str,
+    session_id: str,
+    url: str,
+    user_id: int,
+    checkpoint: Optional[PipelineCheckpoint] = None,
+    video: Optional[Dict] = None,
+) -> Dict:
+    """run_recipe_pipelineのコルーチン版（PIPELINE_MODE=async）
+
+    GeminiとWebSocketは非同期APIで呼び出し、同期APIしかないBedrock（boto3）とチェックポイント（Redis）は
+    スレッドプールで実行して、プロセス共通のイベントループをブロックしない。ステップは同期版と共通。
+    """
+    completed = await asyncio.to_thread(checkpoint.load) if checkpoint else {}
+    steps = _recipe_pipeline_steps(ws_url, session_id, completed, checkpoint)
+    gemini_service = get_gemini_service()
+    # Geminiの部分出力はイベントループ上で通知されるため、送信を予約して次の進捗の前に完了を待つ
+    stream_sends = []
+
+    outcome = None
+    while True:
+        try:
+            step = steps.send(outcome)
+        except StopIteration as stop:
+            return stop.value
+        outcome = None
+        if isinstance(step, _ExtractRecipe):
+            def notify(partial: Dict, step=step):
+                data = stream_progress_data(step.stream_type, step.progress, step.content, partial)
+                stream_sends.append(asyncio.ensure_future(send_task_progress_async(ws_url, session_id, data)))
+            with track_step("gemini"):
+                outcome = await gemini_service.agenerate_content(url, on_progress=notify, video=video)
+        elif isinstance(step, _CallService):
+            with track_step(step.step):
+                outcome = await asyncio.to_thread(step.func, *step.args)
+        elif isinstance(step, _SendProgress):
+            await asyncio.gather(*stream_sends)
+            stream_sends.clear()
+            await send_task_progress_async(ws_url, session_id, step.data)
+        elif checkpoint:
+            await asyncio.to_thread(checkpoint.save, step.step, step.value)
+
+
+def stream_progress_data(step_type: int, progress: int, content: str, partial: Dict) -> Dict:
+    """ストリーミング中の部分出力の進捗通知内容"""
+    return {
+        "content": content,
+        "progress": progress,
+        "type": step_type,
+        "streaming": True,
+        **partial,
+    }
+
+
+def attribute_progress_data(name: str, value, progress: int) -> Dict:
+    """ジャンル・レシピ名・キーワードの生成完了の進捗通知内容"""
+    return {
+        **ATTRIBUTE_STEPS[name],
+        "progress": progress,
+        name: value,
+    }
+
+
+def build_embedding_prompt(embeddings_service, recipe: Dict, attributes: Dict) -> str:
+    """リライト済みレシピとジャンル・レシピ名・キーワードからembedding用のテキストを作成"""
+    # 材料・手順の変換のみに使うため、URL・ユーザーIDは参照しない
+    transform_result = transform_recipe_data(recipe, "", 0)
+    return embeddings_service.get_prompt(
+        recipe_name=attributes["recipe_name"],
+        ingredients=transform_result.get('ingredients', []),
+        processes=transform_result.get('processes', []),
+        genrue=attributes["genre"],
+        keyword=attributes["keywords"]
+    )
+
+
+def refresh_embedding(generated: Dict, embeddings_service) -> bool:
+    """キャッシュ済みの生成結果のembeddingが別モデルのものであれば、現在のモデルで作り直す"""
+    if generated.get("embedding_model", LEGACY_EMBEDDING_MODEL) == embeddings_service.model_id:
+        return False
+    prompt = build_embedding_prompt(embeddings_service, generated["recipe"], generated)
+    generated["embedding"] = embeddings_service.embed_text(prompt)
+    generated["embedding_model"] = embeddings_service.model_id
+    return True
+
+
+def replay_cached_progress(ws_url: str, session_id: str, generated: Dict):
+    """キャッシュヒット時や処理中タスクの結果を共有した場合も、通常と同じ順序で進捗を送信"""
+    send_task_progress_sync(ws_url, session_id, {
+        "content": "生成されたレシピ情報を生成中...",
+        "progress": 25,
+        "type": 2,
+    })
+    send_task_progress_sync(ws_url, session_id, {
+        "content": "レシピ情報を親しみやすい表現に変換中...",
+        "progress": 50,
+        "type": 3,
+    })
+    for progress, name in zip([75, 80, 90], ATTRIBUTE_STEPS):
+        send_task_progress_sync(ws_url, session_id, attribute_progress_data(name, generated[name], progress))
+
+
+@app.task(bind=True, name='tasks.queue_processor.process_recipe_generation_task', ignore_result=settings.RECIPE_TASK_RESULT_POLICY == "ignore")
 def process_recipe_generation_task(self, session_id: str, url: str, user_id: int, metadata: Dict = None):
     """FastAPIから呼び出されるレシピ生成タスク - WebSocket通信でリアルタイム進捗を送信"""
-    ws_url = settings.WEBSOCKET_URL + f"?session_id={session_id}"
+    ws_url = build_ws_url(session_id)
+    priority = resolve_priority(metadata)
+    wait_seconds = queue_wait_seconds(metadata)
+    started = time.monotonic()
+    # FastAPIから送信されたタスクは送信時刻ヘッダーがないため、metadataの作成日時から待ち時間を記録
+    if getattr(self.request, "published_at", None) is None and wait_seconds is not None:
+        record_queue_wait(self.name, wait_seconds)
     
     try:
         print("\n=== Recipe Generation Task Started ===")
@@ -76,119 +611,380 @@ def process_recipe_generation_task(self, session_id: str, url: str, user_id: int
         # メタデータがある場合は表示
         if metadata:
             print(f"Metadata: {metadata}")
-            print(f"Priority: {metadata.get('priority', 'N/A')}")
+            print(f"Priority: {metadata.get('priority', 'N/A')} (broker priority: {priority})")
             print(f"Created at: {metadata.get('created_at', 'N/A')}")
             print(f"Status: {metadata.get('status', 'N/A')}")
         
-        # ここでレシピ生成の実処理をシミュレート（段階的に進捗を送信）
+        # 同じ動画の生成結果がキャッシュにあればLLMパイプラインを省略
+        # 動画解析の解像度・フレームの頻度・解析範囲の指定（キャッシュは指定ごとに分ける）
+        video = (metadata or {}).get("video")
+        video_id = extract_shorts_video_id(url)
+        bypass_cache = (metadata or {}).get("bypass_cache", False)
+        use_cache = settings.RECIPE_CACHE_ENABLED and video_id and not bypass_cache
+        recipe_cache = RecipeResultCache() if use_cache else None
+        generated = recipe_cache.get(video_id, video) if recipe_cache else None
+
+        # リトライ時に完了済みステップから再開するためのチェックポイント
+        checkpoint = PipelineCheckpoint(session_id, url) if settings.CHECKPOINT_ENABLED else None
+
+        def generate():
+            if settings.PIPELINE_MODE == "async":
+                # タスクのスレッドは完了を待つだけで、LLM・WebSocketの待ち時間はプロセス共通のイベントループで重ねる
+                generated = pipeline_runner.run(run_recipe_pipeline_async, ws_url, session_id, url, user_id, checkpoint, video)
+            else:
+                generated = run_recipe_pipeline(ws_url, session_id, url, user_id, checkpoint, video)
+            if recipe_cache:
+                recipe_cache.set(video_id, generated, video)
+            return generated
+
+        if generated:
+            print(f"Cache hit: video_id={video_id}")
+            # embeddingのモデル移行中は、移行前のモデルのembeddingを返さない
+            if refresh_embedding(generated, get_bedrock_embeddings_service()):
+                recipe_cache.set(video_id, generated, video)
+            replay_cached_progress(ws_url, session_id, generated)
+        elif settings.PIPELINE_MODE == "canvas":
+            # ステップごとのタスクに分割し、Gemini用・Bedrock用のキューで実行
+            workflow = dispatch_recipe_canvas(
+                session_id, url, user_id, video_id if use_cache else None,
+                priority=priority, wait_seconds=wait_seconds, video=video,
+            )
+            print(f"Dispatched recipe canvas: {workflow.id}")
+            return {
+                "status": "DISPATCHED",
+                "workflow_id": workflow.id,
+            }
+        elif settings.SINGLE_FLIGHT_ENABLED and video_id and not bypass_cache:
+            # 同じ動画を処理中のタスクがあればその結果を共有
+            generated, shared = SingleFlight().run(f"{pipeline_version()}:{video_id}:{video_variant(video)}", generate)
+            if shared:
+                print(f"Shared in-flight result: video_id={video_id}")
+                replay_cached_progress(ws_url, session_id, generated)
+        else:
+            generated = generate()
+
+        # WebSocket: タスク完了通知
+        data = build_completion_data(generated, url, user_id)
+        send_task_completed_sync(ws_url, session_id, data)
+        if checkpoint:
+            checkpoint.clear()
+        PriorityLatencyRecorder().record(priority, wait_seconds, time.monotonic() - started)
+        
+        print(f"Result: {data['result']}")
+        print(f"Service registry: {service_registry.stats()}")
+        print("=" * 50)
         
-        # Step 1: レシピ生成開始
-        print("Step 1: レシピ生成開始")
-        gemini_service = GeminiService()
-        bedrock_service = BedrockService()
-        bedrock_embeddings_service = BedrockEmbeddingsService()
-        result = gemini_service.generate_content(url)
-
-        # Step 2: レシピ生成完了
-        print("Step 2: レシピ生成開始")
-        data = {
+        return task_result(settings.RECIPE_TASK_RESULT_POLICY, data, recipe_result_summary(session_id, video_id if use_cache else None, data))
+        
+    except Exception as e:
+        logger.error(f"Recipe generation task error: {str(e)}")
+        print(f"処理エラー: {str(e)}")
+        handle_task_error(self, ws_url, session_id, e)
+        raise
+
+
+def build_ws_url(session_id: str) -> str:
+    return settings.WEBSOCKET_URL + f"?session_id={session_id}"
+
+
+def build_completion_data(generated: Dict, url: str, user_id: int) -> Dict:
+    """生成結果からタスク完了通知のデータを作成"""
+    genrue = generated["genre"]
+    recipe_name = generated["recipe_name"]
+    keywords = generated["keywords"]
+    return {
+        "content": "レシピ生成が完了までもう少しです。",
+        "result": transform_recipe_data(generated["recipe"], url, user_id),
+        "genrue": genrue.get('genre', ''),
+        "keywords": keywords.get('keywords', ''),
+        "recipe_name": recipe_name.get('recipes', {}).get('recipe_name', 'AIが生成したレシピ'),
+        "embedding": generated["embedding"],
+        "progress": 99,
+    }
+
+
+def recipe_result_summary(session_id: str, video_id: Optional[str], data: Dict) -> Dict:
+    """結果バックエンドに保存する完了レコード
+
+    video_idはレシピキャッシュに生成結果を保存した場合のみ指定する（キャッシュ無効・bypass_cacheの場合はNone）。
+    キャッシュのエントリは期限切れ・件数上限で削除されるため、参照できない場合もある。
+    """
+    return {
+        "status": "COMPLETED",
+        "session_id": session_id,
+        "video_id": video_id,
+        "recipe_name": data["recipe_name"],
+    }
+
+
+def handle_task_error(task, ws_url: str, session_id: str, error: Exception):
+    """エラーを分類し、一時的なエラー・スロットリングは再試行を予約、それ以外はタスク失敗を通知
+
+    再試行する場合はcelery.exceptions.Retryを送出する（チェックポイントにより完了済みステップは再実行されない）。
+    """
+    schedule_retry(task, error)
+
+    # WebSocket: タスク失敗通知
+    send_task_failed_notification(ws_url, session_id, error)
+
+
+def schedule_retry(task, error: Exception):
+    """一時的なエラー・スロットリングであれば再試行を予約してcelery.exceptions.Retryを送出し、それ以外は失敗として記録"""
+    if service_registry.invalidate_if_credential_error(error):
+        logger.warning("Credential error detected, LLM services will be recreated")
+    kind = classify_error(error)
+    retries = task.request.retries
+    metrics = RetryMetrics()
+    if kind != PERMANENT and retries < settings.TASK_MAX_RETRIES:
+        countdown = retry_countdown(retries, kind, getattr(error, "retry_after", None))
+        metrics.record(task.name, f"retry:{kind}")
+        logger.warning(f"Retrying {task.name} in {countdown:.1f}s ({kind}, attempt {retries + 1}/{settings.TASK_MAX_RETRIES})")
+        raise task.retry(exc=error, countdown=countdown, max_retries=settings.TASK_MAX_RETRIES)
+    metrics.record(task.name, f"failed:{kind}")
+
+
+def send_task_failed_notification(ws_url: str, session_id: str, error: Exception):
+    error_data = {
+        "error_type": type(error).__name__,
+        "failed_at": datetime.utcnow().isoformat(),
+        "content": "レシピ生成中にエラーが発生しました",
+    }
+    send_task_failed_sync(ws_url, session_id, error_data)
+
+
+# --- Celery canvas によるステップ分割実行 ---
+# gemini_extract → rewrite → group(genre, recipe_name, keywords) → chord(embed + publish)
+# Gemini の動画解析と Bedrock のテキスト処理を別キューに分け、それぞれ独立してスケールさせる
+
+
+def dispatch_recipe_canvas(
+    session_id: str,
+    url: str,
+    user_id: int,
+    cache_video_id: Optional[str] = None,
+    priority: Optional[int] = None,
+    wait_seconds: Optional[float] = None,
+    video: Optional[Dict] = None,
+):
+    """レシピ生成のステップをCelery canvasとして実行
+
+    各ステップのメッセージにも元のタスクと同じ優先度を付け、Gemini用・Bedrock用のキューでも優先度順に処理させる。
+    """
+    if priority is None:
+        priority = settings.CELERY_DEFAULT_PRIORITY
+    context = {
+        "session_id": session_id,
+        "url": url,
+        "user_id": user_id,
+        "cache_video_id": cache_video_id,
+        "priority": priority,
+        "wait_seconds": wait_seconds,
+        "dispatched_at": time.time(),
+        "video": video,
+        # 属性の進捗カウンターをワークフローごとに分けるためのID
+        "run_id": uuid.uuid4().hex,
+    }
+    # mergedモードは1回の呼び出しで全項目を生成するため分割しない
+    if settings.BEDROCK_ATTRIBUTE_MODE == "merged":
+        attribute_groups = [list(ATTRIBUTE_STEPS)]
+    else:
+        attribute_groups = [[name] for name in ATTRIBUTE_STEPS]
+    workflow = chain(
+        extract_recipe_step.s(context).set(priority=priority),
+        rewrite_recipe_step.s().set(priority=priority),
+        chord(
+            [generate_attributes_step.s(names).set(priority=priority) for names in attribute_groups],
+            embed_and_publish_step.s().set(priority=priority),
+        ),
+    )
+    return workflow.apply_async()
+
+
+def _stage_checkpoint(context: Dict) -> Optional[PipelineCheckpoint]:
+    if not settings.CHECKPOINT_ENABLED:
+        return None
+    return PipelineCheckpoint(context["session_id"], context["url"])
+
+
+def _run_stage(task, context: Dict, stage: Callable[[str, Optional[PipelineCheckpoint], Dict], Dict]) -> Dict:
+    """ステップを実行し、失敗時は再試行またはタスク失敗を通知"""
+    ws_url = build_ws_url(context["session_id"])
+    try:
+        checkpoint = _stage_checkpoint(context)
+        completed = checkpoint.load() if checkpoint else {}
+        return stage(ws_url, checkpoint, completed)
+    except Exception as e:
+        logger.error(f"Recipe canvas stage error: {str(e)}")
+        handle_task_error(task, ws_url, context["session_id"], e)
+        raise
+
+
+def _attribute_progress_key(context: Dict) -> str:
+    return f"recipe_progress:{context['session_id']}:{context['run_id']}"
+
+
+def _next_attribute_progress(context: Dict, name: str) -> int:
+    """別タスクで完了する属性の進捗を完了順に割り当てる
+
+    完了した項目名の集合で数えるため、chordのヘッダーが再試行されても進捗は進みすぎない。
+    """
+    redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+    key = _attribute_progress_key(context)
+    pipe = redis_client.pipeline()
+    pipe.sadd(key, name)
+    pipe.scard(key)
+    pipe.expire(key, settings.CHECKPOINT_TTL)
+    _, count, _ = pipe.execute()
+    return [75, 80, 90][min(count, 3) - 1]
+
+
+# 次のステップへの入力はメッセージで渡すため、fullの場合以外は途中のステップの結果を保存しない
+# （chordのヘッダーのgenerate_attributes_stepはコールバックに結果を渡すため保存する）
+@app.task(bind=True, name='tasks.queue_processor.extract_recipe_step', ignore_result=settings.RECIPE_TASK_RESULT_POLICY != "full")
+def extract_recipe_step(self, context: Dict) -> Dict:
+    """Step 1-2: Geminiで動画からレシピを抽出"""
+    def stage(ws_url, checkpoint, completed):
+        result = completed.get("gemini")
+        if result is None:
+            with track_step("gemini"):
+                result = get_gemini_service().generate_content(context["url"], video=context.get("video"))
+            if checkpoint:
+                checkpoint.save("gemini", result)
+        send_task_progress_sync(ws_url, context["session_id"], {
             "content": "生成されたレシピ情報を生成中...",
             "progress": 25,
-            "type": 2,  # タスク進捗
-        }
-        send_task_progress_sync(ws_url, session_id, data)
+            "type": 2,
+        })
+        return {**context, "gemini": result}
+    return _run_stage(self, context, stage)
+
 
-        # Step 3: 親しみやすい表現に変換
-        print("Step 3: 親しみやすい表現に変換")
-        result = bedrock_service.rewrite_recipe(result)
-        data = {
+@app.task(bind=True, name='tasks.queue_processor.rewrite_recipe_step', ignore_result=settings.RECIPE_TASK_RESULT_POLICY != "full")
+def rewrite_recipe_step(self, context: Dict) -> Dict:
+    """Step 3: Bedrockでレシピを親しみやすい表現に変換"""
+    def stage(ws_url, checkpoint, completed):
+        result = completed.get("rewrite")
+        if result is None:
+            with track_step("rewrite"):
+                result = get_bedrock_service().rewrite_recipe(context["gemini"])
+            if checkpoint:
+                checkpoint.save("rewrite", result)
+        send_task_progress_sync(ws_url, context["session_id"], {
             "content": "レシピ情報を親しみやすい表現に変換中...",
             "progress": 50,
-            "type": 3
-        }
-        send_task_progress_sync(ws_url, session_id, data)
-
-        # Step 4: ジャンル分類
-        print("Step 4: ジャンル分類")
-        genrue = bedrock_service.generate_genre(result)
-        data = {
-            "content": "レシピのジャンルを分類中...",
-            "progress": 75,
-            "genre": genrue,
-            "type": 4
-        }
+            "type": 3,
+        })
+        return {**context, "rewrite": result}
+    return _run_stage(self, context, stage)
 
-        send_task_progress_sync(ws_url, session_id, data)
 
-        # Step 5: レシピ名生成
-        print("Step 5: レシピ名生成")
-        recipe_name = bedrock_service.generate_recipe_name(result)
-        data = {
-            "content": "レシピ名を生成中...",
-            "progress": 80,
-            "recipe_name": recipe_name,
-            "type": 5
-        }
-
-        send_task_progress_sync(ws_url, session_id, data)
-        # Step 6: キーワード生成
-        print("Step 6: キーワード生成")
-        keywords = bedrock_service.generate_keywords(result)
-        data = {
-            "content": "レシピのキーワードを生成中...",
-            "progress": 90,
-            "keywords": keywords,
-            "type": 6
-        }
+@app.task(bind=True, name='tasks.queue_processor.generate_attributes_step')
+def generate_attributes_step(self, context: Dict, names: List[str]) -> Dict:
+    """Step 4-6: ジャンル・レシピ名・キーワードのうち指定された項目を生成"""
+    def stage(ws_url, checkpoint, completed):
+        session_id = context["session_id"]
+        attributes = {name: completed[name] for name in names if name in completed}
+        pending = [name for name in names if name not in attributes]
+        errors = {}
+        if pending:
+            with track_step("attributes"):
+                generated, errors = get_bedrock_service().generate_recipe_attributes(context["rewrite"], names=pending)
+            attributes.update(generated)
+        for name in names:
+            if name not in attributes:
+                continue
+            if checkpoint and name not in completed:
+                checkpoint.save(name, attributes[name])
+            send_task_progress_sync(ws_url, session_id, attribute_progress_data(name, attributes[name], _next_attribute_progress(context, name)))
+        if errors:
+            raise next(iter(errors.values()))
+        return {"context": context, "attributes": attributes}
+    return _run_stage(self, context, stage)
 
-        send_task_progress_sync(ws_url, session_id, data)
 
-        transform_result = transform_recipe_data(result, url, user_id)
+@app.task(bind=True, name='tasks.queue_processor.embed_and_publish_step', ignore_result=settings.RECIPE_TASK_RESULT_POLICY == "ignore")
+def embed_and_publish_step(self, results: List[Dict]) -> Dict:
+    """Step 7: embeddingを生成し、タスク完了を通知"""
+    context = results[0]["context"]
+    attributes = {}
+    for item in results:
+        attributes.update(item["attributes"])
 
-        # Step 7: レシピデータをembedding用に変換
-        print("Step 7: レシピデータをembedding用に変換")
-        embedding_prompt = bedrock_embeddings_service.get_prompt(
-            recipe_name=recipe_name,
-            ingredients=transform_result.get('ingredients', []),
-            processes=transform_result.get('processes', []),
-            genrue=genrue,
-            keyword=keywords
-        )
-        print(f"Embedding Prompt: {embedding_prompt}")
-        embedding = bedrock_embeddings_service.embed_text(embedding_prompt)
-        
-        
-        # WebSocket: タスク完了通知
-        data = {
-            "content": "レシピ生成が完了までもう少しです。",
-            "result": transform_result,
-            "genrue": genrue.get('genre', ''),
-            "keywords": keywords.get('keywords', ''),
-            "recipe_name": recipe_name.get('recipes', {}).get('recipe_name', 'AIが生成したレシピ'),
+    def stage(ws_url, checkpoint, completed):
+        session_id = context["session_id"]
+        embeddings_service = get_bedrock_embeddings_service()
+        embedding = completed.get("embedding")
+        if embedding is None:
+            embedding_prompt = build_embedding_prompt(embeddings_service, context["rewrite"], attributes)
+            with track_step("embedding"):
+                embedding = embeddings_service.embed_text(embedding_prompt)
+            if checkpoint:
+                checkpoint.save("embedding", embedding)
+        generated = {
+            "recipe": context["rewrite"],
+            **attributes,
             "embedding": embedding,
-            "progress": 99,
+            "embedding_model": embeddings_service.model_id,
         }
+        if context.get("cache_video_id"):
+            RecipeResultCache().set(context["cache_video_id"], generated, context.get("video"))
+
+        data = build_completion_data(generated, context["url"], context["user_id"])
         send_task_completed_sync(ws_url, session_id, data)
-        
-        print(f"Result: {transform_result}")
-        print("=" * 50)
-        
-        return data
-        
+        if checkpoint:
+            checkpoint.clear()
+        redis.from_url(settings.REDIS_URL, decode_responses=True).delete(_attribute_progress_key(context))
+        if "priority" in context:
+            PriorityLatencyRecorder().record(
+                context["priority"],
+                context.get("wait_seconds"),
+                time.time() - context["dispatched_at"],
+            )
+        summary = recipe_result_summary(session_id, context.get("cache_video_id"), data)
+        return task_result(settings.RECIPE_TASK_RESULT_POLICY, data, summary)
+    return _run_stage(self, context, stage)
+
+
+@app.task(bind=True, name='tasks.queue_processor.reembed_recipes_task')
+def reembed_recipes_task(self, model_id: Optional[str] = None, cursor: int = 0, processed: int = 0) -> Dict:
+    """キャッシュ済みのレシピのembeddingを指定モデルで作り直す（embeddingのモデル移行用）
+
+    レシピキャッシュをREEMBED_CHUNK_SIZE件程度ずつ読み出して一括embeddingし、次のカーソルで自身を登録し直す。
+    1タスクの処理量を抑え、失敗した場合もそのチャンクから再開する。通常のレシピ生成より低い優先度で実行する。
+    """
+    model_id = model_id or settings.EMBEDDING_MODEL_ID
+    recipe_cache = RecipeResultCache()
+    try:
+        next_cursor, entries = recipe_cache.scan_entries(cursor, settings.REEMBED_CHUNK_SIZE)
+        stale = {key: entry for key, entry in entries.items() if entry.get("embedding_model", LEGACY_EMBEDDING_MODEL) != model_id}
+        if stale:
+            embeddings_service = get_bedrock_embeddings_service(model_id)
+            prompts = [build_embedding_prompt(embeddings_service, entry["recipe"], entry) for entry in stale.values()]
+            with track_step("reembed"):
+                embeddings = embeddings_service.embed_texts(prompts)
+            for entry, embedding in zip(stale.values(), embeddings):
+                entry["embedding"] = embedding
+                entry["embedding_model"] = model_id
+            recipe_cache.replace_entries(stale)
     except Exception as e:
-        logger.error(f"Recipe generation task error: {str(e)}")
-        print(f"処理エラー: {str(e)}")
-        
-        # WebSocket: タスク失敗通知
-        error_data = {
-            "error_type": type(e).__name__,
-            "failed_at": datetime.utcnow().isoformat(),
-            "content": "レシピ生成中にエラーが発生しました",
-        }
-        send_task_failed_sync(ws_url, session_id, error_data)
-        
+        logger.error(f"Re-embedding error (cursor={cursor}): {str(e)}")
+        schedule_retry(self, e)
         raise
 
+    processed += len(stale)
+    if next_cursor:
+        reembed_recipes_task.apply_async(args=(model_id, next_cursor, processed), priority=PRIORITY_LEVELS["low"])
+    else:
+        logger.info(f"Re-embedding with {model_id} completed: {processed} recipes")
+    return {
+        "model_id": model_id,
+        "cursor": cursor,
+        "next_cursor": next_cursor,
+        "chunk": len(entries),
+        "reembedded": len(stale),
+        "processed": processed,
+    }
+
 
 @app.task(bind=True, name='tasks.queue_processor.scan_recipe_tasks')
 def scan_recipe_tasks(self):
@@ -204,12 +1000,23 @@ def scan_recipe_tasks(self):
         for i, task in enumerate(tasks, 1):
             print(f"\n--- Task {i} ---")
             print(f"Key: {task['key']}")
+            print(f"Broker priority: {resolve_priority(task['data'])}")
             print("Data:")
             for field, value in task['data'].items():
                 print(f"  {field}: {value}")
         
         if not tasks:
             print("FastAPIからのタスクは見つかりませんでした。")
+        processor.acknowledge()
+
+        # 優先度区分ごとの平均待ち時間・処理時間、サーキットの状態と再試行回数
+        try:
+            for tier, stats in PriorityLatencyRecorder(processor.redis_client).summary().items():
+                print(f"Latency [{tier}]: {stats}")
+            print(f"Circuit breakers: {get_circuit_breaker().snapshot(['gemini', 'bedrock'])}")
+            print(f"Retries: {RetryMetrics(processor.redis_client).summary()}")
+        except Exception as e:
+            logger.warning(f"Metrics summary failed: {str(e)}")
         
         print("=" * 40)
         
@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+
+import pytest
+from langchain_aws.chat_models.bedrock_converse import ChatBedrockConverse
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import llm.bedrock as bedrock
+from llm.bedrock import RateLimitedChatBedrock, RateLimitedChatBedrockConverse
+from llm.chain import GenreClassificationChain, RecipeAttributesGenerationChain
+from llm.errors import TRANSIENT, StructuredOutputError, classify_error
+
+MODEL_ID = "apac.amazon.nova-pro-v1:0"
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.acquired = []
+        self.reported = []
+
+    def estimate_tokens(self, model, text=""):
+        return len(text)
+
+    @contextmanager
+    def acquire(self, model, tokens=0, requests=1):
+        self.acquired.append(model)
+        limiter = self
+
+        class Lease:
+            def report_tokens(self, actual_tokens):
+                limiter.reported.append(actual_tokens)
+
+        yield Lease()
+
+
+class RecordingBreaker:
+    def __init__(self):
+        self.guarded = []
+
+    @contextmanager
+    def guard(self, provider):
+        self.guarded.append(provider)
+        yield
+
+
+def tool_call_generate(self, messages, stop=None, run_manager=None, **kwargs):
+    """Converse APIのtool-useの応答を返すスタブ"""
+    name = kwargs["tools"][0]["function"]["name"]
+    message = AIMessage(
+        content="",
+        tool_calls=[{"name": name, "args": {"genre": "和食"}, "id": "call-1", "type": "tool_call"}],
+        usage_metadata={"input_tokens": 10, "output_tokens": 5, "total_tokens": 15},
+    )
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def text_generate(content):
+    """ツールを呼び出さずテキストで応答するスタブ"""
+    def generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+    return generate
+
+
+@pytest.fixture
+def recorders(monkeypatch):
+    limiter = RecordingLimiter()
+    breaker = RecordingBreaker()
+    monkeypatch.setattr(bedrock, "get_rate_limiter", lambda: limiter)
+    monkeypatch.setattr(bedrock, "get_circuit_breaker", lambda: breaker)
+    monkeypatch.setattr(ChatBedrockConverse, "_generate", tool_call_generate)
+    return limiter, breaker
+
+
+def chat_model() -> RateLimitedChatBedrock:
+    return RateLimitedChatBedrock(
+        model_id=MODEL_ID,
+        region_name="ap-northeast-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+        beta_use_converse_api=True,
+    )
+
+
+def test_converse_delegate_is_rate_limited():
+    assert isinstance(chat_model()._as_converse, RateLimitedChatBedrockConverse)
+
+
+def test_structured_chain_goes_through_wrapper(recorders):
+    limiter, breaker = recorders
+    chain = GenreClassificationChain(chat_llm=chat_model(), structured=True)
+
+    assert chain.invoke('{"recipe_name": "肉じゃが"}') == {"genre": "和食"}
+    # ChatBedrockとConverseの委譲先で二重に枠を確保しない
+    assert limiter.acquired == [MODEL_ID]
+    assert limiter.reported == [15]
+    assert breaker.guarded == ["bedrock"]
+
+
+def test_plain_chain_over_converse_goes_through_wrapper(recorders):
+    limiter, breaker = recorders
+    chat_model().invoke("こんにちは", tools=[{"type": "function", "function": {"name": "GenreOutput", "parameters": {}}}])
+    assert limiter.acquired == [MODEL_ID]
+    assert breaker.guarded == ["bedrock"]
+
+
+def test_structured_chain_falls_back_to_text_json(recorders, monkeypatch):
+    monkeypatch.setattr(ChatBedrockConverse, "_generate", text_generate('```json\n{"genre": "洋食"}\n```'))
+    chain = GenreClassificationChain(chat_llm=chat_model(), structured=True)
+
+    assert chain.invoke('{"recipe_name": "グラタン"}') == {"genre": "洋食"}
+
+
+def test_structured_chain_without_output_raises_retryable_error(recorders, monkeypatch):
+    monkeypatch.setattr(ChatBedrockConverse, "_generate", text_generate("ジャンルを判定できませんでした。"))
+    chain = RecipeAttributesGenerationChain(chat_llm=chat_model(), structured=True)
+
+    with pytest.raises(StructuredOutputError) as excinfo:
+        chain.invoke('{"recipe_name": "グラタン"}')
+    assert classify_error(excinfo.value) == TRANSIENT
@@ -0,0 +1,58 @@
+import fakeredis
+import pytest
+from kombu import Connection
+
+from utils.broker import BROKER_TRANSPORT_OPTIONS, KOMBU_DEFAULT_SEP, PriorityChannel, consume_order, find_misrouted_queue_keys
+from utils.priority import PRIORITY_LEVELS, priority_tier, resolve_priority
+
+QUEUE = "recipe_gen_queue"
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(PriorityChannel, "_get_client", lambda self: lambda **kwargs: fakeredis.FakeRedis(server=server))
+    connection = Connection("redis://localhost:6379/0", transport="utils.broker:PriorityRedisTransport", transport_options=BROKER_TRANSPORT_OPTIONS)
+    channel = connection.default_channel
+    yield channel
+    connection.release()
+
+
+def put(channel, name, priority=None):
+    properties = {} if priority is None else {"priority": priority}
+    channel._put(QUEUE, {"body": name, "properties": properties})
+
+
+def test_consume_order_reads_unmarked_messages_after_normal():
+    assert consume_order(range(10)) == [1, 2, 3, 4, 5, 0, 6, 7, 8, 9]
+
+
+def test_unmarked_messages_are_consumed_as_normal(channel):
+    put(channel, "unmarked")
+    put(channel, "low", PRIORITY_LEVELS["low"])
+    put(channel, "normal", PRIORITY_LEVELS["normal"])
+    put(channel, "high", PRIORITY_LEVELS["high"])
+
+    received = [channel._get(QUEUE)["body"] for _ in range(4)]
+
+    assert received == ["high", "normal", "unmarked", "low"]
+
+
+def test_priority_keys_use_shared_separator(channel):
+    put(channel, "high", PRIORITY_LEVELS["high"])
+
+    assert channel.client.llen(f"{QUEUE}:{PRIORITY_LEVELS['high']}") == 1
+
+
+def test_find_misrouted_queue_keys():
+    client = fakeredis.FakeRedis()
+    client.lpush(f"{QUEUE}{KOMBU_DEFAULT_SEP}3", "message")
+    client.lpush(f"{QUEUE}:3", "message")
+
+    assert find_misrouted_queue_keys(client, [QUEUE]) == [f"{QUEUE}{KOMBU_DEFAULT_SEP}3"]
+
+
+def test_resolve_priority_never_uses_the_unmarked_slot():
+    assert resolve_priority({"priority": "high"}) == PRIORITY_LEVELS["high"]
+    assert resolve_priority({"priority": 0}) == PRIORITY_LEVELS["high"]
+    assert priority_tier(0) == "normal"
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import fakeredis
+import pytest
+
+from utils.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from utils.rate_limiter import RateLimitTimeoutError
+
+
+class ThrottlingException(Exception):
+    pass
+
+
+class ServiceUnavailableException(Exception):
+    pass
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker(redis_client=fakeredis.FakeRedis(decode_responses=True), failure_threshold=2, window=60, reset_timeout=30)
+
+
+def open_circuit(breaker: CircuitBreaker, provider: str = "bedrock"):
+    """サーキットを開き、reset_timeoutが経過した状態にする"""
+    for _ in range(breaker.failure_threshold):
+        with pytest.raises(ServiceUnavailableException), breaker.guard(provider):
+            raise ServiceUnavailableException("503")
+    assert breaker.state(provider) == OPEN
+    breaker.redis_client.hset(breaker._key(provider), "opened_at", time.time() - breaker.reset_timeout - 1)
+
+
+def test_opens_after_transient_failures(breaker):
+    open_circuit(breaker)
+    breaker.redis_client.hset(breaker._key("bedrock"), "opened_at", time.time())
+    with pytest.raises(CircuitOpenError), breaker.guard("bedrock"):
+        pass
+    assert breaker.redis_client.ttl(breaker._key("bedrock")) > 0
+
+
+def test_probe_success_closes(breaker):
+    open_circuit(breaker)
+    with breaker.guard("bedrock"):
+        assert breaker.state("bedrock") == HALF_OPEN
+    assert breaker.state("bedrock") == CLOSED
+
+
+@pytest.mark.parametrize("error, expected", [
+    (ServiceUnavailableException("503"), OPEN),
+    (ThrottlingException("Rate exceeded"), OPEN),
+    (RateLimitTimeoutError("timed out waiting for a lease"), OPEN),
+    (ValueError("invalid input"), CLOSED),
+])
+def test_probe_failure_resolves_half_open(breaker, error, expected):
+    open_circuit(breaker)
+    with pytest.raises(type(error)), breaker.guard("bedrock"):
+        raise error
+    assert breaker.state("bedrock") == expected
+    assert not breaker.redis_client.exists(breaker._key("bedrock", "probe"))
+
+
+def test_half_open_probe_is_exclusive(breaker):
+    open_circuit(breaker)
+    with breaker.guard("bedrock"):
+        with pytest.raises(CircuitOpenError), breaker.guard("bedrock"):
+            pass
+
+
+def test_half_open_probe_taken_over_after_probe_expires(breaker):
+    open_circuit(breaker)
+    assert breaker.before_call("bedrock")
+    # 試行中のワーカーが異常終了し、試行の枠のTTLが切れた
+    breaker.redis_client.delete(breaker._key("bedrock", "probe"))
+    with breaker.guard("bedrock"):
+        pass
+    assert breaker.state("bedrock") == CLOSED
+
+
+def test_probe_released_on_base_exception(breaker):
+    open_circuit(breaker)
+    with pytest.raises(KeyboardInterrupt), breaker.guard("bedrock"):
+        raise KeyboardInterrupt
+    assert breaker.state("bedrock") == HALF_OPEN
+    with breaker.guard("bedrock"):
+        pass
+    assert breaker.state("bedrock") == CLOSED
+
+
+def test_throttle_while_closed_is_not_counted(breaker):
+    for _ in range(breaker.failure_threshold + 1):
+        with pytest.raises(ThrottlingException), breaker.guard("bedrock"):
+            raise ThrottlingException("Rate exceeded")
+    assert breaker.state("bedrock") == CLOSED
+
+
+def test_guard_async_resolves_half_open(breaker):
+    open_circuit(breaker)
+
+    async def probe():
+        async with breaker.guard_async("bedrock"):
+            raise ThrottlingException("Rate exceeded")
+
+    with pytest.raises(ThrottlingException):
+        asyncio.run(probe())
+    assert breaker.state("bedrock") == OPEN
+    assert not breaker.redis_client.exists(breaker._key("bedrock", "probe"))
+
+
+def test_redis_unavailable_lets_calls_through():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    breaker = CircuitBreaker(redis_client=fakeredis.FakeRedis(server=server, decode_responses=True))
+    with breaker.guard("bedrock"):
+        pass
+    with pytest.raises(ValueError):
+        with breaker.guard("bedrock"):
+            raise ValueError("invalid input")
@@ -0,0 +1,40 @@
+import pytest
+from pydantic import ValidationError
+
+from llm.output_models import GenreOutput, KeywordsOutput, RecipeAttributesOutput, RecipeOutput
+
+
+def test_enum_is_enforced():
+    assert GenreOutput(genre="和食").genre == "和食"
+    with pytest.raises(ValidationError):
+        GenreOutput(genre="フレンチ")
+
+
+def test_array_length_limits():
+    assert KeywordsOutput(keywords=["肉", "じゃがいも"]).keywords == ["肉", "じゃがいも"]
+    with pytest.raises(ValidationError):
+        KeywordsOutput(keywords=[])
+    with pytest.raises(ValidationError):
+        KeywordsOutput(keywords=[str(i) for i in range(6)])
+
+
+def test_required_fields():
+    with pytest.raises(ValidationError):
+        RecipeAttributesOutput(genre="和食", recipe_name="肉じゃが")
+
+
+def test_nested_objects_round_trip():
+    recipe = {
+        "recipes": {"recipe_name": "肉じゃが"},
+        "processes": [{"process_number": 1, "process": "じゃがいもを切る"}],
+        "ingredients": [{"ingredient_name": "じゃがいも", "amount": "2個"}],
+    }
+
+    assert RecipeOutput.model_validate(recipe).model_dump() == recipe
+
+
+def test_schema_description_is_passed_to_tool_definition():
+    schema = RecipeAttributesOutput.model_json_schema()
+
+    assert schema["properties"]["keywords"]["description"] == "A list of keywords related to the recipe."
+    assert schema["properties"]["keywords"]["maxItems"] == 5
@@ -0,0 +1,70 @@
+import fakeredis
+import pytest
+
+from config import settings
+from tasks.queue_processor import SimpleQueueProcessor
+
+
+@pytest.fixture
+def processor(monkeypatch):
+    monkeypatch.setattr(settings, "TASK_DISCOVERY_MODE", "stream")
+    monkeypatch.setattr(settings, "TASK_STREAM_CLAIM_IDLE_MS", 0)
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr("tasks.queue_processor.redis.from_url", lambda *args, **kwargs: client)
+    return SimpleQueueProcessor()
+
+
+def add_task(client, key, **fields):
+    client.hset(key, mapping={"session_id": key, "url": "https://example.com", **fields})
+    client.xadd(SimpleQueueProcessor.STREAM_KEY, {"key": key})
+
+
+def pending_count(client):
+    return client.xpending(SimpleQueueProcessor.STREAM_KEY, SimpleQueueProcessor.CONSUMER_GROUP)["pending"]
+
+
+def test_entries_stay_pending_until_acknowledged(processor):
+    client = processor.redis_client
+    add_task(client, "task:recipe_gen_1")
+
+    assert [task["key"] for task in processor.find_recipe_tasks()] == ["task:recipe_gen_1"]
+    assert pending_count(client) == 1
+
+    processor.acknowledge()
+
+    assert pending_count(client) == 0
+
+
+def test_unacknowledged_entries_are_reclaimed(processor):
+    client = processor.redis_client
+    add_task(client, "task:recipe_gen_1")
+    processor.find_recipe_tasks()
+
+    # 確認応答する前にスキャンが落ちた場合、別のスキャンが取り直す
+    retry = SimpleQueueProcessor()
+    assert [task["key"] for task in retry.find_recipe_tasks()] == ["task:recipe_gen_1"]
+    retry.acknowledge()
+    assert pending_count(client) == 0
+
+
+def test_acknowledge_trims_stream(processor, monkeypatch):
+    monkeypatch.setattr(settings, "TASK_STREAM_MAXLEN", 0)
+    client = processor.redis_client
+    for i in range(3):
+        add_task(client, f"task:recipe_gen_{i}")
+    processor.find_recipe_tasks()
+
+    processor.acknowledge()
+
+    assert client.xlen(SimpleQueueProcessor.STREAM_KEY) == 0
+
+
+def test_failed_scan_is_not_acknowledged(processor, monkeypatch):
+    client = processor.redis_client
+    add_task(client, "task:recipe_gen_1")
+    monkeypatch.setattr(processor, "_fetch_tasks", lambda keys: 1 / 0)
+
+    assert processor.find_recipe_tasks() == []
+    processor.acknowledge()
+
+    assert pending_count(client) == 1
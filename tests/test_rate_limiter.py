@@ -0,0 +1,96 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from config import settings
+from utils.rate_limiter import DistributedRateLimiter, RateLimitTimeoutError
+
+MODEL = "test-model"
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(settings, "RATE_LIMIT_ENABLED", True)
+
+
+def unavailable_redis():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    return fakeredis.FakeRedis(server=server, decode_responses=True)
+
+
+def make_limiter(redis_client=None, **limit):
+    return DistributedRateLimiter(
+        redis_client=redis_client or fakeredis.FakeRedis(decode_responses=True),
+        limits={MODEL: limit},
+        max_wait=0,
+        lease_ttl=60,
+    )
+
+
+def test_request_bucket_rejects_when_empty():
+    limiter = make_limiter(rpm=2)
+    for _ in range(2):
+        with limiter.acquire(MODEL) as lease:
+            assert lease.lease_id is not None
+
+    with pytest.raises(RateLimitTimeoutError):
+        with limiter.acquire(MODEL):
+            pass
+
+
+def test_batched_requests_take_several_slots():
+    limiter = make_limiter(rpm=3)
+    with limiter.acquire(MODEL, requests=3):
+        pass
+
+    with pytest.raises(RateLimitTimeoutError):
+        with limiter.acquire(MODEL):
+            pass
+
+
+def test_concurrency_slot_is_released_after_the_call():
+    limiter = make_limiter(concurrency=1)
+    with limiter.acquire(MODEL):
+        with pytest.raises(RateLimitTimeoutError):
+            with limiter.acquire(MODEL):
+                pass
+
+    with limiter.acquire(MODEL) as lease:
+        assert lease.lease_id is not None
+
+
+def test_reported_tokens_adjust_the_bucket():
+    limiter = make_limiter(tpm=100)
+    with limiter.acquire(MODEL, tokens=10) as lease:
+        lease.report_tokens(60)
+
+    tokens = float(limiter.redis_client.hget(limiter._key(MODEL, "bucket"), "tokens"))
+    assert tokens == pytest.approx(40, abs=1)
+    with pytest.raises(RateLimitTimeoutError):
+        with limiter.acquire(MODEL, tokens=50):
+            pass
+
+
+def test_calls_go_through_when_redis_is_down():
+    limiter = make_limiter(unavailable_redis(), rpm=1, tpm=10, concurrency=1)
+
+    for _ in range(3):
+        with limiter.acquire(MODEL, tokens=100) as lease:
+            assert lease.lease_id is None
+            lease.report_tokens(200)
+
+
+async def acquire_async_twice(limiter):
+    leases = []
+    for _ in range(2):
+        async with limiter.acquire_async(MODEL) as lease:
+            leases.append(lease)
+    return leases
+
+
+def test_acquire_async_when_redis_is_down():
+    limiter = make_limiter(unavailable_redis(), rpm=1)
+    leases = asyncio.run(acquire_async_twice(limiter))
+    assert [lease.lease_id for lease in leases] == [None, None]
@@ -0,0 +1,64 @@
+import fakeredis
+import pytest
+
+import utils.recipe_cache as recipe_cache
+from config import settings
+from llm.chain import RECIPE_INPUT_TEMPLATE
+from llm.prompt_cache import cacheable_prompt, prompt_text
+from utils.recipe_cache import RecipeResultCache, pipeline_version, video_variant
+
+VIDEO_ID = "abc123"
+
+
+@pytest.fixture
+def cache():
+    return RecipeResultCache(redis_client=fakeredis.FakeRedis(decode_responses=True), ttl=60, max_entries=2)
+
+
+def test_pipeline_version_covers_bedrock_prompts(monkeypatch):
+    version = pipeline_version()
+    changed = cacheable_prompt(prompt_text(recipe_cache.REWRITE_PROMPT) + "\n- 絵文字は使わないでください。", RECIPE_INPUT_TEMPLATE)
+    monkeypatch.setattr(recipe_cache, "REWRITE_PROMPT", changed)
+
+    assert pipeline_version() != version
+
+
+def test_prompt_text_ignores_prompt_cache_point(monkeypatch):
+    texts = []
+    for enabled in (False, True):
+        monkeypatch.setattr(settings, "BEDROCK_PROMPT_CACHE_ENABLED", enabled)
+        texts.append(prompt_text(cacheable_prompt("ジャンルを判定してください。", RECIPE_INPUT_TEMPLATE)))
+
+    assert texts[0] == texts[1]
+
+
+def test_pipeline_version_covers_attribute_mode(monkeypatch):
+    version = pipeline_version()
+    monkeypatch.setattr(settings, "BEDROCK_ATTRIBUTE_MODE", settings.BEDROCK_ATTRIBUTE_MODE + "-changed")
+
+    assert pipeline_version() != version
+
+
+def test_cache_key_depends_on_video_options(cache):
+    assert cache.make_key(VIDEO_ID) == cache.make_key(VIDEO_ID, {"unknown": 1})
+    assert cache.make_key(VIDEO_ID, {"fps": 1}) == cache.make_key(VIDEO_ID, {"fps": "1.0"})
+    assert cache.make_key(VIDEO_ID, {"fps": 1}) != cache.make_key(VIDEO_ID)
+    assert video_variant({"media_resolution": "low", "end_offset": 30}) == video_variant({"end_offset": 30, "media_resolution": "low"})
+
+
+def test_entries_are_stored_per_video_options(cache):
+    cache.set(VIDEO_ID, {"recipe_name": "肉じゃが"})
+
+    assert cache.get(VIDEO_ID) == {"recipe_name": "肉じゃが"}
+    assert cache.get(VIDEO_ID, {"media_resolution": "low"}) is None
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    cache.set("first", {"recipe_name": "1"})
+    cache.set("second", {"recipe_name": "2"})
+    cache.get("first")
+    cache.set("third", {"recipe_name": "3"})
+
+    assert cache.get("second") is None
+    assert cache.get("first") == {"recipe_name": "1"}
+    assert cache.get("third") == {"recipe_name": "3"}
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from utils.single_flight import SingleFlight
+
+KEY = "video-1"
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def single_flight(server, **kwargs):
+    kwargs.setdefault("lock_ttl", 30)
+    kwargs.setdefault("wait_timeout", 5)
+    return SingleFlight(redis_client=fakeredis.FakeRedis(server=server, decode_responses=True), poll_interval=0.05, **kwargs)
+
+
+def run_leader(server, compute):
+    """別スレッドでリーダーを実行し、ロックを取得するまで待つ"""
+    outcome = {}
+
+    def lead():
+        try:
+            outcome["result"] = single_flight(server).run(KEY, compute)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    leader = single_flight(server)
+    while not leader.redis_client.exists(leader._lock_key(KEY)):
+        time.sleep(0.01)
+    return thread, outcome
+
+
+def slow(value, release: threading.Event):
+    def compute():
+        release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+    return compute
+
+
+def test_follower_shares_leader_result(server):
+    release = threading.Event()
+    thread, outcome = run_leader(server, slow({"recipe_name": "肉じゃが"}, release))
+    threading.Timer(0.1, release.set).start()
+
+    result = single_flight(server).run(KEY, lambda: pytest.fail("follower must not compute"))
+    thread.join()
+
+    assert result == ({"recipe_name": "肉じゃが"}, True)
+    assert outcome["result"] == ({"recipe_name": "肉じゃが"}, False)
+
+
+def test_follower_takes_over_after_leader_failure(server):
+    release = threading.Event()
+    thread, outcome = run_leader(server, slow(RuntimeError("Gemini unavailable"), release))
+    threading.Timer(0.1, release.set).start()
+
+    result = single_flight(server).run(KEY, lambda: {"recipe_name": "follower"})
+    thread.join()
+
+    assert isinstance(outcome["error"], RuntimeError)
+    assert result == ({"recipe_name": "follower"}, False)
+
+
+def test_follower_takes_over_after_lock_expires(server):
+    client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    crashed = single_flight(server)
+    client.set(crashed._lock_key(KEY), "crashed-leader", px=200)
+
+    result = single_flight(server).run(KEY, lambda: {"recipe_name": "follower"})
+
+    assert result == ({"recipe_name": "follower"}, False)
+    assert not client.exists(crashed._lock_key(KEY))
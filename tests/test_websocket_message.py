@@ -0,0 +1,43 @@
+import json
+
+import msgpack
+import pytest
+
+from models.websocket_message import BINARY_SUBPROTOCOL, BINARY_VERSION, JSON_VERSION, WebSocketMessage
+
+EMBEDDING = [0.5, -1.25, 3.0]
+
+
+def completed_message():
+    return WebSocketMessage.task_completed("session-1", {"recipe_name": "肉じゃが", "embedding": EMBEDDING})
+
+
+def test_json_frames_are_unchanged_without_subprotocol():
+    payload = completed_message().encode()
+
+    assert isinstance(payload, str)
+    assert json.loads(payload)["version"] == JSON_VERSION
+    assert WebSocketMessage.decode(payload).data["embedding"] == EMBEDDING
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_binary_frames_round_trip(dtype):
+    message = completed_message()
+    payload = message.encode(BINARY_SUBPROTOCOL, embedding_dtype=dtype)
+
+    assert isinstance(payload, bytes)
+    fields = msgpack.unpackb(payload, raw=False)
+    assert fields["version"] == BINARY_VERSION
+    assert fields["data"]["embedding_dtype"] == dtype
+
+    decoded = WebSocketMessage.decode(payload)
+    assert decoded.version == BINARY_VERSION
+    assert decoded.data == {"recipe_name": "肉じゃが", "embedding": EMBEDDING}
+    assert decoded.session_id == message.session_id
+    assert decoded.timestamp == message.timestamp
+
+
+def test_binary_frame_without_embedding():
+    message = WebSocketMessage.task_progress("session-1", {"progress": 50, "type": 3})
+
+    assert WebSocketMessage.decode(message.encode(BINARY_SUBPROTOCOL)).data == {"progress": 50, "type": 3}
@@ -0,0 +1,66 @@
+import logging
+from bisect import bisect
+from typing import Iterable, List
+
+from kombu.transport import redis as kombu_redis
+
+from utils.priority import PRIORITY_LEVELS
+
+logger = logging.getLogger(__name__)
+
+# ワーカーとタスクを送信する側（FastAPIなど）で共通にするRedisブローカーのトランスポート設定。
+# 優先度ごとのリストのキー名は送信側のsep・priority_stepsで決まるため、送信側も必ずこの値でCeleryを設定する。
+# kombuの既定のsep（"\x06\x16"）で送信されたメッセージはこのワーカーでは受信されない。
+BROKER_TRANSPORT_OPTIONS = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+}
+
+# kombuの既定のsep。送信側の設定漏れの検出に使う
+KOMBU_DEFAULT_SEP = "\x06\x16"
+
+
+def consume_order(priority_steps: Iterable[int]) -> List[int]:
+    """優先度のリストを取り出す順番に並べる
+
+    優先度0と優先度なしのメッセージは、キー名に優先度が付かない同じリストに入る。
+    優先度なしで送信されたメッセージを最優先にしないよう、このリストはnormalの優先度のリストの直後に取り出す。
+    """
+    steps = sorted(priority_steps)
+    ordered = [step for step in steps if step]
+    position = bisect(ordered, PRIORITY_LEVELS["normal"])
+    return ordered[:position] + [0] + ordered[position:]
+
+
+class PriorityChannel(kombu_redis.Channel):
+    """優先度なしのメッセージをnormalの順番で取り出すRedisブローカーのチャネル"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sorted_priority_steps = sorted(self.priority_steps)
+        # _get / _brpop_start などはpriority_stepsの順にリストを取り出す
+        self.priority_steps = consume_order(self._sorted_priority_steps)
+
+    def priority(self, n):
+        steps = self._sorted_priority_steps
+        return steps[bisect(steps, n) - 1]
+
+
+class PriorityRedisTransport(kombu_redis.Transport):
+    """PriorityChannelを使うRedisトランスポート（broker_transportに指定する）"""
+
+    Channel = PriorityChannel
+
+
+def find_misrouted_queue_keys(redis_client, queues: Iterable[str]) -> List[str]:
+    """kombuの既定のsepで作られ、このワーカーが取り出さない優先度付きのリストのキーを返す"""
+    misrouted = []
+    for queue in queues:
+        for step in BROKER_TRANSPORT_OPTIONS["priority_steps"]:
+            if not step:
+                continue
+            key = f"{queue}{KOMBU_DEFAULT_SEP}{step}"
+            if redis_client.llen(key):
+                misrouted.append(key)
+    return misrouted
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import logging
+from typing import Any, Optional
+
+import redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineCheckpoint:
+    """レシピ生成パイプラインの各ステップの結果をRedisに保存するクラス
+
+    タスクが再配信・リトライされた場合に完了済みのステップを再実行せず、
+    最後に完了したステップの次から再開するために使う。
+    保存・読み込みに失敗してもタスクは失敗させず、ステップを再実行する。
+    """
+
+    KEY_PREFIX = "recipe_checkpoint"
+
+    def __init__(self, session_id: str, url: str, redis_client=None, ttl: Optional[int] = None):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.ttl = ttl if ttl is not None else settings.CHECKPOINT_TTL
+        # 同じセッションで別のURLが送られた場合に結果を取り違えないようURLも含める
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+        self.key = f"{self.KEY_PREFIX}:{session_id}:{url_hash}"
+
+    def load(self) -> dict:
+        """保存済みの全ステップの結果を取得"""
+        try:
+            values = self.redis_client.hgetall(self.key)
+            return {step: json.loads(value) for step, value in values.items()}
+        except Exception as e:
+            logger.warning(f"Checkpoint load failed: {str(e)}")
+            return {}
+
+    def save(self, step: str, value: Any):
+        """ステップの結果を保存（TTLを延長）"""
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.hset(self.key, step, json.dumps(value, ensure_ascii=False))
+            pipe.expire(self.key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Checkpoint save failed ({step}): {str(e)}")
+
+    def clear(self):
+        """パイプライン完了後にチェックポイントを削除"""
+        try:
+            self.redis_client.delete(self.key)
+        except Exception as e:
+            logger.warning(f"Checkpoint clear failed: {str(e)}")
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+import redis
+
+from config import settings
+from llm.errors import THROTTLE, TRANSIENT, classify_error
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 試行の枠の所有者であれば削除する
+RELEASE_PROBE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class CircuitOpenError(Exception):
+    """プロバイダーのサーキットが開いているため呼び出しを行わなかった"""
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"{provider} のサーキットが開いています（{retry_after:.0f}秒後に再試行可能）")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """プロバイダーごとのサーキットブレーカー（状態はRedisで全ワーカーPodと共有）
+
+    一定時間内に一時的な障害（5xx・タイムアウトなど）が閾値を超えるとサーキットを開き、
+    reset_timeoutの間は呼び出さずにCircuitOpenErrorを送出する。
+    経過後は1件だけ試行（half_open）し、成功すれば閉じ、一時的な障害・スロットリングで失敗すれば再び開く。
+    閉じている間のスロットリングはレートリミッタとリトライで扱うため失敗に数えない。
+    Redisに接続できない場合はサーキットを閉じているものとして扱う。
+    """
+
+    KEY_PREFIX = "llm_circuit"
+
+    def __init__(
+        self,
+        redis_client=None,
+        failure_threshold: Optional[int] = None,
+        window: Optional[int] = None,
+        reset_timeout: Optional[float] = None,
+    ):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.failure_threshold = failure_threshold or settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD
+        self.window = window or settings.CIRCUIT_BREAKER_WINDOW
+        self.reset_timeout = reset_timeout or settings.CIRCUIT_BREAKER_RESET_TIMEOUT
+
+    @contextmanager
+    def guard(self, provider: str) -> Iterator[None]:
+        """呼び出し前にサーキットを確認し、結果を記録する"""
+        if not settings.CIRCUIT_BREAKER_ENABLED:
+            yield
+            return
+        probe = self.before_call(provider)
+        try:
+            yield
+        except Exception as e:
+            self.record_error(provider, e, probe)
+            raise
+        else:
+            self.record_success(provider)
+        finally:
+            if probe:
+                self._release_probe(provider, probe)
+
+    @asynccontextmanager
+    async def guard_async(self, provider: str) -> AsyncIterator[None]:
+        """guardのコルーチン版（Redisでの状態の確認・記録はスレッドプールで行い、イベントループをブロックしない）"""
+        if not settings.CIRCUIT_BREAKER_ENABLED:
+            yield
+            return
+        probe = await asyncio.to_thread(self.before_call, provider)
+        try:
+            yield
+        except Exception as e:
+            await asyncio.to_thread(self.record_error, provider, e, probe)
+            raise
+        else:
+            await asyncio.to_thread(self.record_success, provider)
+        finally:
+            if probe:
+                await asyncio.to_thread(self._release_probe, provider, probe)
+
+    def before_call(self, provider: str) -> Optional[str]:
+        """サーキットが開いていればCircuitOpenErrorを送出
+
+        reset_timeout経過後の試行（half_open）を任された場合は、試行の枠を解放するためのトークンを返す。
+        試行中のワーカーが異常終了しても、枠のTTLが切れれば次の呼び出しが試行を引き継ぐ。
+        """
+        try:
+            state = self.redis_client.hgetall(self._key(provider))
+            if state.get("state", CLOSED) == CLOSED:
+                return None
+            elapsed = time.time() - float(state.get("opened_at", 0))
+            if state["state"] == HALF_OPEN or elapsed >= self.reset_timeout:
+                # 最初に到達したワーカーだけが試行する
+                token = uuid.uuid4().hex
+                if self.redis_client.set(self._key(provider, "probe"), token, nx=True, ex=int(self.reset_timeout) or 1):
+                    pipe = self.redis_client.pipeline()
+                    pipe.hset(self._key(provider), "state", HALF_OPEN)
+                    pipe.expire(self._key(provider), self._state_ttl())
+                    pipe.execute()
+                    logger.info(f"Circuit half-open: {provider}")
+                    return token
+        except redis.RedisError as e:
+            logger.warning(f"Circuit breaker unavailable ({provider}): {str(e)}")
+            return None
+        self._incr_metric(provider, "rejected_total")
+        raise CircuitOpenError(provider, max(self.reset_timeout - elapsed, 1.0))
+
+    def record_success(self, provider: str):
+        try:
+            if self.redis_client.hget(self._key(provider), "state") in (OPEN, HALF_OPEN):
+                self._close(provider)
+        except redis.RedisError as e:
+            logger.warning(f"Circuit breaker unavailable ({provider}): {str(e)}")
+
+    def record_error(self, provider: str, error: Exception, probe: Optional[str] = None):
+        """呼び出しの失敗を記録
+
+        一時的な障害のみ失敗に数える。試行（half_open）の呼び出しはどの失敗でも状態を確定させ、
+        スロットリング（レート制限の待機の打ち切りを含む）なら再び開き、入力の誤りなどプロバイダーが応答した失敗なら閉じる。
+        """
+        if isinstance(error, CircuitOpenError):
+            return
+        kind = classify_error(error)
+        if kind == TRANSIENT:
+            self.record_failure(provider)
+            return
+        if not probe:
+            return
+        try:
+            if kind == THROTTLE:
+                self._open(provider, 0)
+            else:
+                self._close(provider)
+        except redis.RedisError as e:
+            logger.warning(f"Circuit breaker unavailable ({provider}): {str(e)}")
+
+    def record_failure(self, provider: str):
+        try:
+            failures_key = self._key(provider, "failures")
+            pipe = self.redis_client.pipeline()
+            pipe.incr(failures_key)
+            pipe.hget(self._key(provider), "state")
+            failures, state = pipe.execute()
+            if failures == 1:
+                # 最初の失敗から window 秒間の失敗数を数える
+                self.redis_client.expire(failures_key, self.window)
+            self._incr_metric(provider, "failures_total")
+            if state == HALF_OPEN or (state != OPEN and failures >= self.failure_threshold):
+                self._open(provider, failures)
+        except redis.RedisError as e:
+            logger.warning(f"Circuit breaker unavailable ({provider}): {str(e)}")
+
+    def _open(self, provider: str, failures: int):
+        pipe = self.redis_client.pipeline()
+        pipe.hset(self._key(provider), mapping={"state": OPEN, "opened_at": time.time()})
+        # 状態を更新するワーカーがいなくなっても開いたままにならないよう期限を付ける
+        pipe.expire(self._key(provider), self._state_ttl())
+        pipe.delete(self._key(provider, "probe"), self._key(provider, "failures"))
+        pipe.execute()
+        self._incr_metric(provider, "opened_total")
+        logger.warning(f"Circuit opened: {provider} (failures={failures})")
+
+    def _close(self, provider: str):
+        self.redis_client.delete(self._key(provider), self._key(provider, "failures"), self._key(provider, "probe"))
+        self._incr_metric(provider, "closed_total")
+        logger.info(f"Circuit closed: {provider}")
+
+    def _release_probe(self, provider: str, token: str):
+        """試行の枠を解放（期限切れ後に他のワーカーが取得し直した枠は消さない）"""
+        try:
+            self.redis_client.eval(RELEASE_PROBE_SCRIPT, 1, self._key(provider, "probe"), token)
+        except redis.RedisError as e:
+            logger.warning(f"Circuit breaker unavailable ({provider}): {str(e)}")
+
+    def _state_ttl(self) -> int:
+        return int(self.reset_timeout) + self.window
+
+    def state(self, provider: str) -> str:
+        """現在の状態（closed / open / half_open）"""
+        return self.redis_client.hget(self._key(provider), "state") or CLOSED
+
+    def snapshot(self, providers) -> Dict[str, Dict]:
+        """プロバイダーごとの状態と累計の失敗・遮断・開閉回数"""
+        return {
+            provider: {
+                "state": self.state(provider),
+                **{name: int(value) for name, value in self.redis_client.hgetall(self._key(provider, "metrics")).items()},
+            }
+            for provider in providers
+        }
+
+    def _incr_metric(self, provider: str, name: str):
+        try:
+            self.redis_client.hincrby(self._key(provider, "metrics"), name, 1)
+        except redis.RedisError:
+            pass
+
+    def _key(self, provider: str, kind: Optional[str] = None) -> str:
+        if kind is None:
+            return f"{self.KEY_PREFIX}:{provider}"
+        return f"{self.KEY_PREFIX}:{provider}:{kind}"
+
+
+_circuit_breaker: Optional[CircuitBreaker] = None
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """プロセス共通のサーキットブレーカーを取得"""
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        _circuit_breaker = CircuitBreaker()
+    return _circuit_breaker
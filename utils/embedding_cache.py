@@ -0,0 +1,67 @@
+import hashlib
+import logging
+import struct
+from typing import Dict, List, Optional
+
+import redis
+
+from config import settings
+from utils.metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+
+def encode_embedding(embedding: List[float]) -> bytes:
+    """embeddingをリトルエンディアンのfloat32の列に変換（JSONの約1/3のサイズ）"""
+    return struct.pack(f"<{len(embedding)}f", *embedding)
+
+
+def decode_embedding(value: bytes) -> List[float]:
+    return list(struct.unpack(f"<{len(value) // 4}f", value))
+
+
+class EmbeddingCache:
+    """モデルと入力テキストのハッシュをキーにembeddingを保持するRedisキャッシュ
+
+    同じテキストの再embedding（再処理・バックフィル）でBedrockを呼び出さないようにする。
+    値はfloat32のバイナリで保存する。キャッシュの読み書きに失敗してもembeddingは失敗させない。
+    """
+
+    KEY_PREFIX = "embedding_cache"
+
+    def __init__(self, model_id: str, redis_client=None, ttl: Optional[int] = None):
+        self.model_id = model_id
+        # バイナリの値を扱うためデコードしないクライアントを使う
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL)
+        self.ttl = ttl if ttl is not None else settings.EMBEDDING_CACHE_TTL
+
+    def make_key(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.KEY_PREFIX}:{self.model_id}:{digest}"
+
+    def get_many(self, texts: List[str]) -> Dict[str, List[float]]:
+        """キャッシュにあるテキストのembeddingを取得（存在しないテキストは含まない）"""
+        if not texts:
+            return {}
+        try:
+            values = self.redis_client.mget([self.make_key(text) for text in texts])
+        except Exception as e:
+            logger.warning(f"Embedding cache read failed: {str(e)}")
+            return {}
+        cached = {}
+        for text, value in zip(texts, values):
+            record_cache("embedding", value is not None)
+            if value is not None:
+                cached[text] = decode_embedding(value)
+        return cached
+
+    def set_many(self, embeddings: Dict[str, List[float]]):
+        if not embeddings:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for text, embedding in embeddings.items():
+                pipe.set(self.make_key(text), encode_embedding(embedding), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {str(e)}")
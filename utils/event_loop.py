@@ -0,0 +1,130 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import os
+import threading
+from typing import Any, Callable, Coroutine, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundEventLoop:
+    """
+    Asyncio event loop running in a dedicated thread of the worker process
+
+    Coroutines can be submitted from any thread and return a
+    concurrent.futures.Future, so synchronous Celery task code never has to
+    run an event loop inline. The loop is recreated after fork so prefork
+    children never share the parent's thread.
+    """
+
+    def __init__(self, name: str = "background-loop"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._pid = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Return the running loop, starting it on first use"""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Schedule a coroutine on the loop from any thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback: Callable[..., Any], *args):
+        """Schedule a callback on the loop from any thread"""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def is_running(self) -> bool:
+        return self._loop is not None and self._pid == os.getpid()
+
+    def in_loop_thread(self) -> bool:
+        return self._thread is threading.current_thread()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the loop and wait for its thread to exit"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            if loop is None or self._pid != os.getpid():
+                return
+            self._loop = None
+            self._thread = None
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=timeout)
+        if not thread.is_alive():
+            loop.close()
+
+
+class BoundedCoroutineRunner:
+    """
+    Run coroutines submitted from worker threads on one shared loop per process
+
+    At most max_in_flight coroutines run at once; the others wait on the loop
+    without holding a slot. Each coroutine runs in a copy of the submitting
+    thread's context, so the task's tracing span stays the parent of spans
+    created on the loop. Blocking calls offloaded with run_in_executor use a
+    default executor of executor_workers threads.
+    """
+
+    def __init__(self, name: str, max_in_flight: int, executor_workers: int):
+        self.event_loop = BackgroundEventLoop(name=name)
+        self.max_in_flight = max(max_in_flight, 1)
+        self.executor_workers = max(executor_workers, 1)
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def run(self, coro_factory: Callable[..., Coroutine], *args, timeout: Optional[float] = None) -> Any:
+        """Run coro_factory(*args) on the loop and block the calling thread until it finishes"""
+        return self.submit(coro_factory, *args).result(timeout)
+
+    def submit(self, coro_factory: Callable[..., Coroutine], *args) -> concurrent.futures.Future:
+        """Schedule coro_factory(*args) on the loop from any thread"""
+        future = concurrent.futures.Future()
+        context = contextvars.copy_context()
+        self.event_loop.call_soon(self._start, future, context, coro_factory, args)
+        return future
+
+    def _start(self, future: concurrent.futures.Future, context: contextvars.Context, coro_factory: Callable[..., Coroutine], args: tuple):
+        """Runs on the loop"""
+        if not future.set_running_or_notify_cancel():
+            return
+        task = asyncio.get_running_loop().create_task(self._bounded(coro_factory, args), context=context)
+        task.add_done_callback(lambda done: self._copy_result(done, future))
+
+    async def _bounded(self, coro_factory: Callable[..., Coroutine], args: tuple) -> Any:
+        async with self._get_semaphore():
+            return await coro_factory(*args)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        # The loop is recreated after fork and asyncio primitives are bound to their loop
+        if self._semaphore_loop is not loop:
+            loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.executor_workers,
+                thread_name_prefix=f"{self.event_loop.name}-executor",
+            ))
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    @staticmethod
+    def _copy_result(task: asyncio.Task, future: concurrent.futures.Future):
+        if task.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+background_loop = BackgroundEventLoop(name="websocket-loop")
@@ -0,0 +1,170 @@
+"""
+Prometheus メトリクス
+
+prefork の各子プロセスで記録した値を集計するため、prometheus_client の multiprocess モードを使う。
+メインプロセスで HTTP サーバーを起動し、子プロセスが書き出した値をまとめて公開する。
+"""
+import glob
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from config import DEFAULT_LLM_TOKEN_PRICES, settings
+
+# prometheus_client は読み込み時に値の保存方式を決めるため、先に multiprocess モードのディレクトリを指定する
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", settings.METRICS_MULTIPROC_DIR)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# LLM呼び出し・パイプラインのステップは数百ミリ秒から数分かかる
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+# 動画解析1回あたりのGeminiのトークン数（60秒のShortsで約1.8万トークン）
+VIDEO_TOKEN_BUCKETS = (1000, 2500, 5000, 10000, 20000, 40000, 80000, 160000)
+WEBSOCKET_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PIPELINE_STEP_SECONDS = Histogram(
+    "recipe_pipeline_step_seconds",
+    "Duration of each recipe pipeline step",
+    ["step", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_CALL_SECONDS = Histogram(
+    "recipe_llm_call_seconds",
+    "Duration of each LLM call per routed step and model",
+    ["step", "model", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "recipe_llm_tokens_total",
+    "Tokens reported by the provider",
+    ["model", "kind"],
+)
+LLM_COST_USD = Counter(
+    "recipe_llm_cost_usd_total",
+    "Estimated LLM cost from reported tokens and list prices",
+    ["model"],
+)
+GEMINI_EXTRACTION_TOKENS = Histogram(
+    "recipe_gemini_extraction_tokens",
+    "Gemini input and output tokens per video extraction, including escalated passes",
+    ["media_resolution", "escalated"],
+    buckets=VIDEO_TOKEN_BUCKETS,
+)
+GEMINI_EXTRACTION_SECONDS = Histogram(
+    "recipe_gemini_extraction_seconds",
+    "Duration of a video extraction, including escalated passes",
+    ["media_resolution", "escalated"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    "recipe_cache_requests_total",
+    "Cache lookups by result",
+    ["cache", "result"],
+)
+WEBSOCKET_SEND_SECONDS = Histogram(
+    "recipe_websocket_send_seconds",
+    "Duration of WebSocket message delivery including reconnects",
+    ["message_type", "status"],
+    buckets=WEBSOCKET_BUCKETS,
+)
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    "recipe_task_queue_wait_seconds",
+    "Time between publishing a task and a worker starting it",
+    ["task"],
+    buckets=LATENCY_BUCKETS,
+)
+TASK_SECONDS = Histogram(
+    "recipe_task_seconds",
+    "Duration of Celery tasks",
+    ["task", "state"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+@contextmanager
+def track_step(step: str) -> Iterator[None]:
+    """パイプラインのステップの所要時間を記録"""
+    started = time.monotonic()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        PIPELINE_STEP_SECONDS.labels(step=step, status=status).observe(time.monotonic() - started)
+
+
+def record_llm_call(step: str, model: str, seconds: float, ok: bool):
+    LLM_CALL_SECONDS.labels(step=step, model=model, status="ok" if ok else "error").observe(seconds)
+
+
+def record_llm_usage(model: str, input_tokens: Optional[int], output_tokens: Optional[int], cached_input_tokens: Optional[int] = None):
+    """プロバイダーが返した使用トークン数と、定価から見積もった料金を記録
+
+    input_tokensはキャッシュから読み込んだ分（cached_input_tokens）を含む入力トークン数。
+    トークン数はキャッシュ外の入力（input）とキャッシュ済みの入力（cached_input）に分けて記録する。
+    """
+    input_tokens = input_tokens or 0
+    output_tokens = output_tokens or 0
+    cached_input_tokens = min(cached_input_tokens or 0, input_tokens)
+    uncached_input_tokens = input_tokens - cached_input_tokens
+    if uncached_input_tokens:
+        LLM_TOKENS.labels(model=model, kind="input").inc(uncached_input_tokens)
+    if cached_input_tokens:
+        LLM_TOKENS.labels(model=model, kind="cached_input").inc(cached_input_tokens)
+    if output_tokens:
+        LLM_TOKENS.labels(model=model, kind="output").inc(output_tokens)
+    price = {**DEFAULT_LLM_TOKEN_PRICES, **settings.LLM_TOKEN_PRICES}.get(model)
+    if price and (input_tokens or output_tokens):
+        cost = (
+            uncached_input_tokens * price.get("input", 0)
+            + cached_input_tokens * price.get("cached_input", price.get("input", 0))
+            + output_tokens * price.get("output", 0)
+        ) / 1_000_000
+        LLM_COST_USD.labels(model=model).inc(cost)
+
+
+def record_gemini_extraction(media_resolution: Optional[str], escalated: bool, tokens: int, seconds: float):
+    """動画解析1回（再抽出を含む）のトークン数と所要時間を、最後に使った解像度ごとに記録"""
+    labels = {"media_resolution": media_resolution or "default", "escalated": "true" if escalated else "false"}
+    GEMINI_EXTRACTION_TOKENS.labels(**labels).observe(tokens)
+    GEMINI_EXTRACTION_SECONDS.labels(**labels).observe(seconds)
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def record_websocket_send(message_type: str, seconds: float, ok: bool):
+    WEBSOCKET_SEND_SECONDS.labels(message_type=message_type, status="ok" if ok else "error").observe(seconds)
+
+
+def record_queue_wait(task: str, seconds: float):
+    TASK_QUEUE_WAIT_SECONDS.labels(task=task).observe(max(seconds, 0.0))
+
+
+def record_task(task: str, seconds: float, state: str):
+    TASK_SECONDS.labels(task=task, state=state).observe(seconds)
+
+
+def start_metrics_server():
+    """メインプロセスで全子プロセスの値を公開するHTTPサーバーを起動
+
+    前回起動時の値が残らないよう、子プロセスを起動する前に保存ディレクトリを空にする。
+    """
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(settings.METRICS_PORT, registry=registry)
+    logger.info(f"Prometheus metrics exported on :{settings.METRICS_PORT}")
+
+
+def mark_process_dead(pid: int):
+    """終了した子プロセスの値のうち、プロセス単位のもの（gauge）を集計から外す"""
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,99 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# 優先度の名前とCelery（Redisブローカー）の優先度の対応。数値が小さいほど先に処理される。
+# 0は優先度なしのメッセージと同じリストに入り、normalとして扱われるため使わない（utils/broker.py）
+PRIORITY_LEVELS = {
+    "high": 1,
+    "normal": 5,
+    "low": 9,
+}
+
+
+def resolve_priority(metadata: Optional[Dict]) -> int:
+    """メタデータのpriorityをCeleryの優先度（1〜9）に変換
+
+    "high" / "normal" / "low" の名前、または1〜9の数値（小さいほど優先）を受け付ける。
+    指定がない・解釈できない場合は既定の優先度を返す。
+    """
+    value = (metadata or {}).get("priority")
+    if value is None:
+        return settings.CELERY_DEFAULT_PRIORITY
+    if isinstance(value, str) and value.lower() in PRIORITY_LEVELS:
+        return PRIORITY_LEVELS[value.lower()]
+    try:
+        return min(max(int(value), PRIORITY_LEVELS["high"]), 9)
+    except (TypeError, ValueError):
+        return settings.CELERY_DEFAULT_PRIORITY
+
+
+def priority_tier(priority: int) -> str:
+    """優先度の数値を high / normal / low の区分に変換（0はブローカーと同じくnormal）"""
+    if priority == 0:
+        return "normal"
+    if priority <= PRIORITY_LEVELS["high"] + 2:
+        return "high"
+    if priority >= PRIORITY_LEVELS["low"] - 2:
+        return "low"
+    return "normal"
+
+
+def parse_created_at(value) -> Optional[datetime]:
+    """メタデータのcreated_at（ISO 8601）をUTCのdatetimeに変換"""
+    if not value:
+        return None
+    try:
+        created_at = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at
+
+
+class PriorityLatencyRecorder:
+    """優先度区分ごとのキュー待ち時間・処理時間をRedisに集計するクラス
+
+    全ワーカーの値を1か所に集計し、対話的なリクエストが一括処理の後ろで待たされていないかを確認する。
+    """
+
+    KEY_PREFIX = "recipe_metrics:priority"
+
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+    def record(self, priority: int, wait_seconds: Optional[float], duration_seconds: float):
+        tier = priority_tier(priority)
+        logger.info(f"Task latency: priority={priority} tier={tier} wait={wait_seconds}s duration={duration_seconds:.3f}s")
+        try:
+            key = f"{self.KEY_PREFIX}:{tier}"
+            pipe = self.redis_client.pipeline()
+            pipe.hincrby(key, "count", 1)
+            pipe.hincrbyfloat(key, "duration_seconds_total", duration_seconds)
+            if wait_seconds is not None:
+                pipe.hincrby(key, "wait_count", 1)
+                pipe.hincrbyfloat(key, "wait_seconds_total", wait_seconds)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Priority latency record failed: {str(e)}")
+
+    def summary(self) -> Dict[str, Dict]:
+        """優先度区分ごとの平均待ち時間・平均処理時間"""
+        summary = {}
+        for tier in PRIORITY_LEVELS:
+            values = self.redis_client.hgetall(f"{self.KEY_PREFIX}:{tier}")
+            count = int(values.get("count", 0))
+            wait_count = int(values.get("wait_count", 0))
+            summary[tier] = {
+                "count": count,
+                "avg_wait_seconds": float(values.get("wait_seconds_total", 0)) / wait_count if wait_count else None,
+                "avg_duration_seconds": float(values.get("duration_seconds_total", 0)) / count if count else None,
+            }
+        return summary
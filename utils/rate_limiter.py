@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, Optional, Tuple
+
+import redis
+
+from config import DEFAULT_LLM_RATE_LIMITS, settings
+
+logger = logging.getLogger(__name__)
+
+# リクエスト数・トークン数のトークンバケットと同時実行枠を、全て空いている場合のみまとめて確保する。
+# 時刻はRedisサーバーの時刻を使い、Pod間の時計のずれの影響を受けないようにする。
+# 確保できない場合は次に確保できるまでの見込み秒数を返す。
+# ARGV[7]は確保するリクエスト数（一括embeddingなど1回の枠で複数回呼び出す場合）。
+ACQUIRE_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local concurrency = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local lease_ttl = tonumber(ARGV[6])
+local request_cost = tonumber(ARGV[7]) or 1
+
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'ts')
+local elapsed = math.max(now - (tonumber(state[3]) or now), 0)
+local requests = math.min(rpm, (tonumber(state[1]) or rpm) + elapsed * rpm / 60)
+local tokens = math.min(tpm, (tonumber(state[2]) or tpm) + elapsed * tpm / 60)
+
+local wait = 0
+if rpm > 0 then
+  local need_requests = math.min(request_cost, rpm)
+  if requests < need_requests then
+    wait = math.max(wait, (need_requests - requests) * 60 / rpm)
+  end
+end
+if tpm > 0 then
+  -- バケットより大きいリクエストはバケットが満杯になるまで待たせる
+  local need = math.min(cost, tpm)
+  if tokens < need then
+    wait = math.max(wait, (need - tokens) * 60 / tpm)
+  end
+end
+if concurrency > 0 then
+  redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+  if redis.call('ZCARD', KEYS[2]) >= concurrency then
+    wait = math.max(wait, 0.05)
+  end
+end
+if wait > 0 then
+  return tostring(wait)
+end
+
+redis.call('HSET', KEYS[1], 'requests', tostring(requests - request_cost), 'tokens', tostring(tokens - cost), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 120)
+if concurrency > 0 then
+  redis.call('ZADD', KEYS[2], now + lease_ttl, ARGV[5])
+  redis.call('EXPIRE', KEYS[2], lease_ttl * 2)
+end
+return '0'
+"""
+
+
+class RateLimitTimeoutError(Exception):
+    """上限に達したまま待機時間の上限を超えた"""
+
+
+class RateLimitLease:
+    """確保した呼び出し枠
+
+    呼び出し後に実際の使用トークン数を報告すると、見込みとの差分をトークンバケットに反映する。
+    """
+
+    def __init__(self, limiter: "DistributedRateLimiter", model: str, lease_id: Optional[str], estimated_tokens: int):
+        self.limiter = limiter
+        self.model = model
+        self.lease_id = lease_id
+        self.estimated_tokens = estimated_tokens
+        self.waited = 0.0
+
+    def report_tokens(self, actual_tokens: Optional[int]):
+        if self.lease_id is None or not actual_tokens:
+            return
+        self.limiter.adjust_tokens(self.model, actual_tokens - self.estimated_tokens)
+
+
+class DistributedRateLimiter:
+    """Redisを使って全ワーカーPodで共有するモデルごとのレート制限・同時実行数制限
+
+    毎分リクエスト数（rpm）・毎分トークン数（tpm）をトークンバケットで、
+    同時実行数（concurrency）を期限付きの枠で管理する。上限に達した場合はエラーにせず、
+    枠が空くまで待機してから呼び出す。Redisに接続できない場合は制限せずに呼び出す。
+    """
+
+    KEY_PREFIX = "llm_ratelimit"
+
+    def __init__(
+        self,
+        redis_client=None,
+        limits: Optional[Dict[str, dict]] = None,
+        max_wait: Optional[float] = None,
+        lease_ttl: Optional[int] = None,
+    ):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.limits = limits if limits is not None else {**DEFAULT_LLM_RATE_LIMITS, **settings.LLM_RATE_LIMITS}
+        self.max_wait = max_wait if max_wait is not None else settings.RATE_LIMIT_MAX_WAIT
+        self.lease_ttl = lease_ttl if lease_ttl is not None else settings.RATE_LIMIT_LEASE_TTL
+        self._acquire_script = self.redis_client.register_script(ACQUIRE_SCRIPT)
+
+    def estimate_tokens(self, model: str, text: str = "") -> int:
+        """入力テキストの文字数と、モデルごとに見込むトークン数から消費トークン数を見積もる"""
+        return len(text) + int(self.limits.get(model, {}).get("estimated_tokens", 0))
+
+    @contextmanager
+    def acquire(self, model: str, tokens: int = 0, requests: int = 1) -> Iterator[RateLimitLease]:
+        """呼び出し枠を確保し、ブロックを抜けるときに同時実行枠を解放する
+
+        requestsにはブロック内で呼び出すリクエスト数を指定する（同時実行枠は1つだけ確保する）。
+        """
+        limit = self.limits.get(model)
+        if not limit or not settings.RATE_LIMIT_ENABLED:
+            yield RateLimitLease(self, model, None, tokens)
+            return
+
+        lease = self._wait_for_lease(model, limit, tokens, requests)
+        try:
+            yield lease
+        finally:
+            self._release(model, limit, lease)
+
+    @asynccontextmanager
+    async def acquire_async(self, model: str, tokens: int = 0, requests: int = 1) -> AsyncIterator[RateLimitLease]:
+        """acquireのコルーチン版（枠が空くまでの待機中もイベントループをブロックしない）
+
+        同期クライアントでのRedisへの問い合わせは、他のタスクのコルーチンを止めないようスレッドプールで実行する。
+        """
+        limit = self.limits.get(model)
+        if not limit or not settings.RATE_LIMIT_ENABLED:
+            yield RateLimitLease(self, model, None, tokens)
+            return
+
+        lease_id = uuid.uuid4().hex
+        started = time.monotonic()
+        while True:
+            lease, delay = await asyncio.to_thread(self._attempt, model, limit, tokens, requests, lease_id, started)
+            if lease is not None:
+                break
+            await asyncio.sleep(delay)
+        try:
+            yield lease
+        finally:
+            await asyncio.to_thread(self._release, model, limit, lease)
+
+    def adjust_tokens(self, model: str, delta: int):
+        """見込みと実際の使用トークン数の差分をバケットから差し引く"""
+        if not delta or not self.limits.get(model, {}).get("tpm"):
+            return
+        try:
+            self.redis_client.hincrbyfloat(self._key(model, "bucket"), "tokens", -delta)
+        except Exception as e:
+            logger.warning(f"Rate limit token adjustment failed ({model}): {str(e)}")
+
+    def _wait_for_lease(self, model: str, limit: dict, tokens: int, requests: int = 1) -> RateLimitLease:
+        lease_id = uuid.uuid4().hex
+        started = time.monotonic()
+        while True:
+            lease, delay = self._attempt(model, limit, tokens, requests, lease_id, started)
+            if lease is not None:
+                return lease
+            time.sleep(delay)
+
+    def _attempt(self, model: str, limit: dict, tokens: int, requests: int, lease_id: str, started: float) -> Tuple[Optional[RateLimitLease], float]:
+        """枠の確保を1回試み、(確保した枠, 次に試すまでの秒数) を返す（確保できなかった場合は枠がNone）"""
+        try:
+            wait = float(self._acquire_script(
+                keys=[self._key(model, "bucket"), self._key(model, "inflight")],
+                args=[
+                    limit.get("rpm", 0),
+                    limit.get("tpm", 0),
+                    limit.get("concurrency", 0),
+                    tokens,
+                    lease_id,
+                    self.lease_ttl,
+                    requests,
+                ],
+            ))
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter unavailable, calling without limit ({model}): {str(e)}")
+            return RateLimitLease(self, model, None, tokens), 0.0
+
+        waited = time.monotonic() - started
+        if wait <= 0:
+            if waited > 0.1:
+                logger.info(f"Rate limit wait: model={model} waited={waited:.2f}s")
+            lease = RateLimitLease(self, model, lease_id, tokens)
+            lease.waited = waited
+            return lease, 0.0
+        if waited + wait > self.max_wait:
+            raise RateLimitTimeoutError(f"{model} の呼び出し枠を {self.max_wait} 秒以内に確保できませんでした")
+        # 同時に待機しているワーカーが一斉に再試行しないよう揺らぎを加える
+        return None, min(wait, 5.0) * random.uniform(1.0, 1.2)
+
+    def _release(self, model: str, limit: dict, lease: RateLimitLease):
+        if lease.lease_id is not None and limit.get("concurrency", 0) > 0:
+            try:
+                self.redis_client.zrem(self._key(model, "inflight"), lease.lease_id)
+            except Exception as e:
+                logger.warning(f"Rate limit release failed ({model}): {str(e)}")
+
+    def _key(self, model: str, kind: str) -> str:
+        return f"{self.KEY_PREFIX}:{model}:{kind}"
+
+
+_rate_limiter: Optional[DistributedRateLimiter] = None
+
+
+def get_rate_limiter() -> DistributedRateLimiter:
+    """プロセス共通のレートリミッタを取得"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = DistributedRateLimiter()
+    return _rate_limiter
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+import redis
+
+from config import settings
+from llm.chain import ATTRIBUTES_PROMPT, GENRE_PROMPT, KEYWORDS_PROMPT, RECIPE_NAME_PROMPT, REWRITE_PROMPT
+from llm.gemini import RECIPE_EXTRACTION_PROMPT, video_options
+from llm.prompt_cache import prompt_text
+from llm.schemas import GENRE_SCHEMAS, KEYWORD_SCHEMAS, RECIPE_ATTRIBUTES_SCHEMAS, RECIPE_SCHEMAS, RECIPENAME_SCHEMAS
+from utils.metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+
+def pipeline_version() -> str:
+    """Gemini・Bedrockのプロンプト・スキーマ・生成設定から生成パイプラインのバージョンハッシュを算出
+
+    いずれかが変わると別のキャッシュキーになるため、古い生成結果は参照されなくなる。
+    """
+    source = "\n".join([
+        settings.RECIPE_CACHE_VERSION,
+        settings.BEDROCK_ATTRIBUTE_MODE,
+        RECIPE_EXTRACTION_PROMPT,
+        *(prompt_text(prompt) for prompt in (REWRITE_PROMPT, GENRE_PROMPT, RECIPE_NAME_PROMPT, KEYWORDS_PROMPT, ATTRIBUTES_PROMPT)),
+        RECIPE_SCHEMAS,
+        GENRE_SCHEMAS,
+        RECIPENAME_SCHEMAS,
+        KEYWORD_SCHEMAS,
+        RECIPE_ATTRIBUTES_SCHEMAS,
+    ])
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def video_variant(video: Optional[Dict] = None) -> str:
+    """動画解析のオプション（解像度・フレームの頻度・解析範囲）のハッシュ
+
+    オプションが異なると抽出結果も変わるため、キャッシュキー・single-flightのキーに含める。
+    """
+    source = json.dumps(video_options(video), sort_keys=True)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:8]
+
+
+class RecipeResultCache:
+    """動画ID（と動画解析のオプション）をキーにレシピ生成結果を保持するRedisキャッシュ
+
+    リライト済みレシピ・ジャンル・レシピ名・キーワード・embeddingを保存する。
+    各エントリはTTLで失効し、最終参照時刻のソート済みセットで件数上限を超えた古いものから削除する（LRU）。
+    キャッシュの読み書きに失敗してもタスクは失敗させない。
+    """
+
+    KEY_PREFIX = "recipe_cache"
+
+    def __init__(self, redis_client=None, ttl: Optional[int] = None, max_entries: Optional[int] = None):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.ttl = ttl if ttl is not None else settings.RECIPE_CACHE_TTL
+        self.max_entries = max_entries if max_entries is not None else settings.RECIPE_CACHE_MAX_ENTRIES
+        self.version = pipeline_version()
+        self.index_key = f"{self.KEY_PREFIX}:index"
+
+    def make_key(self, video_id: str, video: Optional[Dict] = None) -> str:
+        """動画ID・動画解析のオプション・パイプラインバージョンからキャッシュキーを生成"""
+        return f"{self.KEY_PREFIX}:{self.version}:{video_id}:{video_variant(video)}"
+
+    def get(self, video_id: str, video: Optional[Dict] = None) -> Optional[dict]:
+        """キャッシュされた生成結果を取得（存在しない場合はNone）"""
+        key = self.make_key(video_id, video)
+        try:
+            value = self.redis_client.get(key)
+            record_cache("recipe", value is not None)
+            if value is None:
+                self.redis_client.zrem(self.index_key, key)
+                return None
+            # 参照時刻を更新してLRUの順序に反映
+            self.redis_client.zadd(self.index_key, {key: time.time()})
+            return json.loads(value)
+        except Exception as e:
+            logger.warning(f"Recipe cache read failed: {str(e)}")
+            return None
+
+    def set(self, video_id: str, entry: dict, video: Optional[Dict] = None) -> bool:
+        """生成結果をキャッシュに保存"""
+        key = self.make_key(video_id, video)
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.set(key, json.dumps(entry, ensure_ascii=False), ex=self.ttl)
+            pipe.zadd(self.index_key, {key: time.time()})
+            pipe.execute()
+            self._evict()
+            return True
+        except Exception as e:
+            logger.warning(f"Recipe cache write failed: {str(e)}")
+            return False
+
+    def scan_entries(self, cursor: int, count: int) -> Tuple[int, Dict[str, dict]]:
+        """現在のバージョンのエントリをSCANで最大count件程度ずつ取得し、(次のカーソル, {キー: 生成結果}) を返す
+
+        次のカーソルが0の場合は全件を走査済み。
+        """
+        cursor, keys = self.redis_client.scan(cursor, match=f"{self.KEY_PREFIX}:{self.version}:*", count=count)
+        if not keys:
+            return cursor, {}
+        values = self.redis_client.mget(keys)
+        return cursor, {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    def replace_entries(self, entries: Dict[str, dict]):
+        """scan_entriesで取得したエントリを、TTLと参照順序を変えずに書き換える"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, entry in entries.items():
+            pipe.set(key, json.dumps(entry, ensure_ascii=False), keepttl=True, xx=True)
+        pipe.execute()
+
+    def _evict(self):
+        """TTL切れのインデックスを掃除し、上限を超えた分を古い順に削除"""
+        self.redis_client.zremrangebyscore(self.index_key, 0, time.time() - self.ttl)
+        overflow = self.redis_client.zcard(self.index_key) - self.max_entries
+        if overflow <= 0:
+            return
+        oldest = self.redis_client.zrange(self.index_key, 0, overflow - 1)
+        if oldest:
+            pipe = self.redis_client.pipeline()
+            pipe.delete(*oldest)
+            pipe.zrem(self.index_key, *oldest)
+            pipe.execute()
@@ -0,0 +1,43 @@
+import logging
+import random
+from typing import Dict, Optional
+
+import redis
+
+from config import settings
+from llm.errors import THROTTLE
+
+logger = logging.getLogger(__name__)
+
+
+def retry_countdown(retries: int, kind: str, retry_after: Optional[float] = None) -> float:
+    """再試行までの秒数（指数バックオフ + ジッター）
+
+    同じ障害で失敗した多数のタスクが同時に再試行しないよう、上限値の半分から上限値の間で揺らがせる。
+    スロットリングは基準値を4倍にして長めに待つ。サーキットが開いている場合は再開可能になるまで待つ。
+    """
+    base = settings.TASK_RETRY_BACKOFF * (4 if kind == THROTTLE else 1)
+    cap = min(settings.TASK_RETRY_BACKOFF_MAX, base * (2 ** retries))
+    countdown = random.uniform(cap / 2, cap)
+    if retry_after:
+        countdown = max(countdown, retry_after)
+    return countdown
+
+
+class RetryMetrics:
+    """タスク・エラー分類ごとの再試行回数と最終的な失敗数をRedisに集計するクラス"""
+
+    KEY = "recipe_metrics:retries"
+
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+    def record(self, task_name: str, outcome: str):
+        """outcomeは retry:<分類> / failed:<分類>"""
+        try:
+            self.redis_client.hincrby(self.KEY, f"{task_name}:{outcome}", 1)
+        except Exception as e:
+            logger.warning(f"Retry metrics record failed: {str(e)}")
+
+    def summary(self) -> Dict[str, int]:
+        return {field: int(value) for field, value in self.redis_client.hgetall(self.KEY).items()}
@@ -0,0 +1,121 @@
+import json
+import logging
+import time
+import uuid
+from typing import Callable, Optional, Tuple
+
+import redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# ロックの所有者であれば削除する（他のタスクが取得し直したロックを消さない）
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """同じキーの処理を複数タスクで重複実行しないためのRedisロック
+
+    最初にロックを取得したタスク（リーダー）だけが処理を実行し、結果をpub/subで通知する。
+    同時に到着した重複タスクは通知を待ち、リーダーの結果を共有する。
+    リーダーが失敗した場合はロックの解放後に、異常終了した場合はロックのTTL切れ後に、待機中のタスクがリーダーを引き継ぐ。
+    """
+
+    KEY_PREFIX = "recipe_inflight"
+
+    def __init__(self, redis_client=None, lock_ttl: Optional[int] = None, wait_timeout: Optional[float] = None, poll_interval: float = 1.0):
+        self.redis_client = redis_client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.lock_ttl = lock_ttl if lock_ttl is not None else settings.SINGLE_FLIGHT_LOCK_TTL
+        self.wait_timeout = wait_timeout if wait_timeout is not None else settings.SINGLE_FLIGHT_WAIT_TIMEOUT
+        self.poll_interval = poll_interval
+
+    def run(self, key: str, compute: Callable[[], dict]) -> Tuple[dict, bool]:
+        """キーに対する処理を1回だけ実行し、結果を共有
+
+        Returns:
+            (result, shared): 処理結果と、他のタスクの結果を共有したかどうか
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            token = uuid.uuid4().hex
+            if self.redis_client.set(self._lock_key(key), token, nx=True, ex=self.lock_ttl):
+                return self._lead(key, token, compute), False
+
+            shared = self._wait(key, deadline)
+            if shared is not None:
+                return shared, True
+            if time.monotonic() >= deadline:
+                logger.warning(f"Single-flight wait timed out, running independently: {key}")
+                return compute(), False
+
+    def _lead(self, key: str, token: str, compute: Callable[[], dict]) -> dict:
+        """リーダーとして処理を実行し、結果を待機中のタスクへ通知"""
+        try:
+            result = compute()
+        except Exception:
+            self._publish(key, {"status": "failed"})
+            self._release(key, token)
+            raise
+        message = {"status": "completed", "result": result}
+        # 購読前に完了したタスクも取得できるよう結果を短時間保存する
+        self.redis_client.set(self._result_key(key), json.dumps(message, ensure_ascii=False), ex=settings.SINGLE_FLIGHT_RESULT_TTL)
+        self._publish(key, message)
+        self._release(key, token)
+        return result
+
+    def _wait(self, key: str, deadline: float) -> Optional[dict]:
+        """リーダーの完了通知を待機（リーダーが失敗した・消えた場合はNone）"""
+        pubsub = self.redis_client.pubsub()
+        try:
+            pubsub.subscribe(self._channel(key))
+            while time.monotonic() < deadline:
+                message = self._load(self.redis_client.get(self._result_key(key)))
+                if message is None:
+                    notification = pubsub.get_message(ignore_subscribe_messages=True, timeout=self.poll_interval)
+                    if notification:
+                        message = self._load(notification["data"])
+                if message is not None:
+                    if message.get("status") == "completed":
+                        return message["result"]
+                    # リーダーの失敗は一時的な障害の場合もあるため、ロックを取得し直して自身で処理する
+                    logger.info(f"Single-flight leader failed, retrying lock: {key}")
+                    return None
+                # ロックが消えていればリーダーは終了しているため取得を試みる
+                if not self.redis_client.exists(self._lock_key(key)):
+                    return None
+            return None
+        finally:
+            pubsub.close()
+
+    def _publish(self, key: str, message: dict):
+        try:
+            self.redis_client.publish(self._channel(key), json.dumps(message, ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"Single-flight publish failed: {str(e)}")
+
+    def _release(self, key: str, token: str):
+        try:
+            self.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, self._lock_key(key), token)
+        except Exception as e:
+            logger.warning(f"Single-flight lock release failed: {str(e)}")
+
+    @staticmethod
+    def _load(value) -> Optional[dict]:
+        if not value:
+            return None
+        return json.loads(value)
+
+    def _lock_key(self, key: str) -> str:
+        return f"{self.KEY_PREFIX}:lock:{key}"
+
+    def _result_key(self, key: str) -> str:
+        return f"{self.KEY_PREFIX}:result:{key}"
+
+    def _channel(self, key: str) -> str:
+        return f"{self.KEY_PREFIX}:channel:{key}"
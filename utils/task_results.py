@@ -0,0 +1,55 @@
+import zlib
+from typing import Any, Dict, Optional
+
+import msgpack
+from kombu.serialization import register
+
+# タスク結果の保存方式
+#   full: 戻り値をそのまま結果バックエンドに保存
+#   summary: 状態と参照用の小さなレコードのみ保存（生成結果はWebSocket・レシピキャッシュから取得する）
+#   ignore: 保存しない（ステータスも記録されない）
+RESULT_POLICIES = ("full", "summary", "ignore")
+
+# zlibで圧縮したmsgpackのシリアライザ名
+COMPRESSED_MSGPACK = "msgpack-zlib"
+
+
+def _pack_default(obj):
+    # Celeryのgroupシグネチャは__len__がタスク数を返すため、dictのサブクラスは通常のdictにしてからパックする
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, tuple):
+        return list(obj)
+    for base in (bool, int, float, str, bytes):
+        if isinstance(obj, base):
+            return base(obj)
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+def register_serializers():
+    """kombuにmsgpack-zlibシリアライザを登録
+
+    結果バックエンドには圧縮の設定がないため、結果を圧縮する場合はこのシリアライザをresult_serializerに指定する。
+    kombu標準のmsgpackはcanvasのシグネチャ（group）を正しくパックできないため、
+    canvasモードでタスクメッセージをmsgpackにする場合もこのシリアライザをtask_serializerに指定する。
+    メッセージ・結果を読み込むプロセス（FastAPIなど）でも登録が必要。
+    """
+    register(
+        COMPRESSED_MSGPACK,
+        lambda data: zlib.compress(msgpack.packb(data, use_bin_type=True, strict_types=True, default=_pack_default)),
+        lambda payload: msgpack.unpackb(zlib.decompress(payload), raw=False),
+        content_type="application/x-msgpack-zlib",
+        content_encoding="binary",
+    )
+
+
+def task_result(policy: str, data: Any, summary: Dict) -> Optional[Any]:
+    """保存方式に応じて、タスクの戻り値（結果バックエンドに保存される値）を返す
+
+    ignoreの場合はタスクにignore_resultを指定するため、戻り値は保存されない。
+    """
+    if policy == "full":
+        return data
+    if policy == "ignore":
+        return None
+    return summary
@@ -0,0 +1,151 @@
+"""
+OpenTelemetry トレーシング
+
+タスクごとにスパンを作り、LLM呼び出し・Chain・embedding・WebSocket送信を子スパンとして記録する。
+トレースコンテキストはCeleryのメッセージヘッダー（W3C traceparent）で受け渡し、WebSocketメッセージにも付与する。
+エクスポーターはネットワークに依存しないよう、ローカルのOTLPコレクター・ファイル・標準出力から選ぶ。
+"""
+import functools
+import logging
+import os
+import threading
+from typing import Callable, Dict, Optional, Sequence
+
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter, SpanExportResult
+from opentelemetry.trace import Status, StatusCode
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+tracer = trace.get_tracer("bae-recipe-worker")
+
+_provider: Optional[TracerProvider] = None
+
+
+class FileSpanExporter(SpanExporter):
+    """スパンを1行1件のJSONでファイルに追記するエクスポーター"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        try:
+            lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            return SpanExportResult.SUCCESS
+        except OSError as e:
+            logger.warning(f"Span export failed: {str(e)}")
+            return SpanExportResult.FAILURE
+
+    def shutdown(self):
+        pass
+
+
+def init_tracing():
+    """プロセスのTracerProviderを初期化（TRACING_EXPORTERがnoneの場合は何もしない）
+
+    BatchSpanProcessorは送信用スレッドを持つため、preforkの子プロセスで起動後に呼び出す。
+    """
+    global _provider
+    exporter_name = settings.TRACING_EXPORTER
+    if exporter_name == "none" or _provider is not None:
+        return
+    if exporter_name == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=settings.TRACING_OTLP_ENDPOINT)
+    elif exporter_name == "file":
+        exporter = FileSpanExporter(settings.TRACING_FILE_PATH)
+    elif exporter_name == "console":
+        exporter = ConsoleSpanExporter()
+    else:
+        raise ValueError(f"不正なトレースのエクスポーターです: {exporter_name}")
+
+    _provider = TracerProvider(resource=Resource.create({
+        "service.name": settings.TRACING_SERVICE_NAME,
+        "process.pid": os.getpid(),
+    }))
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_provider)
+    logger.info(f"Tracing initialized with {exporter_name} exporter")
+
+
+def shutdown_tracing():
+    """未送信のスパンを送信してTracerProviderを停止"""
+    if _provider is not None:
+        _provider.shutdown()
+
+
+def traced(name: str, **attributes) -> Callable:
+    """関数の呼び出しを子スパンとして記録するデコレーター"""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.start_as_current_span(name, attributes=attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate_span(**attributes):
+    """現在のスパンに属性を追加"""
+    trace.get_current_span().set_attributes(attributes)
+
+
+def inject_context(carrier: Dict[str, str]):
+    """現在のトレースコンテキストをtraceparentとしてcarrierに書き込む"""
+    propagate.inject(carrier)
+
+
+def current_traceparent() -> Optional[str]:
+    carrier = {}
+    propagate.inject(carrier)
+    return carrier.get("traceparent")
+
+
+def start_task_span(task):
+    """メッセージヘッダーのトレースコンテキストを親として、タスクのスパンを開始
+
+    ヘッダーにコンテキストがない場合（トレースしていないプロデューサー）はタスクのスパンがルートになる。
+    """
+    # ワーカーではメッセージヘッダーがrequestの属性になり、apply()ではrequest.headersに入る
+    headers = getattr(task.request, "headers", None) or {}
+    carrier = {
+        key: value
+        for key in ("traceparent", "tracestate")
+        if (value := getattr(task.request, key, None) or headers.get(key))
+    }
+    span = tracer.start_span(
+        task.name,
+        context=propagate.extract(carrier),
+        kind=trace.SpanKind.CONSUMER,
+        attributes={
+            "celery.task_id": task.request.id or "",
+            "celery.retries": task.request.retries or 0,
+        },
+    )
+    task.request.trace_span = span
+    task.request.trace_token = context.attach(trace.set_span_in_context(span))
+
+
+def record_task_error(task, error: BaseException):
+    """タスクのスパンに例外を記録"""
+    span = getattr(task.request, "trace_span", None)
+    if span is not None:
+        span.record_exception(error)
+        span.set_status(Status(StatusCode.ERROR, str(error)))
+
+
+def end_task_span(task, state: Optional[str]):
+    span = getattr(task.request, "trace_span", None)
+    if span is None:
+        return
+    span.set_attribute("celery.state", state or "UNKNOWN")
+    span.end()
+    context.detach(task.request.trace_token)
+    task.request.trace_span = None
@@ -1,16 +1,38 @@
 import asyncio
+import atexit
+import concurrent.futures
 import logging
+import os
+import random
+import threading
+import time
 from contextlib import asynccontextmanager
 from typing import Optional
 
 import websockets
 from websockets.exceptions import ConnectionClosed, InvalidURI
 
-from models.websocket_message import WebSocketMessage
+from config import settings
+from models.websocket_message import BINARY_SUBPROTOCOL, WebSocketMessage
+from utils.event_loop import BackgroundEventLoop, background_loop
+from utils.metrics import record_websocket_send
+from utils.tracing import current_traceparent, tracer
 
 logger = logging.getLogger(__name__)
 
 
+def connect_options() -> dict:
+    """
+    Handshake options for websockets.connect
+
+    The binary subprotocol is only offered; a backend that does not select it keeps receiving JSON text.
+    """
+    return {
+        "subprotocols": [BINARY_SUBPROTOCOL] if settings.WEBSOCKET_BINARY_ENABLED else None,
+        "compression": "deflate" if settings.WEBSOCKET_COMPRESSION else None,
+    }
+
+
 class WebSocketClient:
     """
     WebSocket client for sending recipe generation task updates
@@ -29,7 +51,7 @@ class WebSocketClient:
         try:
             logger.info(f"Connecting to WebSocket: {self.ws_url}")
             websocket = await asyncio.wait_for(
-                websockets.connect(self.ws_url),
+                websockets.connect(self.ws_url, **connect_options()),
                 timeout=self.timeout
             )
             logger.info("WebSocket connection established")
@@ -61,20 +83,24 @@ class WebSocketClient:
         Returns:
             bool: True if message was sent successfully, False otherwise
         """
+        started = time.monotonic()
         try:
             async with self.connect() as websocket:
-                message_json = message.model_dump_json()
-                logger.debug(f"Sending WebSocket message: {message_json}")
+                payload = message.encode(websocket.subprotocol, settings.WEBSOCKET_EMBEDDING_DTYPE)
+                logger.debug(f"Sending WebSocket message: {payload!r}")
                 
-                await websocket.send(message_json)
+                await websocket.send(payload)
                 logger.info(f"Successfully sent {message.type} message for session {message.session_id}")
+                record_websocket_send(message.type, time.monotonic() - started, ok=True)
                 return True
                 
         except ConnectionClosed:
             logger.error("WebSocket connection was closed unexpectedly")
+            record_websocket_send(message.type, time.monotonic() - started, ok=False)
             return False
         except Exception as e:
             logger.error(f"Failed to send WebSocket message: {e}")
+            record_websocket_send(message.type, time.monotonic() - started, ok=False)
             return False
     
     def send_message_sync(self, message: WebSocketMessage) -> bool:
@@ -88,16 +114,9 @@ class WebSocketClient:
             bool: True if message was sent successfully, False otherwise
         """
         try:
-            # Create new event loop if one doesn't exist
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_closed():
-                    raise RuntimeError("Event loop is closed")
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            return loop.run_until_complete(self.send_message(message))
+            # Run on the shared background loop instead of blocking on an inline loop
+            future = background_loop.submit(self.send_message(message))
+            return future.result(timeout=self.timeout * 2)
             
         except Exception as e:
             logger.error(f"Error in synchronous WebSocket send: {e}")
@@ -124,30 +143,314 @@ class WebSocketClient:
         return await self.send_message(message)
 
 
+class _Channel:
+    """Outbound queue and connection state for a single WebSocket URL"""
+
+    def __init__(self, ws_url: str, max_queue_size: int):
+        self.ws_url = ws_url
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.websocket = None
+        self.reader = None
+        self.worker = None
+
+
+class WebSocketConnectionManager:
+    """
+    Long-lived WebSocket connections shared by all tasks in a worker process
+
+    Messages are enqueued without blocking the caller and sent in order on the
+    background event loop, one persistent connection per URL. When
+    multiplexing is enabled, messages of every session share the connection
+    to the base WebSocket URL and are routed by their session_id field.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 1000,
+        heartbeat_interval: float = 20.0,
+        idle_timeout: float = 60.0,
+        connect_timeout: float = 10.0,
+        max_backoff: float = 30.0,
+        max_retries: int = 5,
+        event_loop: BackgroundEventLoop = background_loop,
+    ):
+        self.max_queue_size = max_queue_size
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.event_loop = event_loop
+        self._lock = threading.Lock()
+        self._pid = None
+        self._channels = {}
+        self._pending = set()
+
+    def submit(self, ws_url: str, message: WebSocketMessage) -> concurrent.futures.Future:
+        """
+        Enqueue a message and return a future resolved with the delivery result
+
+        The future resolves to True once the message has been sent, or False
+        if it was dropped after retries or because the queue overflowed.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            # Forked worker processes must not reuse the parent's channels
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._channels = {}
+                self._pending = set()
+            self._pending.add(future)
+        future.add_done_callback(self._discard_pending)
+        try:
+            self.event_loop.call_soon(self._put, ws_url, message, future)
+        except Exception as e:
+            logger.error(f"Failed to enqueue WebSocket message: {e}")
+            future.set_result(False)
+        return future
+
+    def enqueue(self, ws_url: str, message: WebSocketMessage) -> bool:
+        """
+        Enqueue a message for delivery without waiting for the network
+
+        Returns:
+            bool: True if the message was accepted by the outbound queue
+        """
+        future = self.submit(ws_url, message)
+        return not (future.done() and not future.result())
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """
+        Wait until every message enqueued so far has been delivered or dropped
+
+        Returns:
+            bool: True if all pending messages completed within the timeout
+        """
+        with self._lock:
+            pending = list(self._pending)
+        if not pending:
+            return True
+        _, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        if not_done:
+            logger.warning(f"{len(not_done)} WebSocket messages still pending after {timeout}s")
+        return not not_done
+
+    def close(self, timeout: float = 5.0):
+        """Flush pending messages, close connections and stop the background loop"""
+        if not self.event_loop.is_running():
+            return
+        self.flush(timeout)
+        try:
+            self.event_loop.submit(self._shutdown()).result(timeout=timeout)
+        except Exception as e:
+            logger.warning(f"WebSocket manager did not shut down cleanly: {e}")
+        self.event_loop.stop(timeout)
+
+    def _discard_pending(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _put(self, ws_url: str, message: WebSocketMessage, future: concurrent.futures.Future):
+        """Runs on the background loop"""
+        channel = self._channels.get(ws_url)
+        if channel is None:
+            channel = _Channel(ws_url, self.max_queue_size)
+            self._channels[ws_url] = channel
+        if channel.queue.full():
+            dropped, dropped_future = channel.queue.get_nowait()
+            channel.queue.task_done()
+            dropped_future.set_result(False)
+            logger.warning(f"WebSocket queue full, dropping oldest {dropped.type} message for session {dropped.session_id}")
+        channel.queue.put_nowait((message, future))
+        if channel.worker is None or channel.worker.done():
+            channel.worker = asyncio.get_running_loop().create_task(self._run_channel(channel))
+
+    async def _run_channel(self, channel: _Channel):
+        """Send queued messages in order, reconnecting with backoff on failure"""
+        try:
+            while True:
+                try:
+                    message, future = await asyncio.wait_for(channel.queue.get(), timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # Close idle connections; the channel is recreated on the next message
+                    break
+                delivered = False
+                started = time.monotonic()
+                try:
+                    delivered = await self._deliver(channel, message)
+                finally:
+                    record_websocket_send(message.type, time.monotonic() - started, ok=delivered)
+                    channel.queue.task_done()
+                    if not future.done():
+                        future.set_result(delivered)
+        finally:
+            await self._disconnect(channel)
+            if self._channels.get(channel.ws_url) is channel:
+                if channel.queue.empty():
+                    del self._channels[channel.ws_url]
+                else:
+                    # Messages arrived while closing
+                    channel.worker = asyncio.get_running_loop().create_task(self._run_channel(channel))
+
+    async def _deliver(self, channel: _Channel, message: WebSocketMessage) -> bool:
+        backoff = 0.5
+        for attempt in range(self.max_retries + 1):
+            try:
+                websocket = await self._connect(channel)
+                await websocket.send(message.encode(websocket.subprotocol, settings.WEBSOCKET_EMBEDDING_DTYPE))
+                logger.info(f"Successfully sent {message.type} message for session {message.session_id}")
+                return True
+            except Exception as e:
+                logger.warning(f"WebSocket send failed (attempt {attempt + 1}): {e}")
+                await self._disconnect(channel)
+                if attempt < self.max_retries:
+                    await asyncio.sleep(backoff + random.uniform(0, backoff))
+                    backoff = min(backoff * 2, self.max_backoff)
+        logger.error(f"Dropping {message.type} message for session {message.session_id} after {self.max_retries + 1} attempts")
+        return False
+
+    async def _connect(self, channel: _Channel):
+        if channel.websocket is not None:
+            return channel.websocket
+        logger.info(f"Connecting to WebSocket: {channel.ws_url}")
+        channel.websocket = await asyncio.wait_for(
+            websockets.connect(
+                channel.ws_url,
+                ping_interval=self.heartbeat_interval,
+                ping_timeout=self.heartbeat_interval,
+                **connect_options(),
+            ),
+            timeout=self.connect_timeout
+        )
+        channel.reader = asyncio.get_running_loop().create_task(self._drain(channel, channel.websocket))
+        logger.info("WebSocket connection established")
+        return channel.websocket
+
+    async def _drain(self, channel: _Channel, websocket):
+        """Discard inbound frames so pings are answered and closure is detected"""
+        try:
+            async for _ in websocket:
+                pass
+        except Exception:
+            pass
+        if channel.websocket is websocket:
+            channel.websocket = None
+
+    async def _disconnect(self, channel: _Channel):
+        websocket, channel.websocket = channel.websocket, None
+        if channel.reader is not None:
+            channel.reader.cancel()
+            channel.reader = None
+        if websocket is not None:
+            try:
+                await websocket.close()
+                logger.info("WebSocket connection closed")
+            except Exception as e:
+                logger.warning(f"Error closing WebSocket: {e}")
+
+    async def _shutdown(self):
+        for channel in list(self._channels.values()):
+            await channel.queue.join()
+            if channel.worker is not None:
+                channel.worker.cancel()
+                await asyncio.gather(channel.worker, return_exceptions=True)
+            await self._disconnect(channel)
+        self._channels.clear()
+
+
+connection_manager = WebSocketConnectionManager(
+    max_queue_size=settings.WEBSOCKET_MAX_QUEUE_SIZE,
+    heartbeat_interval=settings.WEBSOCKET_HEARTBEAT_INTERVAL,
+    idle_timeout=settings.WEBSOCKET_IDLE_TIMEOUT,
+    max_backoff=settings.WEBSOCKET_MAX_BACKOFF,
+    max_retries=settings.WEBSOCKET_MAX_RETRIES,
+)
+atexit.register(connection_manager.close)
+
+
+def _send_sync(ws_url: str, message: WebSocketMessage) -> bool:
+    """Send through the persistent connection manager, or one connection per message"""
+    with tracer.start_as_current_span(f"websocket.{message.type}", attributes={"session_id": message.session_id}) as span:
+        # Let the backend join its spans to the task's trace
+        message.traceparent = current_traceparent()
+        sent = _deliver_sync(ws_url, message)
+        span.set_attribute("websocket.sent", sent)
+        return sent
+
+
+def _deliver_sync(ws_url: str, message: WebSocketMessage) -> bool:
+    if not settings.WEBSOCKET_PERSISTENT:
+        return WebSocketClient(ws_url).send_message_sync(message)
+    if settings.WEBSOCKET_MULTIPLEX:
+        ws_url = settings.WEBSOCKET_URL
+    if settings.WEBSOCKET_FIRE_AND_FORGET:
+        return connection_manager.enqueue(ws_url, message)
+    try:
+        return connection_manager.submit(ws_url, message).result(timeout=settings.WEBSOCKET_SEND_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Timed out waiting for WebSocket delivery: {e}")
+        return False
+
+
+async def _send_async(ws_url: str, message: WebSocketMessage) -> bool:
+    """Coroutine counterpart of _send_sync for pipelines running on an event loop"""
+    with tracer.start_as_current_span(f"websocket.{message.type}", attributes={"session_id": message.session_id}) as span:
+        message.traceparent = current_traceparent()
+        sent = await _deliver_async(ws_url, message)
+        span.set_attribute("websocket.sent", sent)
+        return sent
+
+
+async def _deliver_async(ws_url: str, message: WebSocketMessage) -> bool:
+    if not settings.WEBSOCKET_PERSISTENT:
+        return await WebSocketClient(ws_url).send_message(message)
+    if settings.WEBSOCKET_MULTIPLEX:
+        ws_url = settings.WEBSOCKET_URL
+    if settings.WEBSOCKET_FIRE_AND_FORGET:
+        return connection_manager.enqueue(ws_url, message)
+    delivery = asyncio.wrap_future(connection_manager.submit(ws_url, message))
+    # asyncio.wait leaves the delivery running on timeout, like the synchronous path
+    done, _ = await asyncio.wait({delivery}, timeout=settings.WEBSOCKET_SEND_TIMEOUT)
+    if not done:
+        logger.error("Timed out waiting for WebSocket delivery")
+        return False
+    return delivery.result()
+
+
+def flush_pending_messages(timeout: Optional[float] = None) -> bool:
+    """Wait for queued messages of this worker process to be delivered"""
+    if not settings.WEBSOCKET_PERSISTENT:
+        return True
+    return connection_manager.flush(timeout if timeout is not None else settings.WEBSOCKET_FLUSH_TIMEOUT)
+
+
 # Synchronous wrapper functions for use in Celery tasks
 def send_task_started_sync(ws_url: str, session_id: str, data: Optional[dict] = None) -> bool:
     """Synchronous wrapper for sending task started notification"""
-    client = WebSocketClient(ws_url)
     message = WebSocketMessage.task_started(session_id, data)
-    return client.send_message_sync(message)
+    return _send_sync(ws_url, message)
 
 
 def send_task_progress_sync(ws_url: str, session_id: str, data: Optional[dict] = None) -> bool:
     """Synchronous wrapper for sending task progress notification"""
-    client = WebSocketClient(ws_url)
     message = WebSocketMessage.task_progress(session_id, data)
-    return client.send_message_sync(message)
+    return _send_sync(ws_url, message)
 
 
 def send_task_completed_sync(ws_url: str, session_id: str, data: Optional[dict] = None) -> bool:
     """Synchronous wrapper for sending task completed notification"""
-    client = WebSocketClient(ws_url)
     message = WebSocketMessage.task_completed(session_id, data)
-    return client.send_message_sync(message)
+    return _send_sync(ws_url, message)
 
 
 def send_task_failed_sync(ws_url: str, session_id: str, data: Optional[dict] = None) -> bool:
     """Synchronous wrapper for sending task failed notification"""
-    client = WebSocketClient(ws_url)
     message = WebSocketMessage.task_failed(session_id, data)
-    return client.send_message_sync(message)
+    return _send_sync(ws_url, message)
+
+
+# Coroutine functions for use in the async pipeline
+async def send_task_progress_async(ws_url: str, session_id: str, data: Optional[dict] = None) -> bool:
+    """Send task progress notification without blocking the event loop"""
+    message = WebSocketMessage.task_progress(session_id, data)
+    return await _send_async(ws_url, message)
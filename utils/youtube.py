@@ -0,0 +1,19 @@
+import re
+from typing import Optional
+
+# YouTube Shorts URLのパターン（www.の有無・クエリ文字列を許容）
+YOUTUBE_SHORTS_PATTERN = r'^https://(www\.)?youtube\.com/shorts/([a-zA-Z0-9_-]+)(\?.*)?$'
+
+
+def extract_shorts_video_id(url: str) -> Optional[str]:
+    """YouTube Shorts URLから動画IDを抽出
+
+    www.の有無やクエリ文字列の違いに関わらず、同じ動画であれば同じIDを返す。
+    Shorts URLでない場合はNoneを返す。
+    """
+    if not url:
+        return None
+    match = re.match(YOUTUBE_SHORTS_PATTERN, url.strip())
+    if not match:
+        return None
+    return match.group(2)